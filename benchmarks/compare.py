@@ -0,0 +1,36 @@
+"""
+Compare two benchmark result files stage by stage.
+
+    python -m benchmarks.compare baseline.json new.json
+"""
+import argparse
+import json
+from benchmarks.run_benchmarks import STAGES
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {(r["scale"], r["stage"]): r for r in report["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline", help="Results of the reference commit.")
+    parser.add_argument("new", help="Results to compare against the reference.")
+    args = parser.parse_args()
+
+    baseline_report, baseline = load_results(args.baseline)
+    new_report, new = load_results(args.new)
+    print(f"baseline {baseline_report.get('commit')}  new {new_report.get('commit')}")
+    print(f"{'reads':>11} {'stage':<24} {'reads/s':>12} {'speedup':>8} {'peak MB':>9} {'change':>8}")
+    for key in sorted(set(baseline) & set(new), key=lambda key: (key[0], STAGES.index(key[1]))):
+        old, cur = baseline[key], new[key]
+        speedup = cur["seconds"] and old["seconds"] / cur["seconds"]
+        memory = cur["peak_rss_mb"] / old["peak_rss_mb"] if old["peak_rss_mb"] else 0
+        print(f"{key[0]:>11} {key[1]:<24} {cur['reads_per_sec'] or 0:12.0f} "
+              f"{speedup:7.2f}x {cur['peak_rss_mb']:9.1f} {memory:7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
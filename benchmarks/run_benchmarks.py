@@ -0,0 +1,177 @@
+"""
+Benchmark every pipeline stage on synthetic libraries of several sizes.
+
+    python -m benchmarks.run_benchmarks --reads 100000 1000000 --json results.json
+
+Each stage runs in a fresh process that reads its inputs from the outputs of
+the previous stage, so the reported peak RSS belongs to that stage alone
+(`children_peak_rss_mb` covers the worker processes it started). Results are
+written as JSON; compare two of them with `python -m benchmarks.compare`.
+"""
+import argparse
+import concurrent.futures
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+from collections import OrderedDict
+import yaml
+from benchmarks.synthetic import generate_dataset
+
+
+STAGES = ["load_fastq", "categorize_reads_by_hto", "deduplicate_umi",
+          "filter_cellbarcodes", "split_GEX_fastqs"]
+
+
+def run_stage(stage, config_path, output, threads, chunk_size, memory_budget=None):
+    """
+    Run one stage on the outputs of the previous ones in `output` and return
+    its wall time in seconds and peak memory in MB.
+    """
+    import numpy as np
+    from src.config_validator import load_config
+    from src.count_matrix import HTOCountMatrix
+    from src.demultiplexer import (categorize_reads_by_hto, deduplicate_umi,
+                                   filter_cellbarcodes, split_GEX_fastqs, load_cellbarcodes)
+    from src.engine import dataframe_module
+    from src.fastq_loader import load_fastq
+
+    config = load_config(config_path)
+    libname = config["libraries_with_HTOs"][0]["htolib_name"]
+    samples = [hto["sample_name"] for hto in config["HTO_sequences"]]
+    hto_fastqs = {d["R12"]: d["path"] for d in config["libraries_with_HTOs"]}
+    labels_path = os.path.join(output, f"{libname}_hto_labels.npy")
+    matrix_path = os.path.join(output, f"{libname}_hto_matrix.npz")
+    filtered_path = os.path.join(output, f"{libname}_filtered_cellbarcodes.csv")
+    # Inputs, and the dataframe library, are loaded before the clock starts
+    dataframe_module()
+    if stage == "deduplicate_umi":
+        hto_labels = np.load(labels_path)
+    elif stage == "filter_cellbarcodes":
+        matrix = HTOCountMatrix.load(matrix_path)
+    elif stage == "split_GEX_fastqs":
+        filtered_df = load_cellbarcodes(filtered_path, samples, config)
+
+    start = time.perf_counter()
+    if stage == "load_fastq":
+        load_fastq(libname=libname, fastq_R1=hto_fastqs["R1"], fastq_R2=hto_fastqs["R2"],
+                   config=config, thread=threads, chunk_size=chunk_size, output=output,
+                   statistics=OrderedDict())
+    elif stage == "categorize_reads_by_hto":
+        _, hto_labels = categorize_reads_by_hto(libname=libname, config=config, thread=threads,
+                                                chunk_size=chunk_size, output=output)
+    elif stage == "deduplicate_umi":
+        deduplicate_umi(samples=samples, hto_labels=hto_labels, libname=libname, config=config,
+                        thread=threads, chunk_size=chunk_size, output=output,
+                        memory_budget=memory_budget)
+    elif stage == "filter_cellbarcodes":
+        filter_cellbarcodes(matrix=matrix, config=config, libname=libname, output=output)
+    elif stage == "split_GEX_fastqs":
+        split_GEX_fastqs(libname=libname, config=config, filtered_df=filtered_df,
+                         output=output, chunk_size=chunk_size, statistics=OrderedDict(),
+                         thread=threads)
+    seconds = time.perf_counter() - start
+    if stage == "categorize_reads_by_hto":
+        np.save(labels_path, hto_labels)
+    # ru_maxrss is in kilobytes on Linux
+    return {"seconds": seconds,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "children_peak_rss_mb":
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def count_reads(path):
+    """
+    Count the records of a FASTQ file.
+    """
+    open_func = gzip.open if path.endswith(".gz") else open
+    with open_func(path, "rb") as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 22), b"")) // 4
+
+
+def benchmark(config_path, output, threads, chunk_size, memory_budget=None):
+    """
+    Run all stages in order, each in a new process, and return one result
+    per stage.
+    """
+    with open(config_path) as f:
+        config = yaml.safe_load(f)
+    reads = {"hto": count_reads(config["libraries_with_HTOs"][0]["path"]),
+             "gex": count_reads(config["libraries_to_be_demultiplexed"][0]["path"])}
+    os.makedirs(output, exist_ok=True)
+    results = []
+    for stage in STAGES:
+        # A process per stage keeps peak RSS from carrying over between stages
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_stage, stage, config_path, output, threads,
+                                     chunk_size, memory_budget).result()
+        n_reads = reads["gex" if stage == "split_GEX_fastqs" else "hto"]
+        result.update(stage=stage, reads=n_reads,
+                      reads_per_sec=n_reads / result["seconds"] if result["seconds"] else None)
+        results.append(result)
+        print(f"{stage:<24} {n_reads:>11} reads {result['seconds']:9.2f} s "
+              f"{result['reads_per_sec'] or 0:12.0f} reads/s {result['peak_rss_mb']:9.1f} MB",
+              flush=True)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scHTO pipeline stages on "
+                                                 "synthetic libraries.")
+    parser.add_argument("--reads", type=int, nargs="+", default=[100000, 1000000],
+                        help="Read pairs of the HTO and GEX libraries, one run per value.")
+    parser.add_argument("--cells", type=int, default=3000, help="Number of cells.")
+    parser.add_argument("--samples", type=int, default=3, help="Number of samples (max 8).")
+    parser.add_argument("--error_rate", type=float, default=0.01,
+                        help="Substitution rate of barcode and HTO bases.")
+    parser.add_argument("--no_gzip", action="store_true", help="Write plain FASTQ inputs.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator.")
+    parser.add_argument("--threads", type=int, default=4, help="Threads given to the stages.")
+    parser.add_argument("--chunk_size", type=int, default=1000000, help="Chunk size of the stages.")
+    parser.add_argument("--dedup_memory", type=int, default=None,
+                        help="Benchmark streaming deduplication with this budget in MB.")
+    parser.add_argument("--workdir", default="benchmark_data",
+                        help="Directory for the generated inputs and stage outputs.")
+    parser.add_argument("--json", default="benchmark_results.json", help="Result file.")
+    args = parser.parse_args()
+
+    report = {"commit": git_commit(), "python": platform.python_version(),
+              "machine": platform.machine(), "cpu_count": os.cpu_count(),
+              "parameters": {k: v for k, v in vars(args).items() if k not in ("workdir", "json")},
+              "results": []}
+    for n_reads in args.reads:
+        dataset = os.path.join(
+            args.workdir, f"reads{n_reads}_cells{args.cells}_samples{args.samples}_"
+                          f"error{args.error_rate}_seed{args.seed}"
+                          f"{'' if args.no_gzip else '_gz'}")
+        config_path = os.path.join(dataset, "config.yaml")
+        # Generated inputs are reused by later runs with the same parameters
+        if not os.path.exists(config_path):
+            print(f"Generating {n_reads} synthetic read pairs in {dataset}", flush=True)
+            generate_dataset(dataset, n_reads, n_cells=args.cells, n_samples=args.samples,
+                             error_rate=args.error_rate, compress=not args.no_gzip,
+                             seed=args.seed)
+        memory_budget = args.dedup_memory * 1024 ** 2 if args.dedup_memory else None
+        for result in benchmark(config_path, os.path.join(dataset, "output"), args.threads,
+                                args.chunk_size, memory_budget):
+            report["results"].append(dict(result, scale=n_reads))
+    with open(args.json, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Deterministic synthetic HTO and GEX libraries for benchmarks.
+
+Cells get random 16-nt barcodes and are spread evenly over the samples. Read
+pairs of the HTO library carry the barcode and a 12-nt UMI on R1 and the HTO
+of the cell's sample on R2; GEX read pairs carry a barcode and UMI on R1 and
+a random cDNA on R2. A share of the reads comes from background barcodes that
+belong to no cell, and bases of barcodes and HTOs are substituted at
+`error_rate`. The same arguments always produce the same files.
+"""
+import gzip
+import os
+import numpy as np
+import yaml
+
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+HTO_SEQUENCES = ["TTGGCCTTTGTATCG", "AACGCCAGTATGAAC", "GCTTCCGTATATCTG",
+                 "CTCCTCTGCAATTAC", "CAGTAGTCACGGTCA", "ATTGACCCGCGTTAG",
+                 "AAGTATCGTTTCGCA", "GGTTGCCAGATGTCA"]
+POSITIONS = {"cell_barcode_R12": "R1", "cell_barcode_start": 1, "cell_barcode_end": 16,
+             "umi_R12": "R1", "umi_start": 17, "umi_end": 28,
+             "hto_R12": "R2", "hto_start": 1, "hto_end": 15}
+R2_LENGTH = {"hto": 50, "gex": 90}
+# Reads generated and written at a time
+BATCH_SIZE = 100000
+
+
+def random_bases(rng, n, length):
+    return BASES[rng.integers(0, 4, size=(n, length))]
+
+
+def mutate(rng, seqs, error_rate):
+    """
+    Substitute every base of a sequence matrix by another base with
+    probability `error_rate`.
+    """
+    if error_rate:
+        errors = rng.random(seqs.shape) < error_rate
+        shift = rng.integers(1, 4, size=int(errors.sum()))
+        codes = np.searchsorted(BASES, seqs[errors])
+        seqs[errors] = BASES[(codes + shift) % 4]
+    return seqs
+
+
+def format_records(name, first, seqs):
+    """
+    Format a sequence matrix as FASTQ records named `{name}{index}`.
+    """
+    quality = b"F" * seqs.shape[1]
+    return b"".join(b"@%s%d\n%s\n+\n%s\n" % (name, first + i, seq, quality)
+                    for i, seq in enumerate(seqs.view(f"S{seqs.shape[1]}").ravel()))
+
+
+def _write_library(prefix, n_reads, cell_barcodes, cell_hto, hto_matrix, kind,
+                   background_rate, error_rate, rng, compress):
+    suffix = ".fastq.gz" if compress else ".fastq"
+    paths = {R12: f"{prefix}_{R12}{suffix}" for R12 in ("R1", "R2")}
+    open_func = (lambda path: gzip.open(path, "wb", compresslevel=1)) if compress else \
+        (lambda path: open(path, "wb"))
+    with open_func(paths["R1"]) as f1, open_func(paths["R2"]) as f2:
+        for first in range(0, n_reads, BATCH_SIZE):
+            n = min(BATCH_SIZE, n_reads - first)
+            # Cells are sampled with skewed abundances, like real libraries
+            cells = (rng.geometric(4.0 / len(cell_barcodes), size=n) - 1) % len(cell_barcodes)
+            barcodes = cell_barcodes[cells]
+            background = rng.random(n) < background_rate
+            barcodes[background] = random_bases(rng, int(background.sum()), 16)
+            r1 = np.hstack([mutate(rng, barcodes, error_rate), random_bases(rng, n, 12)])
+            r2 = random_bases(rng, n, R2_LENGTH[kind])
+            if kind == "hto":
+                hto = hto_matrix[cell_hto[cells]]
+                hto[background] = hto_matrix[rng.integers(0, len(hto_matrix),
+                                                          size=int(background.sum()))]
+                r2[:, :hto.shape[1]] = mutate(rng, hto, error_rate)
+            f1.write(format_records(b"read", first, r1))
+            f2.write(format_records(b"read", first, r2))
+    return paths
+
+
+def generate_dataset(directory, n_reads, n_cells=1000, n_samples=3, error_rate=0.01,
+                     compress=True, gex_reads=None, background_rate=0.2, seed=0):
+    """
+    Write an HTO and a GEX library of paired FASTQs into `directory` together
+    with a matching `config.yaml`, and return the path of the config.
+    """
+    if not 1 <= n_samples <= len(HTO_SEQUENCES):
+        raise ValueError(f"n_samples must be between 1 and {len(HTO_SEQUENCES)}")
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    cell_barcodes = random_bases(rng, n_cells, 16)
+    cell_hto = np.arange(n_cells) % n_samples
+    hto_matrix = np.frombuffer("".join(HTO_SEQUENCES[:n_samples]).encode(),
+                               dtype=np.uint8).reshape(n_samples, -1)
+    hto_paths = _write_library(os.path.join(directory, "hto"), n_reads, cell_barcodes,
+                               cell_hto, hto_matrix, "hto", background_rate, error_rate,
+                               rng, compress)
+    gex_paths = _write_library(os.path.join(directory, "gex"), gex_reads or n_reads,
+                               cell_barcodes, cell_hto, hto_matrix, "gex", background_rate,
+                               error_rate, rng, compress)
+    samples = [f"sample{i + 1}" for i in range(n_samples)]
+    config = {
+        "libraries_with_HTOs": [{"htolib_name": "pool1", "R12": R12, "path": path}
+                                for R12, path in hto_paths.items()],
+        "positions": POSITIONS,
+        "libraries_to_be_demultiplexed": [{"htolib_name": "pool1", "R12": R12, "path": path}
+                                          for R12, path in gex_paths.items()],
+        "HTO_sequences": [{"htolib_name": "pool1", "sample_name": sample,
+                           "hto_sequence": HTO_SEQUENCES[i]}
+                          for i, sample in enumerate(samples)],
+        "expected_cell_number": [{"htolib_name": "pool1", "sample_name": sample,
+                                  "estimate_number": int(np.count_nonzero(cell_hto == i))}
+                                 for i, sample in enumerate(samples)],
+    }
+    config_path = os.path.join(directory, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return config_path
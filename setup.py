@@ -1,5 +1,21 @@
-from setuptools import setup, find_packages
-from Cython.Build import cythonize
+from setuptools import setup, find_packages, Extension
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    # The GEX split falls back to NumPy without the compiled kernel
+    cythonize = None
+
+extensions = []
+if cythonize:
+    extensions = cythonize([Extension("src.fastq_chunk_processor",
+                                      ["src/fastq_chunk_processor.pyx"]),
+                            Extension("src.zran", ["src/zran.pyx"], libraries=["z"])],
+                           compiler_directives={'language_level' : "3"})
+    # A failed build, e.g. without the zlib headers, only leaves out the
+    # kernel or the gzip index
+    for extension in extensions:
+        extension.optional = True
 
 setup(
     name="schto",
@@ -8,15 +24,16 @@ setup(
     install_requires=[
         "PyYAML",
         "pytest",
-        "modin[all]",
         "numpy",
-        "ray"
+        "pandas"
     ],
+    extras_require={
+        "modin": ["modin[ray]"]
+    },
     entry_points={
         "console_scripts": [
             "schto=src.main:main"
         ]
     },
-    ext_modules = cythonize("src/fastq_chunk_processor.pyx",
-                            compiler_directives={'language_level' : "3"})
+    ext_modules=extensions
 )
\ No newline at end of file
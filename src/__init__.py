@@ -0,0 +1,3 @@
+from src.pipeline import Pipeline, LibraryResult
+
+__all__ = ["Pipeline", "LibraryResult"]
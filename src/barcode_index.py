@@ -0,0 +1,110 @@
+import numpy as np
+from src.encoding import invalid_code, packed_dtype
+
+
+# Labels of barcodes that do not belong to a single sample.
+UNASSIGNED = -1
+AMBIGUOUS = -2
+
+# Halves of up to this many bases get a dense table of bucket offsets
+# (4**12 entries) instead of a binary search.
+MAX_DENSE_HALF = 12
+
+
+class BarcodeIndex:
+    """
+    Whitelist of packed cell barcodes with their sample labels, answering
+    exact and 1-mismatch lookups for whole arrays of barcodes at once.
+
+    Exact matches are found with `searchsorted` in the sorted barcodes. For
+    1-mismatch lookups the index follows the pigeonhole principle: a barcode
+    one mismatch away from a whitelisted one shares either its left or its
+    right half exactly, so only whitelisted barcodes sharing a half are
+    compared. Exact matches take precedence; a barcode one mismatch away from
+    barcodes of different samples is AMBIGUOUS.
+    """
+
+    def __init__(self, barcodes, labels, length):
+        self.length = length
+        self.dtype = packed_dtype(length)
+        barcodes = np.asarray(barcodes, dtype=self.dtype)
+        labels = np.asarray(labels, dtype=np.int16)
+        # Like building a dict, the last label of a repeated barcode wins.
+        reverse_unique = np.unique(barcodes[::-1], return_index=True)[1]
+        keep = len(barcodes) - 1 - reverse_unique
+        keep = keep[barcodes[keep] != invalid_code(length)]
+        self.barcodes = barcodes[keep]
+        self.labels = labels[keep]
+        self.right_bits = self.dtype.type(2 * (length - length // 2))
+        self.halves = [self._half_index(half, half_length) for half, half_length in
+                       zip(self._halves(self.barcodes), (length // 2, length - length // 2))]
+
+    def _halves(self, barcodes):
+        right_mask = self.dtype.type((1 << int(self.right_bits)) - 1)
+        return barcodes >> self.right_bits, barcodes & right_mask
+
+    @staticmethod
+    def _half_index(half, half_length):
+        """
+        Group the whitelist by one half. Returns the sorted half values, the
+        whitelist positions in that order and, for short halves, the offset
+        of every possible half value in the sorted order.
+        """
+        order = np.argsort(half, kind='stable')
+        offsets = None
+        if half_length <= MAX_DENSE_HALF:
+            offsets = np.zeros(4 ** half_length + 1, dtype=np.int64)
+            np.cumsum(np.bincount(half.astype(np.int64), minlength=4 ** half_length),
+                      out=offsets[1:])
+        return half[order], order, offsets
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def lookup(self, barcodes, max_mismatch=1):
+        """
+        Return the sample label of every packed barcode, UNASSIGNED when it
+        matches no whitelisted barcode, or AMBIGUOUS.
+        """
+        barcodes = np.asarray(barcodes, dtype=self.dtype)
+        result = np.full(len(barcodes), UNASSIGNED, dtype=np.int16)
+        if len(self.barcodes) == 0 or len(barcodes) == 0:
+            return result
+        idx = np.searchsorted(self.barcodes, barcodes)
+        idx[idx == len(self.barcodes)] = 0
+        exact = self.barcodes[idx] == barcodes
+        result[exact] = self.labels[idx[exact]]
+        if max_mismatch:
+            misses = np.flatnonzero(~exact & (barcodes != invalid_code(self.length)))
+            result[misses] = self._lookup_neighbors(barcodes[misses])
+        return result
+
+    def _lookup_neighbors(self, barcodes):
+        queries, candidates = [], []
+        for query_half, (half, members, offsets) in zip(self._halves(barcodes), self.halves):
+            if offsets is not None:
+                lo = offsets[query_half.astype(np.int64)]
+                hi = offsets[query_half.astype(np.int64) + 1]
+            else:
+                lo = np.searchsorted(half, query_half, side='left')
+                hi = np.searchsorted(half, query_half, side='right')
+            counts = hi - lo
+            query = np.repeat(np.arange(len(barcodes)), counts)
+            ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            queries.append(query)
+            candidates.append(members[np.repeat(lo, counts) + ranks])
+        query = np.concatenate(queries)
+        candidate = np.concatenate(candidates)
+        # A mismatch sets at least one bit of its 2-bit base; fold each base
+        # onto its low bit and keep candidates with exactly one differing base.
+        diff = barcodes[query] ^ self.barcodes[candidate]
+        low_bits = self.dtype.type(int("01" * (8 * self.dtype.itemsize // 2), 2))
+        diff = (diff | (diff >> self.dtype.type(1))) & low_bits
+        hit = (diff != 0) & ((diff & (diff - self.dtype.type(1))) == 0)
+        query, labels = query[hit], self.labels[candidate[hit]]
+        lowest = np.full(len(barcodes), np.iinfo(np.int16).max, dtype=np.int16)
+        highest = np.full(len(barcodes), np.iinfo(np.int16).min, dtype=np.int16)
+        np.minimum.at(lowest, query, labels)
+        np.maximum.at(highest, query, labels)
+        return np.where(lowest == highest, lowest,
+                        np.where(lowest > highest, UNASSIGNED, AMBIGUOUS)).astype(np.int16)
@@ -0,0 +1,129 @@
+import concurrent.futures
+import os
+import struct
+import zlib
+from collections import deque
+
+
+# Largest uncompressed payload of a block; like bgzip, it leaves room for
+# incompressible data so that a compressed block never exceeds 64 KiB.
+BLOCK_SIZE = 0xff00
+# Blocks handed to the thread pool in one task.
+BLOCKS_PER_TASK = 16
+# Empty block marking the end of a BGZF file.
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data, compresslevel=6):
+    """
+    Compress up to BLOCK_SIZE bytes into one BGZF block: a gzip member whose
+    BC extra field stores the size of the block.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                         ord("B"), ord("C"), 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<2I", zlib.crc32(data), len(data))
+
+
+def _compress_blocks(data, compresslevel):
+    return b"".join(compress_block(data[i:i + BLOCK_SIZE], compresslevel)
+                    for i in range(0, len(data), BLOCK_SIZE))
+
+
+class BGZFWriter:
+    """
+    Write a BGZF file, compressing independent blocks on a thread pool.
+
+    The output is a series of gzip members ending with the BGZF EOF block,
+    so it decompresses with gzip/zcat and can be indexed like bgzip output.
+    zlib releases the GIL while compressing, so the blocks of one or several
+    writers sharing `executor` are compressed in parallel; they are written
+    in order by the thread calling write() and close(). A shared executor
+    should come with its number of `threads`, which bounds the blocks in
+    flight.
+    """
+
+    def __init__(self, path, compresslevel=6, threads=1, executor=None):
+        self.compresslevel = compresslevel
+        self.fileobj = open(path, "wb")
+        self.own_executor = executor is None and threads > 1
+        if self.own_executor:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.executor = executor
+        self.max_pending = 2 * max(threads, 1)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer += data
+        task_size = BLOCK_SIZE * BLOCKS_PER_TASK
+        if len(self.buffer) >= task_size:
+            n = len(self.buffer) - len(self.buffer) % task_size
+            self._submit(bytes(self.buffer[:n]))
+            del self.buffer[:n]
+        return len(data)
+
+    def _submit(self, data):
+        if self.executor is None:
+            self.fileobj.write(_compress_blocks(data, self.compresslevel))
+            return
+        self.pending.append(self.executor.submit(_compress_blocks, data, self.compresslevel))
+        while len(self.pending) > self.max_pending or (self.pending and self.pending[0].done()):
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self):
+        if self.fileobj.closed:
+            return
+        try:
+            self.flush()
+            self.fileobj.write(EOF_BLOCK)
+        finally:
+            self.fileobj.close()
+            if self.own_executor:
+                self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(path, compresslevel=6, threads=1, executor=None):
+    """
+    Open an output file for binary writing, as BGZF if `path` ends with .gz.
+    """
+    if path.endswith(".gz"):
+        return BGZFWriter(path, compresslevel=compresslevel, threads=threads,
+                          executor=executor)
+    return open(path, "wb")
+
+
+def concatenate(paths, output, buffer_size=1 << 20):
+    """
+    Concatenate BGZF files into `output` without recompressing them: their
+    blocks are copied as they are and only one EOF block is kept at the end.
+    """
+    with open(output, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                f.seek(max(size - len(EOF_BLOCK), 0))
+                remaining = size - len(EOF_BLOCK) if f.read() == EOF_BLOCK else size
+                f.seek(0)
+                while remaining > 0:
+                    data = f.read(min(buffer_size, remaining))
+                    out.write(data)
+                    remaining -= len(data)
+        out.write(EOF_BLOCK)
@@ -0,0 +1,143 @@
+import os
+import struct
+import numpy as np
+
+
+# Every column file starts with a fixed 64-byte header: the magic bytes, the
+# format version, the numpy dtype string of the values and the number of
+# rows. The values follow as one contiguous little-endian array, so a column
+# maps straight into memory with np.memmap.
+MAGIC = b"SCHTOCOL"
+VERSION = 1
+HEADER_SIZE = 64
+_HEADER = struct.Struct("<8sI8sQ")
+
+
+def column_path(prefix, column):
+    """
+    Path of one column of the store at `prefix`, e.g. `{output}/{libname}_reads`.
+    """
+    return f"{prefix}.{column}.col"
+
+
+def _pack_header(dtype, rows):
+    header = _HEADER.pack(MAGIC, VERSION, dtype.str.encode(), rows)
+    return header.ljust(HEADER_SIZE, b"\0")
+
+
+def read_header(path):
+    """
+    Return the dtype and number of rows of a column file.
+    """
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError(f"{path} is too short to be a column file")
+    magic, version, dtype, rows = _HEADER.unpack_from(header)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a column file")
+    if version != VERSION:
+        raise ValueError(f"{path} has unsupported column format version {version}")
+    dtype = np.dtype(dtype.rstrip(b"\0").decode())
+    if os.path.getsize(path) < HEADER_SIZE + rows * dtype.itemsize:
+        raise ValueError(f"{path} is truncated")
+    return dtype, rows
+
+
+class ColumnWriter:
+    """
+    Append aligned chunks of fixed-width columns to a store of one file per
+    column.
+
+    The row count in the headers is written on `close()`, so an interrupted
+    store reads as empty rather than partially filled.
+    """
+
+    def __init__(self, prefix, dtypes):
+        self.prefix = prefix
+        self.dtypes = {column: np.dtype(dtype).newbyteorder("<")
+                       for column, dtype in dtypes.items()}
+        self.rows = 0
+        self.files = {}
+        for column, dtype in self.dtypes.items():
+            f = open(column_path(prefix, column), "wb")
+            f.write(_pack_header(dtype, 0))
+            self.files[column] = f
+
+    @property
+    def paths(self):
+        return [column_path(self.prefix, column) for column in self.dtypes]
+
+    def append(self, columns):
+        """
+        Write one chunk given as {column: array}, with the same number of rows
+        in every column.
+        """
+        lengths = {len(columns[column]) for column in self.dtypes}
+        if len(lengths) != 1:
+            raise ValueError("Columns of a chunk differ in length")
+        for column, dtype in self.dtypes.items():
+            self.files[column].write(np.ascontiguousarray(columns[column], dtype=dtype).data)
+        self.rows += lengths.pop()
+
+    def close(self, complete=True):
+        """
+        Close the files; with `complete`, record the number of rows written.
+        """
+        for column, f in self.files.items():
+            if not f.closed:
+                if complete:
+                    f.seek(0)
+                    f.write(_pack_header(self.dtypes[column], self.rows))
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+
+def open_column(prefix, column):
+    """
+    Map a column read-only into memory. Slices of the returned array are read
+    from disk (or shared page cache) only when they are used.
+    """
+    path = column_path(prefix, column)
+    dtype, rows = read_header(path)
+    if rows == 0:
+        # Empty files cannot be memory-mapped
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(rows,))
+
+
+def open_columns(prefix, columns):
+    """
+    Map several aligned columns; returns {column: array}.
+    """
+    arrays = {column: open_column(prefix, column) for column in columns}
+    if len({len(array) for array in arrays.values()}) > 1:
+        raise ValueError(f"Columns of {prefix} differ in length")
+    return arrays
+
+
+def concatenate(prefixes, prefix, columns, chunk_size=1 << 20):
+    """
+    Write the rows of the stores at `prefixes`, in order, into a new store at
+    `prefix`. Returns the number of rows.
+    """
+    shards = [open_columns(shard, columns) for shard in prefixes]
+    with ColumnWriter(prefix, {column: shards[0][column].dtype for column in columns}) as writer:
+        for shard in shards:
+            for start in range(0, len(shard[columns[0]]), chunk_size):
+                writer.append({column: shard[column][start:start + chunk_size]
+                               for column in columns})
+    return writer.rows
+
+
+def remove(prefix, columns):
+    """
+    Delete the files of a store.
+    """
+    for column in columns:
+        os.remove(column_path(prefix, column))
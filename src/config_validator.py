@@ -41,9 +41,16 @@ def validate_config(config: dict):
                 if key not in entry:
                     logger.error("Missing key '%s' in %s entry: %s", key, lib_section, entry)
                     raise ConfigValidationError(f"Missing key '{key}' in {lib_section} entry: {entry}")
-            if not os.path.exists(entry["path"]):
-                logger.error("File does not exist: %s", entry["path"])
-                raise ConfigValidationError(f"File does not exist: {entry['path']}")
+            for path in entry_paths(entry):
+                if not os.path.exists(path):
+                    logger.error("File does not exist: %s", path)
+                    raise ConfigValidationError(f"File does not exist: {path}")
+        for lib, lanes in fastq_lanes(config.get(lib_section, [])).items():
+            if "R1" in lanes and "R2" in lanes and len(lanes["R1"]) != len(lanes["R2"]):
+                logger.error("Library %s in %s has %d R1 and %d R2 files", lib, lib_section,
+                             len(lanes["R1"]), len(lanes["R2"]))
+                raise ConfigValidationError(
+                    f"Library {lib} in {lib_section} needs as many R1 as R2 files")
 
     # Validate positions: check that each position entry has the required keys and values.
     position_keys = [
@@ -56,4 +63,25 @@ def validate_config(config: dict):
             logger.error("Missing key '%s' in positions section", key)
             raise ConfigValidationError(f"Missing key '{key}' in positions section")
 
-    logger.info("Configuration file validated successfully.")
\ No newline at end of file
+    logger.info("Configuration file validated successfully.")
+
+def entry_paths(entry):
+    """
+    Return the FASTQ files of a library entry: `path` is one file or a list
+    of files, one per lane.
+    """
+    return [entry["path"]] if isinstance(entry["path"], str) else list(entry["path"])
+
+
+def fastq_lanes(entries):
+    """
+    Group library entries into {htolib_name: {R12: [paths]}} with the lanes
+    in config order. The lanes of a read are listed in one entry or spread
+    over several entries with the same htolib_name and R12; R1 and R2 files
+    are paired by position.
+    """
+    lanes = {}
+    for entry in entries:
+        lanes.setdefault(entry["htolib_name"], {}).setdefault(entry["R12"], []).extend(
+            entry_paths(entry))
+    return lanes
@@ -0,0 +1,143 @@
+import numpy as np
+from src.encoding import invalid_code, packed_dtype
+
+
+def _run_starts(values):
+    """
+    Indices where runs of equal values start in a sorted array. Cheaper than
+    np.unique, which hashes the values before sorting them.
+    """
+    starts = np.ones(len(values), dtype=bool)
+    starts[1:] = values[1:] != values[:-1]
+    return np.flatnonzero(starts)
+
+
+def count_umis(labels, cell_barcodes, umis, cb_length, umi_length):
+    """
+    Count the unique UMIs of every (sample, cell barcode) in one vectorized
+    pass over the packed reads.
+
+    Reads without a sample label (negative) or with a barcode or UMI holding
+    N are left out. Returns the aligned arrays (sample_codes, barcodes,
+    counts), sorted by sample and then barcode.
+    """
+    labels = np.asarray(labels)
+    cell_barcodes = np.asarray(cell_barcodes, dtype=packed_dtype(cb_length))
+    umis = np.asarray(umis, dtype=packed_dtype(umi_length))
+    valid = ((labels >= 0) & (cell_barcodes != invalid_code(cb_length))
+             & (umis != invalid_code(umi_length)))
+    labels, cell_barcodes, umis = labels[valid], cell_barcodes[valid], umis[valid]
+    label_bits = max(int(labels.max()), 1).bit_length() if len(labels) else 1
+    if label_bits + 2 * (cb_length + umi_length) <= 64:
+        # Sample, barcode and UMI fit in one key: a single sort finds the
+        # unique triples, already in (sample, barcode) order
+        umi_bits = np.uint64(2 * umi_length)
+        keys = np.sort((labels.astype(np.uint64) << np.uint64(2 * cb_length) |
+                        cell_barcodes.astype(np.uint64)) << umi_bits | umis.astype(np.uint64))
+        groups = keys[_run_starts(keys)] >> umi_bits
+        starts = _run_starts(groups)
+        counts = np.diff(np.append(starts, len(groups)))
+        groups = groups[starts]
+        sample_codes = (groups >> np.uint64(2 * cb_length)).astype(np.int16)
+        barcodes = (groups & np.uint64((1 << 2 * cb_length) - 1)).astype(cell_barcodes.dtype)
+        return sample_codes, barcodes, counts
+    order = np.lexsort((umis, cell_barcodes, labels))
+    labels, cell_barcodes, umis = labels[order], cell_barcodes[order], umis[order]
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (labels[1:] != labels[:-1]) | (cell_barcodes[1:] != cell_barcodes[:-1])
+    new_umi = new_group.copy()
+    new_umi[1:] |= umis[1:] != umis[:-1]
+    starts = np.flatnonzero(new_group)
+    counts = np.add.reduceat(new_umi.astype(np.int64), starts) if len(starts) else \
+        np.empty(0, dtype=np.int64)
+    return labels[starts].astype(np.int16), cell_barcodes[starts], counts
+
+
+class HTOCountMatrix:
+    """
+    Sparse matrix of unique UMI counts with one row per cell barcode and one
+    column per HTO (sample), in CSR layout.
+
+    Rows are the packed cell barcodes in ascending order; `indptr` delimits
+    the entries of every row in `indices` (sample labels) and `data` (UMI
+    counts). The matrix is saved as an uncompressed .npz file of these
+    arrays.
+    """
+
+    def __init__(self, samples, barcodes, indptr, indices, data, length):
+        self.samples = list(samples)
+        self.barcodes = barcodes
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.length = length
+
+    @classmethod
+    def from_counts(cls, samples, sample_codes, barcodes, counts, length):
+        """
+        Build the matrix from aligned (sample, barcode, count) entries.
+        """
+        barcodes = np.asarray(barcodes, dtype=packed_dtype(length))
+        order = np.lexsort((sample_codes, barcodes))
+        sorted_barcodes = barcodes[order]
+        starts = _run_starts(sorted_barcodes)
+        indptr = np.append(starts, len(order)).astype(np.int64)
+        return cls(samples, sorted_barcodes[starts], indptr,
+                   np.asarray(sample_codes, dtype=np.int16)[order],
+                   np.asarray(counts, dtype=np.uint32)[order], length)
+
+    @property
+    def shape(self):
+        return len(self.barcodes), len(self.samples)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def rows(self):
+        """
+        Row index of every entry.
+        """
+        return np.repeat(np.arange(len(self.barcodes)), np.diff(self.indptr))
+
+    def sample_totals(self):
+        """
+        Unique UMIs of every sample.
+        """
+        return np.bincount(self.indices, weights=self.data,
+                           minlength=len(self.samples)).astype(np.int64)
+
+    def ranked(self):
+        """
+        Return all entries as (sample_codes, barcodes, counts), ordered by
+        count (descending), then sample and barcode.
+        """
+        barcodes = self.barcodes[self.rows()]
+        order = np.lexsort((barcodes, self.indices, -self.data.astype(np.int64)))
+        return self.indices[order], barcodes[order], self.data[order]
+
+    def top_barcodes(self, cell_numbers):
+        """
+        Select the `cell_numbers[sample]` barcodes with the most UMIs of every
+        sample. Returns (sample_codes, barcodes, counts) grouped by sample in
+        sample order, each by count (descending) with ties by barcode.
+        """
+        barcodes = self.barcodes[self.rows()]
+        order = np.lexsort((barcodes, -self.data.astype(np.int64), self.indices))
+        sample_codes = self.indices[order]
+        # Rank of every entry within its sample
+        sample_starts = np.searchsorted(sample_codes, np.arange(len(self.samples)))
+        ranks = np.arange(len(order)) - sample_starts[sample_codes]
+        keep = order[ranks < np.asarray(cell_numbers, dtype=np.int64)[sample_codes]]
+        return self.indices[keep], barcodes[keep], self.data[keep]
+
+    def save(self, path):
+        np.savez(path, samples=np.array(self.samples, dtype=str), barcodes=self.barcodes,
+                 indptr=self.indptr, indices=self.indices, data=self.data,
+                 length=np.array(self.length))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays["samples"].tolist(), arrays["barcodes"], arrays["indptr"],
+                       arrays["indices"], arrays["data"], int(arrays["length"]))
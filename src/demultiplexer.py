@@ -1,98 +1,281 @@
 import logging
-from src.fastq_loader import read_fastq_in_chunks
+from src.fastq_loader import read_paired_chunks, get_field_positions, reads_prefix
+from src.encoding import encode_array, decode_array, invalid_code, packed_dtype
 import numpy as np
-import modin.pandas as pd
 import os
+import tempfile
 import concurrent.futures
-import gzip
-from src.fastq_chunk_processor import process_chunk
+from src.gex_splitter import split_chunks
+from src.gex_prescan import prescan_prefix, prescanned_barcodes
+from src.bgzf import open_output, concatenate
+from src.config_validator import fastq_lanes
+from src.scheduler import run_lanes
+from src.prefetch import PrefetchReader, PREFETCH_BLOCKS
+from src.gzip_index import split_lanes
+from src.barcode_index import BarcodeIndex, UNASSIGNED, AMBIGUOUS
+from src.umi_dedup import UMIDeduplicator
+from src.engine import dataframe_module
+from src.count_matrix import HTOCountMatrix, count_umis
+from src.column_store import open_column, open_columns
 
 logger = logging.getLogger(__name__)
 
 
 def categorize_reads_by_hto(libname, config, thread,
-                            chunk_size, output):
+                            chunk_size, output, hamming_distance=0, reads=None):
     """
     Categorize reads into samples based on HTO sequences.
+
+    Every read gets the index of its sample in `samples` through one lookup
+    in a precomputed HTO table, or UNASSIGNED/AMBIGUOUS. The HTOs are mapped
+    from the column store in `output` unless the extracted `reads` are given
+    as arrays (see `extract_reads`). Returns the tuple (samples, labels).
     """
+    _, hto_start, hto_end = get_field_positions(config["positions"])["hto"]
     hto_seq = {}
     for hto in config["HTO_sequences"]:
         if hto["htolib_name"] == libname:
+            if len(hto["hto_sequence"]) != hto_end - hto_start:
+                # Packed codes of different lengths are not comparable
+                logger.warning("HTO %s of sample %s does not match the HTO length %d in positions",
+                               hto["hto_sequence"], hto["sample_name"], hto_end - hto_start)
             hto_seq[hto["sample_name"]] = hto["hto_sequence"]
-    hto_parquet = os.path.join(output, f"{libname}_hto.parquet")
-    # Load Parquet file into a DataFrame
-    hto_df = pd.read_parquet(hto_parquet)
-    logger.info("Load HTO parquet: %s", hto_parquet)
-    categorized_indices = {sample_name: [] for sample_name in hto_seq.keys()}
-
-    def process_sample(sample_name, hto_sequence):
-        indices = hto_df.index[hto_df['extracted'] == hto_sequence].tolist()
-        return sample_name, indices
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=thread) as executor:
-        futures = {executor.submit(process_sample, sample_name, hto_sequence): sample_name for sample_name, hto_sequence in hto_seq.items()}
-        for future in concurrent.futures.as_completed(futures):
-            sample_name, indices = future.result()
-            categorized_indices[sample_name].extend(indices)
-            logger.info("Sample %s: %d reads categorized", sample_name, len(indices))
-    
-    return categorized_indices
+    samples = list(hto_seq.keys())
+    table_codes, table_labels = build_hto_table(list(hto_seq.values()),
+                                                hto_end - hto_start,
+                                                hamming_distance)
+    # Map the HTO column of the extracted reads and label it chunk by chunk
+    if reads is None:
+        hto_codes = open_column(reads_prefix(output, libname), 'hto')
+        logger.info("Mapped %d HTOs of %s", len(hto_codes), libname)
+    else:
+        hto_codes = reads['hto']
+    labels = np.empty(len(hto_codes), dtype=table_labels.dtype)
+    for start in range(0, len(hto_codes), chunk_size):
+        labels[start:start + chunk_size] = assign_hto_labels(
+            hto_codes[start:start + chunk_size], table_codes, table_labels)
 
+    counts = np.bincount(labels[labels >= 0], minlength=len(samples))
+    for sample_name, count in zip(samples, counts):
+        logger.info("Sample %s: %d reads categorized", sample_name, count)
+    if hamming_distance:
+        logger.info("%d reads have an HTO ambiguous between samples",
+                    np.count_nonzero(labels == AMBIGUOUS))
 
-def deduplicate_umi(categorized_indices, libname, thread, chunk_size, output):
-    bc_parquet = os.path.join(output, f"{libname}_cellbarcodes.parquet")
-    umi_parquet = os.path.join(output, f"{libname}_umi.parquet")
-    bcumi_df = pd.concat([pd.read_parquet(bc_parquet)['extracted'],
-                          pd.read_parquet(umi_parquet)['extracted']], axis=1)
-    bcumi_df.columns = ['cell_barcode', 'umi']
-    logger.info("Loaded cell barcode and UMI parquet files for %s", libname)
-    
-    # Add sample column
-    sample_arr = np.empty(len(bcumi_df), dtype=object)
-    for sample, indices in categorized_indices.items():
-        sample_arr[indices] = sample
-    bcumi_df['sample'] = sample_arr
-    logger.info("Assigned reads to samples for %s", libname)
-    # Drop duplicate rows and keep only the unique ones
-    # Convert columns to categorical
-    bcumi_df['cell_barcode'] = bcumi_df['cell_barcode'].astype('category')
-    bcumi_df['umi'] = bcumi_df['umi'].astype('category')
-    bcumi_df['sample'] = bcumi_df['sample'].astype('category')
-    bcumi_df = bcumi_df.dropna(subset=['sample'])
-    unique_df = bcumi_df.drop_duplicates(subset=['cell_barcode', 'umi', 'sample'])
-    logger.info("Deduplicated UMIs for %s", libname)
-    # Add umi_count for counting the number of unique UMIs per cell barcode per sample
-    unique_df = unique_df.groupby(['sample', 'cell_barcode'], observed=True).size().reset_index(name='umi_count')
-    logger.info("Calculated the frequency of unique UMIs for %s", libname)
-    # Rank rows by umi_count and place the top ones at the top
-    unique_df = unique_df.sort_values(by='umi_count', ascending=False)
-    logger.info("Ranked cell barcodes by UMI counts for %s", libname)
-    
-    # Save the result to a file
-    unique_df.to_csv(os.path.join(output, f"{libname}_umi_counts.csv"),
-                     index=False)
+    return samples, labels
+
+
+def build_hto_table(hto_sequences, length, hamming_distance=0):
+    """
+    Build the lookup table from packed HTO codes to sample labels.
+
+    The label of an HTO is its index in `hto_sequences`. With
+    `hamming_distance=1`, all sequences one mismatch away from an HTO are
+    added as well; exact HTOs take precedence over neighbours, and neighbours
+    (or exact sequences) shared by different samples are labelled AMBIGUOUS.
+    Returns the sorted codes and their labels as two aligned arrays.
+    """
+    label_dtype = np.int8 if len(hto_sequences) < np.iinfo(np.int8).max else np.int16
+    exact = {}
+    for label, sequence in enumerate(hto_sequences):
+        if len(sequence) != length:
+            continue
+        exact[sequence] = label if exact.get(sequence, label) == label else AMBIGUOUS
+    table = dict(exact)
+    if hamming_distance:
+        for sequence, label in exact.items():
+            for neighbor in generate_neighbors(sequence):
+                if neighbor in exact:
+                    continue
+                table[neighbor] = label if table.get(neighbor, label) == label else AMBIGUOUS
+    sequences = list(table.keys())
+    codes = encode_array(sequences, length) if sequences else np.empty(0, dtype=packed_dtype(length))
+    labels = np.array(list(table.values()), dtype=label_dtype)
+    order = np.argsort(codes)
+    return codes[order], labels[order]
+
+
+def assign_hto_labels(hto_codes, table_codes, table_labels):
+    """
+    Look up the sample label of every packed HTO code; codes missing from the
+    table (including invalid ones) are UNASSIGNED.
+    """
+    if len(table_codes) == 0:
+        return np.full(len(hto_codes), UNASSIGNED, dtype=table_labels.dtype)
+    idx = np.searchsorted(table_codes, hto_codes)
+    idx[idx == len(table_codes)] = 0
+    hit = table_codes[idx] == hto_codes
+    return np.where(hit, table_labels[idx], UNASSIGNED).astype(table_labels.dtype)
+
+
+def deduplicate_umi(samples, hto_labels, libname, config, thread, chunk_size, output,
+                    memory_budget=None, reads=None):
+    """
+    Deduplicate UMIs per cell barcode per sample and count the unique UMIs.
+
+    By default the whole library is deduplicated in memory. With a
+    `memory_budget` in bytes, reads are streamed in chunks through a
+    UMIDeduplicator that spills to disk instead; both produce the same counts.
+    The counts are saved as a sparse cell barcode x HTO matrix
+    (`{libname}_hto_matrix.npz`) and ranked by UMI count into
+    `{libname}_umi_counts.csv`. Returns the HTOCountMatrix.
+
+    As in categorize_reads_by_hto, the reads are mapped from `output` unless
+    given as arrays. With `output` None, nothing is saved and streaming
+    spills to the system's temporary directory.
+    """
+    fields = get_field_positions(config["positions"])
+    _, cb_start, cb_end = fields['cell_barcode']
+    if reads is None:
+        reads = open_columns(reads_prefix(output, libname), ('cell_barcode', 'umi'))
+    key_bits = 2 * sum(end - start for column, (_, start, end) in fields.items()
+                       if column in ('cell_barcode', 'umi'))
+    if memory_budget and key_bits > 64:
+        logger.warning("Cell barcode and UMI are too long for streaming deduplication; "
+                       "deduplicating %s in memory", libname)
+        memory_budget = None
+    if memory_budget:
+        counts = _deduplicate_umi_streaming(samples, hto_labels, libname, fields,
+                                            reads, chunk_size, output, memory_budget)
+    else:
+        counts = _deduplicate_umi_in_memory(samples, hto_labels, libname, fields,
+                                            reads)
+    matrix = HTOCountMatrix.from_counts(samples, *counts, cb_end - cb_start)
+    if output is None:
+        return matrix
+    matrix.save(os.path.join(output, f"{libname}_hto_matrix.npz"))
+    logger.info("Saved a matrix of %d cell barcodes x %d HTOs with %d entries for %s",
+                *matrix.shape, matrix.nnz, libname)
+
+    # Rank rows by umi_count and place the top ones at the top; ties are
+    # ordered by sample and cell barcode so reruns are reproducible
+    unique_df = cellbarcode_table(samples, *matrix.ranked())
+    decode_cellbarcodes(unique_df, config).to_csv(
+        os.path.join(output, f"{libname}_umi_counts.csv"), index=False)
     logger.info("Saved processed %d cell barcodes and UMIs for %s",
                 unique_df.shape[0], libname)
-    return unique_df
+    return matrix
+
+
+def _deduplicate_umi_in_memory(samples, hto_labels, libname, fields, reads):
+    _, cb_start, cb_end = fields['cell_barcode']
+    _, umi_start, umi_end = fields['umi']
+    # Reads without a sample and barcodes or UMIs containing N (which share
+    # one invalid code and cannot be told apart) are left out
+    counts = count_umis(hto_labels, reads['cell_barcode'], reads['umi'],
+                        cb_end - cb_start, umi_end - umi_start)
+    logger.info("Calculated the frequency of unique UMIs for %s", libname)
+    return counts
+
 
-def filter_cellbarcodes(unique_df, config, libname, output):
+def _deduplicate_umi_streaming(samples, hto_labels, libname, fields, reads,
+                               chunk_size, output, memory_budget):
+    _, cb_start, cb_end = fields['cell_barcode']
+    _, umi_start, umi_end = fields['umi']
+    cb_invalid = invalid_code(cb_end - cb_start)
+    umi_invalid = invalid_code(umi_end - umi_start)
+    cb_dtype = packed_dtype(cb_end - cb_start)
+    with tempfile.TemporaryDirectory(prefix=f"{libname}_dedup_", dir=output) as tmpdir:
+        deduplicator = UMIDeduplicator(len(samples), cb_end - cb_start, umi_end - umi_start,
+                                       memory_budget, tmpdir)
+        for start in range(0, len(reads['umi']), chunk_size):
+            cell_barcodes = reads['cell_barcode'][start:start + chunk_size]
+            umis = reads['umi'][start:start + chunk_size]
+            labels = hto_labels[start:start + chunk_size].copy()
+            # Reads with a barcode or UMI containing N are left out
+            labels[(cell_barcodes == cb_invalid) | (umis == umi_invalid)] = UNASSIGNED
+            deduplicator.add(labels, cell_barcodes, umis)
+        logger.info("Deduplicated UMIs for %s with %d spills to disk",
+                    libname, deduplicator.n_spills)
+        sample_codes = [np.empty(0, dtype=np.int16)]
+        cell_barcodes = [np.empty(0, dtype=cb_dtype)]
+        umi_counts = [np.empty(0, dtype=np.int64)]
+        for sample, barcodes, counts in deduplicator.counts():
+            sample_codes.append(np.full(len(barcodes), sample, dtype=np.int16))
+            cell_barcodes.append(barcodes.astype(cb_dtype))
+            umi_counts.append(counts)
+    logger.info("Calculated the frequency of unique UMIs for %s", libname)
+    return np.concatenate(sample_codes), np.concatenate(cell_barcodes), np.concatenate(umi_counts)
+
+def filter_cellbarcodes(matrix, config, libname, output):
+    """
+    Select the expected number of cells of every sample: the cell barcodes
+    with the most UMIs in that sample's column of the count matrix. The
+    selection is saved to `output` unless it is None.
+    """
     cell_numbers = {d["sample_name"]: d["estimate_number"]
                     for d in config["expected_cell_number"]
                     if d["htolib_name"]==libname}
-    filtered_df = unique_df.groupby('sample', group_keys=False).apply(
-        lambda x: x.nlargest(cell_numbers[x.name], 'umi_count')
-    )
-    filtered_df.to_csv(os.path.join(output,
+    # Samples without any UMIs need no expected cell number
+    totals = matrix.sample_totals()
+    top = matrix.top_barcodes([cell_numbers[sample] if total else 0
+                               for sample, total in zip(matrix.samples, totals)])
+    filtered_df = cellbarcode_table(matrix.samples, *top)
+    if output is None:
+        return filtered_df
+    decode_cellbarcodes(filtered_df, config).to_csv(os.path.join(output,
         f"{libname}_filtered_cellbarcodes.csv"), index=False)
     logger.info("Saved filtered %d cell barcodes and UMIs for %s",
                 filtered_df.shape[0], libname)
     return filtered_df
 
-def split_GEX_fastqs(libname, config, filtered_df, output, chunk_size, statistics):
-    # Get dictionary for barcode to sample
-    barcode_to_sample = dict(zip(filtered_df['cell_barcode'],
-                                 filtered_df['sample']))
-    neighbor_dict = build_neighbor_dict(barcode_to_sample)
+def cellbarcode_table(samples, sample_codes, barcodes, counts):
+    """
+    Build a dataframe of sample, packed cell barcode and UMI count.
+    """
+    pd = dataframe_module()
+    return pd.DataFrame({
+        'sample': pd.Categorical.from_codes(np.asarray(sample_codes), categories=samples),
+        'cell_barcode': barcodes,
+        'umi_count': np.asarray(counts, dtype=np.int64),
+    })
+
+def decode_cellbarcodes(df, config):
+    """
+    Return a copy of df with its packed cell barcodes decoded into sequences
+    for writing output.
+    """
+    _, cb_start, cb_end = get_field_positions(config["positions"])["cell_barcode"]
+    df = df.copy()
+    df['cell_barcode'] = decode_array(df['cell_barcode'].to_numpy(), cb_end - cb_start)
+    return df
+
+def load_cellbarcodes(path, samples, config):
+    """
+    Read a cell barcode table written by deduplicate_umi or filter_cellbarcodes
+    back with packed cell barcodes, in its original row order.
+    """
+    _, cb_start, cb_end = get_field_positions(config["positions"])["cell_barcode"]
+    pd = dataframe_module()
+    df = pd.read_csv(path, dtype={'sample': str, 'cell_barcode': str})
+    return cellbarcode_table(samples,
+                             pd.Categorical(df['sample'].to_numpy(), categories=samples).codes,
+                             encode_array(df['cell_barcode'].to_list(), cb_end - cb_start),
+                             df['umi_count'].to_numpy())
+
+def split_GEX_fastqs(libname, config, filtered_df, output, chunk_size, statistics, thread=1,
+                     compresslevel=6, prefetch_blocks=PREFETCH_BLOCKS, prescanned=False,
+                     gzip_index=False):
+    """
+    Split the read pairs of the GEX library into samples by their cell barcodes.
+
+    Paired chunks are routed on `thread - 1` workers while the calling
+    thread reads the input and writes each sample's output in input order.
+    The outputs are BGZF files whose blocks are compressed on a pool of
+    `thread` threads shared by all samples.
+
+    A library given as several lanes is split lane by lane on up to `thread`
+    threads, each into BGZF shards of its own, which are then concatenated
+    in lane order without recompressing them. Every input file is
+    decompressed up to `prefetch_blocks` blocks ahead.
+
+    With `prescanned`, the cell barcodes stored by `prescan_gex` in `output`
+    are looked up by the workers instead of reading them from the records.
+    Both mates are still decompressed and parsed to copy their records.
+
+    With `gzip_index`, gzipped lanes are also split into ranges of records on
+    up to `thread` threads like lanes (see `src.gzip_index`).
+    """
     # Get cell barcode positions in GEX
     positions = config["positions"]
     cb_start = int(positions['cell_barcode_start']) - 1
@@ -101,50 +284,71 @@ def split_GEX_fastqs(libname, config, filtered_df, output, chunk_size, statistic
     
     samples = [hto["sample_name"] for hto in config["HTO_sequences"]
                if hto["htolib_name"] == libname]
-    # Get GEX FASTQ paths
-    gex_fastqs = {d["R12"]: d["path"]
-                  for d in config["libraries_to_be_demultiplexed"]
-                  if d["htolib_name"] == libname}
-    
-    # Choose the appropriate file open function (gzip or plain text)
-    open_func = gzip.open if gex_fastqs["R1"].endswith('.gz') else open
-
-    # Pre-open output files for each sample.
-    out_files_R1 = {}
-    out_files_R2 = {}
-    for sample in samples:
-        out_path_R1 = os.path.join(output, f"{libname}_{sample}_R1.fastq.gz")
-        out_path_R2 = os.path.join(output, f"{libname}_{sample}_R2.fastq.gz")
-        out_files_R1[sample] = gzip.open(out_path_R1, 'wt')
-        out_files_R2[sample] = gzip.open(out_path_R2, 'wt')
-    # Initialize counters for statistics.
-    total_read_pairs = 0
-    sample_counts = {sample: 0 for sample in out_files_R1.keys()}
-    # Process FASTQ files in lockstep, chunk by chunk.
-    with open_func(gex_fastqs["R1"], 'rt') as f1, open_func(gex_fastqs["R2"], 'rt') as f2:
-        for chunk1, chunk2 in zip(read_fastq_in_chunks(f1, chunk_size*10),
-                                  read_fastq_in_chunks(f2, chunk_size*10)):
-            logger.info("Processing a chunk of %d records for %s", len(chunk1), libname)
-            local_total, local_counts = process_chunk(chunk1, chunk2,
-                                                    barcode_to_sample,
-                                                    neighbor_dict,
-                                                    cb_start, cb_end, cb_R12,
-                                                    out_files_R1, out_files_R2)
-            total_read_pairs += local_total
-            for sample, count in local_counts.items():
-                sample_counts[sample] = sample_counts.get(sample, 0) + count
-
-    # Close all output files.
-    for fh in out_files_R1.values():
-        fh.close()
-    for fh in out_files_R2.values():
-        fh.close()
-        
-    statistics["GEX R1"] = gex_fastqs["R1"]
-    statistics["GEX R2"] = gex_fastqs["R2"]
+    # Get the whitelist index from packed barcode to sample
+    sample_labels = {sample: label for label, sample in enumerate(samples)}
+    barcode_index = BarcodeIndex(filtered_df['cell_barcode'].to_numpy(),
+                                 [sample_labels[sample] for sample in filtered_df['sample']],
+                                 cb_end - cb_start)
+    # Get GEX FASTQ paths, one per lane
+    gex_fastqs = fastq_lanes(config["libraries_to_be_demultiplexed"])[libname]
+    lanes = list(zip(gex_fastqs["R1"], gex_fastqs["R2"]))
+    if gzip_index and thread > len(lanes):
+        # Split gzipped lanes into ranges of records, which are split like lanes
+        parts = [(number, part) for number, lane in enumerate(lanes, 1)
+                 for part in split_lanes([lane], -(-thread // len(lanes)), thread)]
+    else:
+        parts = list(enumerate(lanes, 1))
+    lane_threads = min(len(parts), thread)
+    routing = (samples, barcode_index, cb_start, cb_end, cb_R12)
+    outputs = {(sample, R12): os.path.join(output, f"{libname}_{sample}_{R12}")
+               for sample in samples for R12 in ("R1", "R2")}
+
+    def split_lane(item):
+        shard, (number, (fastq_R1, fastq_R2)) = item
+        suffix = f".lane{shard}" if len(parts) > 1 else ""
+        # Pre-open output files for each sample.
+        out_files = {key: open_output(f"{path}{suffix}.fastq.gz", compresslevel, thread,
+                                      compressor)
+                     for key, path in outputs.items()}
+        # Process FASTQ files in lockstep, chunk by chunk, while both are
+        # decompressed ahead on background threads.
+        try:
+            with PrefetchReader(fastq_R1, depth=prefetch_blocks) as f1, \
+                    PrefetchReader(fastq_R2, depth=prefetch_blocks) as f2:
+                chunk_pairs = read_paired_chunks(f1, f2, chunk_size, libname)
+                if prescanned:
+                    chunk_pairs = prescanned_barcodes(
+                        chunk_pairs, prescan_prefix(output, libname, number), cb_R12,
+                        getattr(fastq_R1, "first", 0), getattr(fastq_R1, "last", None))
+                return split_chunks(chunk_pairs, routing,
+                                    {sample: out_files[sample, "R1"] for sample in samples},
+                                    {sample: out_files[sample, "R2"] for sample in samples},
+                                    workers=thread // lane_threads - 1)
+        finally:
+            # Close all output files.
+            for fh in out_files.values():
+                fh.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread) as compressor:
+        results = run_lanes(list(enumerate(parts, 1)), split_lane, lane_threads)
+    if len(parts) > 1:
+        for path in outputs.values():
+            shards = [f"{path}.lane{shard}.fastq.gz" for shard in range(1, len(parts) + 1)]
+            concatenate(shards, f"{path}.fastq.gz")
+            for shard in shards:
+                os.remove(shard)
+    total_read_pairs = sum(total for total, _ in results)
+    sample_counts = {}
+    for _, counts in results:
+        for sample, count in counts.items():
+            sample_counts[sample] = sample_counts.get(sample, 0) + count
+    logger.info("Processed %d read pairs for %s", total_read_pairs, libname)
+
+    statistics["GEX R1"] = ";".join(gex_fastqs["R1"])
+    statistics["GEX R2"] = ";".join(gex_fastqs["R2"])
     statistics["GEX total read pairs"] = total_read_pairs
     for sample in set(samples):
-        statistics[f"GEX filtered read pairs of {sample}"] = sample_counts[sample]
+        statistics[f"GEX filtered read pairs of {sample}"] = sample_counts.get(sample, 0)
         
     return statistics
 
@@ -159,16 +363,3 @@ def generate_neighbors(barcode, alphabet="ACGT"):
                 neighbors.add("".join(barcode))
         barcode[i] = original  # restore original
     return neighbors
-
-def build_neighbor_dict(barcode_to_sample, alphabet="ACGT"):
-    neighbor_dict = {}
-    for barcode, sample in barcode_to_sample.items():
-        for neighbor in generate_neighbors(barcode, alphabet):
-            # Only add if this neighbor isn't already in the exact dictionary,
-            # or mark as ambiguous if needed.
-            if neighbor not in barcode_to_sample:
-                if neighbor in neighbor_dict and neighbor_dict[neighbor] != sample:
-                    neighbor_dict[neighbor] = None  # mark ambiguous
-                else:
-                    neighbor_dict[neighbor] = sample
-    return neighbor_dict
\ No newline at end of file
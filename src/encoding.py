@@ -0,0 +1,100 @@
+import numpy as np
+
+
+# 2-bit code of every byte value: A=0, C=1, G=2, T=3. Any other byte (N,
+# IUPAC codes or the zero padding of reads shorter than a field) is invalid.
+INVALID_BASE = 255
+BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+for _code, _bases in enumerate((b"Aa", b"Cc", b"Gg", b"Tt")):
+    for _base in _bases:
+        BASE_CODES[_base] = _code
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+# Longest sequence that still leaves the invalid code free in a uint64.
+MAX_LENGTH = 31
+
+
+def packed_dtype(length):
+    """
+    Return the smallest unsigned integer dtype holding a sequence of the
+    given length at 2 bits per base, plus the invalid code.
+    """
+    if length < 1 or length > MAX_LENGTH:
+        raise ValueError(f"Cannot pack sequences of length {length}; "
+                         f"supported lengths are 1 to {MAX_LENGTH}")
+    return np.dtype(np.uint32) if length <= 15 else np.dtype(np.uint64)
+
+
+def invalid_code(length):
+    """
+    Return the code of sequences containing N or any other non-ACGT base.
+
+    It is the maximum of the packed dtype, which is never reached by a valid
+    sequence, so invalid reads neither match a barcode nor each other by value.
+    """
+    return packed_dtype(length).type(np.iinfo(packed_dtype(length)).max)
+
+
+def encode_seq(seq):
+    """
+    Encode a single sequence into its packed integer.
+    """
+    return encode_array([seq], len(seq))[0]
+
+
+def decode_seq(code, length):
+    """
+    Decode a single packed integer back into a sequence.
+    """
+    return decode_array(np.asarray([code], dtype=packed_dtype(length)), length)[0]
+
+
+def encode_array(seqs, length=None):
+    """
+    Encode sequences into a packed integer array.
+
+    `seqs` is either a 2D uint8 array with one sequence per row (e.g. a slice
+    of a read matrix) or an iterable of str/bytes sequences of `length` bases.
+    Shorter sequences are zero-padded and, like sequences containing N, end up
+    as the invalid code.
+    """
+    matrix = np.asarray(seqs)
+    if matrix.dtype != np.uint8 or matrix.ndim != 2:
+        matrix = sequence_matrix(seqs, length)
+    length = matrix.shape[1]
+    dtype = packed_dtype(length)
+    codes = BASE_CODES[matrix]
+    packed = np.zeros(matrix.shape[0], dtype=dtype)
+    for i in range(length):
+        packed <<= dtype.type(2)
+        packed |= codes[:, i].astype(dtype)
+    # Invalid bases set all their bits; mask the whole sequence instead.
+    packed[(codes == INVALID_BASE).any(axis=1)] = invalid_code(length)
+    return packed
+
+
+def decode_array(packed, length):
+    """
+    Decode a packed integer array into an array of str. Invalid codes are
+    decoded as a run of N.
+    """
+    packed = np.asarray(packed, dtype=packed_dtype(length))
+    matrix = np.empty((packed.shape[0], length), dtype=np.uint8)
+    for i in range(length):
+        shift = packed.dtype.type(2 * (length - 1 - i))
+        matrix[:, i] = BASES[(packed >> shift) & packed.dtype.type(3)]
+    matrix[packed == invalid_code(length)] = ord("N")
+    return matrix.view(f"S{length}").ravel().astype(str)
+
+
+def sequence_matrix(seqs, width=None):
+    """
+    Convert an iterable of str/bytes sequences into a 2D uint8 array with one
+    zero-padded row per sequence, `width` columns wide (or as wide as the
+    longest sequence).
+    """
+    arr = np.asarray(seqs, dtype=f"S{width}" if width else "S")
+    width = width or max(arr.dtype.itemsize, 1)
+    if arr.dtype.itemsize < width:
+        arr = arr.astype(f"S{width}")
+    return arr.reshape(-1).view(np.uint8).reshape(-1, arr.dtype.itemsize)
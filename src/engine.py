@@ -0,0 +1,37 @@
+import importlib
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Dataframe libraries the pipeline can run on: pandas runs in-process, modin
+# distributes dataframes over Ray (or another modin engine).
+ENGINES = {"pandas": "pandas", "modin": "modin.pandas"}
+
+_engine = "pandas"
+
+
+def set_engine(name, cpus=None):
+    """
+    Select the dataframe engine. Nothing is imported until the first
+    dataframe is needed; for modin, `cpus` bounds its workers.
+    """
+    global _engine
+    if name not in ENGINES:
+        raise ValueError(f"Unknown dataframe engine {name!r}; choose from {', '.join(ENGINES)}")
+    if name == "modin" and cpus:
+        os.environ["MODIN_CPUS"] = str(cpus)
+    _engine = name
+    logger.debug("Using the %s dataframe engine", name)
+
+
+def get_engine():
+    return _engine
+
+
+def dataframe_module():
+    """
+    Import and return the pandas-compatible module of the selected engine.
+    """
+    return importlib.import_module(ENGINES[_engine])
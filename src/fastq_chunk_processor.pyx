@@ -1,93 +1,136 @@
 # fastq_chunk_processor.pyx
 # cython: boundscheck=False, wraparound=False, nonecheck=False, language_level=3
+"""
+Compiled kernel of the GEX split.
 
-def process_chunk(list chunk1, list chunk2,
-                  dict barcode_to_sample,
-                  dict neighbor_dict,
-                  int cb_start, int cb_end, str cb_R12,
-                  dict out_files_R1, dict out_files_R2):
-    """
-    Process a chunk of FASTQ records, writing paired records to sample files,
-    and accumulate counts for statistics.
+Both functions work on the raw buffer and line ends of a FastqChunk and run
+without the GIL, so several threads can route chunks in parallel. They give
+the same results as the NumPy implementation in `src.gex_splitter`, which
+is used when this extension is not built.
+"""
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_FromStringAndSize
+from libc.stdint cimport int16_t, int64_t, uint8_t, uint64_t
+from libc.string cimport memcpy
+import numpy as np
 
-    Parameters:
-      chunk1: List of tuples (header, seq, plus, qual) from R1.
-      chunk2: List of tuples (header, seq, plus, qual) from R2.
-      barcode_to_sample: Dictionary mapping cell barcode to sample.
-      cb_start: Start index for barcode extraction (0-indexed).
-      cb_end: End index for barcode extraction.
-      cb_R12: R1 or R2 where barcode locates.
-      out_files_R1: Dictionary mapping sample to output file object for R1.
-      out_files_R2: Dictionary mapping sample to output file object for R2.
-    
-    Returns:
-      A tuple (local_total, chunk_sample_counts) where:
-        local_total is the number of paired records processed.
-        chunk_sample_counts is a dict mapping sample to the number of records written.
-    """
-    cdef int i, n = len(chunk1)
-    cdef tuple rec1, rec2
-    cdef str header1, seq1, plus1, qual1
-    cdef str header2, seq2, plus2, qual2
-    cdef str cell_barcode, sample
-    cdef int local_total = 0
+# Keep in sync with src.barcode_index
+cdef int16_t UNASSIGNED = -1
+cdef int16_t AMBIGUOUS = -2
+cdef uint8_t INVALID_BASE = 255
 
-    # Initialize a Python dictionary for sample counts
-    chunk_sample_counts = {}
-    
-    for i in range(n):
-        local_total += 1
-        rec1 = chunk1[i]
-        rec2 = chunk2[i]
-        # Unpack R1
-        header1 = rec1[0]
-        seq1    = rec1[1]
-        plus1   = rec1[2]
-        qual1   = rec1[3]
-        # Unpack R2
-        header2 = rec2[0]
-        seq2    = rec2[1]
-        plus2   = rec2[2]
-        qual2   = rec2[3]
+cdef uint8_t[256] BASE_CODES
+for _byte in range(256):
+    BASE_CODES[_byte] = INVALID_BASE
+for _code, _bases in enumerate((b"Aa", b"Cc", b"Gg", b"Tt")):
+    for _byte in _bases:
+        BASE_CODES[_byte] = _code
 
-        # Extract the cell barcode from the R1 sequence
-        if cb_R12 == "R1":
-            cell_barcode = seq1[cb_start:cb_end]
+
+cdef inline Py_ssize_t find(const uint64_t[::1] whitelist, uint64_t key) noexcept nogil:
+    cdef Py_ssize_t lo = 0, hi = whitelist.shape[0], mid
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if whitelist[mid] < key:
+            lo = mid + 1
         else:
-            cell_barcode = seq2[cb_start:cb_end]
-        sample = get_sample_for_barcode_fast(cell_barcode,
-                                             barcode_to_sample,
-                                             neighbor_dict)
-        if sample is not None:
-            # Update the count for this sample
-            if sample in chunk_sample_counts:
-                chunk_sample_counts[sample] = chunk_sample_counts[sample] + 1
-            else:
-                chunk_sample_counts[sample] = 1
-            # Write the paired records to the respective sample files.
-            out_files_R1[sample].write(header1 + "\n" + seq1 + "\n" + plus1 + "\n" + qual1 + "\n")
-            out_files_R2[sample].write(header2 + "\n" + seq2 + "\n" + plus2 + "\n" + qual2 + "\n")
+            hi = mid
+    if lo < whitelist.shape[0] and whitelist[lo] == key:
+        return lo
+    return -1
+
+
+def route_labels(const uint8_t[::1] data, const int64_t[:, ::1] line_ends,
+                 int cb_start, int cb_end, const uint64_t[::1] whitelist,
+                 const int16_t[::1] labels, int max_mismatch=1):
+    """
+    Return the sample label of the cell barcode (bases cb_start to cb_end) of
+    every read, looked up in the sorted packed `whitelist` and its aligned
+    `labels`.
+
+    Exact matches take precedence; otherwise a barcode one mismatch away
+    from whitelisted barcodes of one sample gets that sample, and from
+    several samples AMBIGUOUS. Reads shorter than cb_end, barcodes with a
+    non-ACGT base and barcodes without a match are UNASSIGNED.
+    """
+    cdef Py_ssize_t n = line_ends.shape[0], i, found
+    cdef int length = cb_end - cb_start, p, alt, shift
+    cdef int64_t seq_start
+    cdef uint64_t key, code, neighbor
+    cdef uint8_t base
+    cdef int16_t label, best
+    cdef bint valid
+    result = np.empty(n, dtype=np.int16)
+    cdef int16_t[::1] out = result
+    with nogil:
+        for i in range(n):
+            out[i] = UNASSIGNED
+            seq_start = line_ends[i, 0] + 1
+            if line_ends[i, 1] - seq_start < cb_end:
+                continue
+            key = 0
+            valid = True
+            for p in range(cb_start, cb_end):
+                base = BASE_CODES[data[seq_start + p]]
+                if base == INVALID_BASE:
+                    valid = False
+                    break
+                key = (key << 2) | base
+            if not valid:
+                continue
+            found = find(whitelist, key)
+            if found >= 0:
+                out[i] = labels[found]
+                continue
+            if not max_mismatch:
+                continue
+            best = UNASSIGNED
+            for p in range(length):
+                shift = 2 * (length - 1 - p)
+                code = (key >> shift) & 3
+                for alt in range(4):
+                    if alt == <int>code:
+                        continue
+                    neighbor = key ^ ((code ^ <uint64_t>alt) << shift)
+                    found = find(whitelist, neighbor)
+                    if found < 0:
+                        continue
+                    label = labels[found]
+                    if best == UNASSIGNED:
+                        best = label
+                    elif best != label:
+                        best = AMBIGUOUS
+            out[i] = best
+    return result
 
-    return local_total, chunk_sample_counts
 
-def get_sample_for_barcode_fast(str cell_barcode, dict barcode_to_sample, dict neighbor_dict):
+def gather_records(const uint8_t[::1] data, const int64_t[:, ::1] line_ends,
+                   const int16_t[::1] labels, int n_samples):
     """
-    Return the sample corresponding to cell_barcode using an exact match first,
-    then falling back to the neighbor dictionary.
-    
-    Parameters:
-      cell_barcode: The barcode string.
-      barcode_to_sample: Dictionary mapping barcodes to samples (exact matches).
-      neighbor_dict: Dictionary mapping barcode neighbors (within Hamming distance 1)
-                     to samples.
-    
-    Returns:
-      The sample if found, otherwise None.
+    Return a list with the raw bytes of the records of every sample label,
+    concatenated in input order.
     """
-    cdef object sample = barcode_to_sample.get(cell_barcode)
-    if sample is not None:
-        return sample
-    sample = neighbor_dict.get(cell_barcode)
-    if sample is None:
-        return None
-    return sample
\ No newline at end of file
+    cdef Py_ssize_t n = line_ends.shape[0], i
+    cdef int64_t start, end
+    cdef int16_t label
+    cdef int64_t[::1] sizes = np.zeros(n_samples, dtype=np.int64)
+    cdef int64_t[::1] offsets = np.zeros(n_samples, dtype=np.int64)
+    with nogil:
+        for i in range(n):
+            label = labels[i]
+            if 0 <= label < n_samples:
+                start = line_ends[i - 1, 3] + 1 if i else 0
+                sizes[label] += line_ends[i, 3] + 1 - start
+    records = [PyBytes_FromStringAndSize(NULL, sizes[label]) for label in range(n_samples)]
+    pointers = np.zeros(n_samples, dtype=np.uintp)
+    for label in range(n_samples):
+        pointers[label] = <size_t>PyBytes_AS_STRING(records[label])
+    cdef size_t[::1] addresses = pointers
+    with nogil:
+        for i in range(n):
+            label = labels[i]
+            if 0 <= label < n_samples:
+                start = line_ends[i - 1, 3] + 1 if i else 0
+                end = line_ends[i, 3] + 1
+                memcpy(<char*>addresses[label] + offsets[label], &data[start], end - start)
+                offsets[label] += end - start
+    return records
@@ -1,109 +1,282 @@
 import logging
 import os
-import modin.pandas as pd
-from fastqio import FASTQReader
+from itertools import zip_longest
+import numpy as np
+from src import column_store
+from src.column_store import ColumnWriter
+from src.encoding import encode_array, packed_dtype
+from src.prefetch import PrefetchReader, PREFETCH_BLOCKS
+from src.gzip_index import split_lanes
+from src.scheduler import run_lanes
 
 
 logger = logging.getLogger(__name__)
 
+# Columns extracted from every HTO read pair; they share their names with
+# the `<field>_R12`, `<field>_start` and `<field>_end` keys in positions.
+FIELDS = ("cell_barcode", "umi", "hto")
 
-def load_fastq(libname, fastq_R1, fastq_R2, config, thread, chunk_size, output, statistics):
+
+def get_field_positions(positions):
+    """
+    Convert the positions section of the configuration into
+    {column: (R12, start, end)} with 0-indexed, end-exclusive slices.
+    """
+    return {field: (positions[f"{field}_R12"],
+                    int(positions[f"{field}_start"]) - 1,
+                    int(positions[f"{field}_end"]))
+            for field in FIELDS}
+
+
+def reads_prefix(output, libname):
+    """
+    Prefix of the column store holding the extracted reads of a library.
+    """
+    return os.path.join(output, f"{libname}_reads")
+
+
+def load_fastq(libname, fastq_R1, fastq_R2, config, thread, chunk_size, output, statistics,
+               prefetch_blocks=PREFETCH_BLOCKS, gzip_index=False):
     """
     Load R1 and R2 FASTQ files and extract cell barcodes, UMI and HTOs accordingly.
+
+    Both files are streamed once, side by side, and every configured field is
+    sliced from whichever read it sits on. The fields are packed at 2 bits per
+    base (see `src.encoding`) and appended to a column store of fixed-width
+    files (`{libname}_reads.<field>.col`, see `src.column_store`) with one
+    aligned row per read pair.
+
+    `fastq_R1` and `fastq_R2` are single files or lists of lane files paired
+    by position. Lanes are extracted on up to `thread` threads into stores
+    of their own, which are then concatenated in lane order. Every file is
+    decompressed up to `prefetch_blocks` blocks ahead. With `gzip_index`,
+    gzipped lanes are also split into ranges of records that are extracted
+    in parallel like lanes (see `src.gzip_index`).
     """
-    positions = config["positions"]
-    # Cell barcodes
-    cb_start = int(positions['cell_barcode_start']) - 1
-    cb_end = int(positions['cell_barcode_end'])
-    prefix = os.path.join(output, f"{libname}_cellbarcodes")
-    if positions["cell_barcode_R12"] == "R1":
-        fastq = FASTQReader(fastq_R1, thread=thread, chunk_size=chunk_size)
-    else:
-        fastq = FASTQReader(fastq_R2, thread=thread, chunk_size=chunk_size)
-    fastq.extract(start=cb_start, end=cb_end,
-                  save_parquet=True, parquet_prefix=prefix)
-    # UMI
-    umi_start = int(positions['umi_start']) - 1
-    umi_end = int(positions['umi_end'])
-    prefix = os.path.join(output, f"{libname}_umi")
-    if positions["umi_R12"] == "R1":
-        fastq = FASTQReader(fastq_R1, thread=thread, chunk_size=chunk_size)
-    else:
-        fastq = FASTQReader(fastq_R2, thread=thread, chunk_size=chunk_size)
-    fastq.extract(start=umi_start, end=umi_end,
-                  save_parquet=True, parquet_prefix=prefix)
-    # HTO
-    hto_start = int(positions['hto_start']) - 1
-    hto_end = int(positions['hto_end'])
-    prefix = os.path.join(output, f"{libname}_hto")
-    if positions["hto_R12"] == "R1":
-        fastq = FASTQReader(fastq_R1, thread=thread, chunk_size=chunk_size)
+    fields = get_field_positions(config["positions"])
+    prefix = reads_prefix(output, libname)
+    lanes = _lane_parts(list(zip(_as_list(fastq_R1), _as_list(fastq_R2))), thread, gzip_index)
+    if len(lanes) == 1:
+        total_read_pairs = _extract_lane(prefix, *lanes[0], fields, chunk_size, libname,
+                                         prefetch_blocks)
     else:
-        fastq = FASTQReader(fastq_R2, thread=thread, chunk_size=chunk_size)
-    fastq.extract(start=hto_start, end=hto_end,
-                  save_parquet=True, parquet_prefix=prefix)
-    statistics["Total read pair"] = fastq.count_reads()
-    
+        shards = [f"{prefix}.lane{lane}" for lane in range(1, len(lanes) + 1)]
+        lane_reads = run_lanes(
+            list(zip(shards, lanes)),
+            lambda item: _extract_lane(item[0], *item[1], fields, chunk_size, libname,
+                                       prefetch_blocks),
+            thread)
+        total_read_pairs = column_store.concatenate(shards, prefix, list(fields))
+        for (lane, _), shard, reads in zip(lanes, shards, lane_reads):
+            logger.info("Extracted %d read pairs from %s", reads, lane)
+            column_store.remove(shard, list(fields))
+    logger.info("Saved %d extracted read pairs to %s.*.col", total_read_pairs, prefix)
+    statistics["Total read pair"] = total_read_pairs
+
     return statistics
 
 
-def extract_information(pair, positions, hto_sequences):
+def _as_list(paths):
+    return [paths] if isinstance(paths, str) else list(paths)
+
+
+def _lane_parts(lanes, thread, gzip_index):
+    # Enough ranges per lane to keep `thread` threads busy
+    if not gzip_index or thread <= len(lanes):
+        return lanes
+    return split_lanes(lanes, -(-thread // len(lanes)), thread)
+
+
+def extract_reads(libname, fastq_R1, fastq_R2, config, thread, chunk_size,
+                  prefetch_blocks=PREFETCH_BLOCKS, gzip_index=False):
     """
-    Extracts and encodes hashtag, cell barcode, and UMI from a read pair.
+    Extract the packed fields of the HTO library like `load_fastq`, but keep
+    them in memory instead of writing a column store. Returns
+    {field: array} with one aligned row per read pair.
     """
-    r1, r2 = pair
-    cb_start = int(positions['cell_barcode_start']) - 1
-    cb_end = int(positions['cell_barcode_end'])
-    if positions["cell_barcode_R12"] == "R1":
-        cell_barcode = r1[cb_start:cb_end]
-    else:
-        cell_barcode = r2[cb_start:cb_end]
+    fields = get_field_positions(config["positions"])
+    dtypes = {column: packed_dtype(end - start) for column, (_, start, end) in fields.items()}
 
-    umi_start = int(positions['umi_start']) - 1
-    umi_end = int(positions['umi_end'])
-    if positions["umi_R12"] == "R1":
-        umi = r1[umi_start:umi_end]
-    else:
-        umi = r2[umi_start:umi_end]
+    def extract_lane(lane):
+        chunks = list(_extract_chunks(*lane, fields, chunk_size, libname, prefetch_blocks))
+        return {column: np.concatenate([np.empty(0, dtype=dtype)] +
+                                       [chunk[column] for chunk in chunks])
+                for column, dtype in dtypes.items()}
 
-    hashtag_start = int(positions['hto_start']) - 1
-    hashtag_end = int(positions['hto_end'])
-    if positions["hto_R12"] == "R1":
-        hashtag = r1[hashtag_start:hashtag_end]
-    else:
-        hashtag = r2[hashtag_start:hashtag_end]
-
-    return {
-        'cell_barcode': encode_seq(cell_barcode),
-        'umi': encode_seq(umi),
-        'hashtag': encode_seq(hashtag)
-    }
-
-def save_to_parquet(data, output_dir, chunk_index):
-    """
-    Save extracted information to a Parquet file.
-    """
-    df = pd.DataFrame(data)
-    output_path = os.path.join(output_dir, f"extracted_reads_chunk_{chunk_index}.parquet")
-    df.to_parquet(output_path)
-    logger.info("Saved chunk %d to %s", chunk_index, output_path)
-
-
-def read_fastq_in_chunks(file_handle, chunk_size=10000):
-    """
-    Generator that yields a list of FASTQ records.
-    Each record is a tuple: (header, sequence, plus, quality).
-    """
-    records = []
-    while True:
-        # Read one record (4 lines)
-        record = [file_handle.readline().rstrip() for _ in range(4)]
-        if not record[0]:
-            # End of file; yield any remaining records.
-            if records:
-                yield records
-            break
-        records.append(tuple(record))
-        if len(records) >= chunk_size:
-            yield records
-            records = []
\ No newline at end of file
+    lanes = run_lanes(_lane_parts(list(zip(_as_list(fastq_R1), _as_list(fastq_R2))), thread,
+                                  gzip_index),
+                      extract_lane, thread)
+    reads = {column: np.concatenate([lane[column] for lane in lanes]) for column in fields}
+    logger.info("Extracted %d read pairs of %s", len(reads["hto"]), libname)
+    return reads
+
+
+def _extract_lane(prefix, fastq_R1, fastq_R2, fields, chunk_size, libname, prefetch_blocks):
+    dtypes = {column: packed_dtype(end - start) for column, (_, start, end) in fields.items()}
+    with ColumnWriter(prefix, dtypes) as writer:
+        for columns in _extract_chunks(fastq_R1, fastq_R2, fields, chunk_size, libname,
+                                       prefetch_blocks):
+            writer.append(columns)
+            logger.debug("Extracted %d read pairs from %s", writer.rows, fastq_R1)
+    return writer.rows
+
+
+def _extract_chunks(fastq_R1, fastq_R2, fields, chunk_size, libname, prefetch_blocks):
+    with PrefetchReader(fastq_R1, depth=prefetch_blocks) as f1, \
+            PrefetchReader(fastq_R2, depth=prefetch_blocks) as f2:
+        for chunk1, chunk2 in read_paired_chunks(f1, f2, chunk_size, libname):
+            yield extract_information(chunk1, chunk2, fields)
+
+
+def extract_information(chunk1, chunk2, fields):
+    """
+    Extracts and encodes hashtag, cell barcode, and UMI from a pair of
+    FastqChunks.
+
+    Returns a dictionary of packed integer arrays keyed like `fields`, each
+    holding one entry per read pair.
+    """
+    matrices = {}
+    for R12, chunk in (("R1", chunk1), ("R2", chunk2)):
+        # Only the bases up to the end of the last field on this read are needed.
+        width = max([end for read, _, end in fields.values() if read == R12], default=0)
+        if width:
+            matrices[R12] = chunk.sequence_matrix(width)
+    return {column: encode_array(matrices[R12][:, start:end])
+            for column, (R12, start, end) in fields.items()}
+
+
+def read_paired_chunks(file_R1, file_R2, chunk_size, libname):
+    """
+    Read R1 and R2 side by side and yield pairs of FastqChunks.
+
+    Raises ValueError when the files hold different numbers of reads or when
+    the first or last read names of a chunk pair differ. Checking two names
+    per chunk keeps the check out of the per-read work while still catching
+    files that are not mates of each other or that drift apart.
+    """
+    for chunk1, chunk2 in zip_longest(read_fastq_chunks(file_R1, chunk_size),
+                                      read_fastq_chunks(file_R2, chunk_size)):
+        if chunk1 is None or chunk2 is None or len(chunk1) != len(chunk2):
+            raise ValueError(f"R1 and R2 of {libname} contain different numbers of reads")
+        for index in (0, len(chunk1) - 1):
+            name1, name2 = chunk1.read_name(index), chunk2.read_name(index)
+            if name1 != name2:
+                raise ValueError(f"R1 and R2 of {libname} are out of sync: read "
+                                 f"{name1.decode(errors='replace')} is paired with "
+                                 f"{name2.decode(errors='replace')}")
+        yield chunk1, chunk2
+
+
+class FastqChunk:
+    """
+    A chunk of FASTQ records kept as the raw bytes they were read from.
+
+    `line_ends` holds the offset of the newline ending each of the four
+    lines of every record, shape (n, 4), so fields and whole records are
+    sliced out of `buffer` without splitting it into Python strings.
+    """
+
+    def __init__(self, buffer, line_ends):
+        self.buffer = buffer
+        self.line_ends = line_ends
+
+    def __len__(self):
+        return self.line_ends.shape[0]
+
+    @property
+    def record_starts(self):
+        starts = np.empty(len(self), dtype=self.line_ends.dtype)
+        starts[:1] = 0
+        starts[1:] = self.line_ends[:-1, 3] + 1
+        return starts
+
+    @property
+    def record_ends(self):
+        return self.line_ends[:, 3] + 1
+
+    def read_name(self, index):
+        """
+        Return the name of a read: its header up to the first whitespace,
+        without the `/1` or `/2` mate suffix.
+        """
+        start = int(self.line_ends[index - 1, 3]) + 2 if index else 1
+        name = self.buffer[start:int(self.line_ends[index, 0])].split(maxsplit=1)
+        name = name[0] if name else b""
+        return name[:-2] if name.endswith((b"/1", b"/2")) else name
+
+    def sequence_matrix(self, width, start=0):
+        """
+        Return bases `start` to `width` of every read as a 2D uint8 array,
+        zero-padded where a read is shorter.
+        """
+        data = np.frombuffer(self.buffer, dtype=np.uint8)
+        seq_starts = self.line_ends[:, 0] + 1
+        seq_lengths = self.line_ends[:, 1] - seq_starts
+        columns = np.arange(start, width)
+        if len(self) and seq_lengths.min() >= width:
+            # Every read covers the slice: gather the bases directly
+            return data[seq_starts[:, None] + columns]
+        idx = np.minimum(seq_starts[:, None] + columns, len(data) - 1)
+        return np.where(columns < seq_lengths[:, None], data[idx], 0).astype(np.uint8)
+
+    def record_bytes(self, indices):
+        """
+        Return the raw bytes of the selected records, concatenated in order.
+        Runs of consecutive records are copied as one slice.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return b""
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        first = indices[np.concatenate(([0], breaks))]
+        last = indices[np.concatenate((breaks - 1, [len(indices) - 1]))]
+        view = memoryview(self.buffer)
+        return b"".join([view[start:end] for start, end in
+                         zip(self.record_starts[first].tolist(),
+                             self.record_ends[last].tolist())])
+
+
+def read_fastq_chunks(file_handle, chunk_size=10000, block_size=1 << 22):
+    """
+    Generator that yields FastqChunks of `chunk_size` records (the last one
+    may be shorter) from a FASTQ file opened in binary mode.
+
+    The file is read in blocks of `block_size` bytes and record boundaries
+    are found by scanning each block for newlines at once; a partial record
+    at the end of a block is carried over to the next chunk.
+    """
+    pending = bytearray()
+    newlines = np.empty(0, dtype=np.int64)
+    eof = False
+    while not eof:
+        block = file_handle.read(block_size)
+        eof = not block
+        if eof:
+            # Ignore trailing blank lines and terminate the last line
+            del pending[len(pending.rstrip()):]
+            newlines = newlines[newlines < len(pending)]
+            if pending:
+                pending += b"\n"
+                newlines = np.append(newlines, len(pending) - 1)
+        else:
+            found = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            newlines = np.concatenate([newlines, found + len(pending)])
+            pending += block
+        # Cut all full chunks, and at the end of the file the remaining records
+        n_lines = len(newlines) - len(newlines) % 4
+        start = done = 0
+        while n_lines - done >= 4 * chunk_size or (eof and n_lines > done):
+            n = min(4 * chunk_size, n_lines - done)
+            end = int(newlines[done + n - 1]) + 1
+            chunk = FastqChunk(bytes(pending[start:end]),
+                               (newlines[done:done + n] - start).reshape(-1, 4))
+            if np.any(np.frombuffer(chunk.buffer, dtype=np.uint8)[chunk.record_starts] != ord("@")):
+                raise ValueError("Malformed FASTQ record: header does not start with '@'")
+            yield chunk
+            start, done = end, done + n
+        if done:
+            del pending[:start]
+            newlines = newlines[done:] - start
+    if pending:
+        raise ValueError("Truncated FASTQ record at the end of the file")
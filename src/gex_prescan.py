@@ -0,0 +1,86 @@
+import logging
+import os
+import numpy as np
+from src.column_store import ColumnWriter, open_columns
+from src.config_validator import fastq_lanes
+from src.encoding import encode_array, packed_dtype
+from src.fastq_loader import read_fastq_chunks
+from src.prefetch import PrefetchReader, PREFETCH_BLOCKS
+from src.scheduler import run_lanes
+
+
+logger = logging.getLogger(__name__)
+
+# Columns of a prescanned lane: the packed cell barcode of every read and the
+# offset just past its record in the uncompressed FASTQ.
+COLUMNS = ("cell_barcode", "record_end")
+
+
+def prescan_prefix(output, libname, lane):
+    """
+    Prefix of the column store holding the prescanned barcodes of one lane
+    (numbered from 1) of a GEX library.
+    """
+    return os.path.join(output, f"{libname}_gex_barcodes.lane{lane}")
+
+
+def prescan_gex(libname, config, output, chunk_size, thread=1, prefetch_blocks=PREFETCH_BLOCKS):
+    """
+    Extract the packed cell barcode of every read of the GEX library ahead of
+    the split, which does not need the whitelist for this part.
+
+    Only the read holding the cell barcode is decompressed. Every lane is
+    stored as a column store (`{libname}_gex_barcodes.lane<n>.*.col`) with
+    the barcodes and the end offset of every record, on up to `thread`
+    threads. Returns the number of reads.
+    """
+    positions = config["positions"]
+    cb_start = int(positions['cell_barcode_start']) - 1
+    cb_end = int(positions['cell_barcode_end'])
+    lanes = fastq_lanes(config["libraries_to_be_demultiplexed"])[libname][
+        positions["cell_barcode_R12"]]
+
+    def scan_lane(lane):
+        number, path = lane
+        prefix = prescan_prefix(output, libname, number)
+        offset = 0
+        dtypes = {"cell_barcode": packed_dtype(cb_end - cb_start), "record_end": np.uint64}
+        with PrefetchReader(path, depth=prefetch_blocks) as f, \
+                ColumnWriter(prefix, dtypes) as writer:
+            for chunk in read_fastq_chunks(f, chunk_size):
+                writer.append({
+                    "cell_barcode": encode_array(chunk.sequence_matrix(cb_end, start=cb_start)),
+                    "record_end": offset + chunk.record_ends})
+                offset += len(chunk.buffer)
+        logger.info("Prescanned %d GEX cell barcodes of %s", writer.rows, path)
+        return writer.rows
+
+    return sum(run_lanes(list(enumerate(lanes, 1)), scan_lane, thread))
+
+
+def prescanned_barcodes(chunk_pairs, prefix, cb_R12, first=0, last=None):
+    """
+    Attach the prescanned barcodes at `prefix` to a stream of (chunk1,
+    chunk2) pairs of the same lane, or of its reads `first` up to `last`,
+    yielding (chunk1, chunk2, barcodes).
+
+    The barcodes of a chunk are a slice of the mapped column, which the
+    routing workers look up. The stored end of the last record of every
+    chunk is compared with the chunk read now, so a FASTQ that changed
+    since the prescan is detected.
+    """
+    columns = open_columns(prefix, COLUMNS)
+    start = first
+    offset = int(columns["record_end"][first - 1]) if first else 0
+    for chunk1, chunk2 in chunk_pairs:
+        chunk = chunk1 if cb_R12 == "R1" else chunk2
+        end = start + len(chunk)
+        offset += len(chunk.buffer)
+        if end > len(columns["record_end"]) or int(columns["record_end"][end - 1]) != offset:
+            raise ValueError(f"GEX reads do not match their prescan {prefix}; "
+                             "the FASTQ files changed since it was made")
+        yield chunk1, chunk2, np.asarray(columns["cell_barcode"][start:end])
+        start = end
+    if start != (len(columns["record_end"]) if last is None else last):
+        raise ValueError(f"GEX reads do not match their prescan {prefix}; "
+                         "the FASTQ files changed since it was made")
@@ -0,0 +1,132 @@
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+from collections import deque
+import numpy as np
+from src.encoding import encode_array
+
+try:
+    from src import fastq_chunk_processor as kernel
+    if not hasattr(kernel, "route_labels"):
+        # A build of an older version of the extension
+        raise ImportError("outdated fastq_chunk_processor extension")
+except ImportError:
+    kernel = None
+
+
+logger = logging.getLogger(__name__)
+
+def label_reads(chunk, barcode_index, cb_start, cb_end, compiled=None):
+    """
+    Return the sample label of the cell barcode of every read in a
+    FastqChunk: exact matches first, then barcodes within Hamming distance 1.
+
+    `compiled` selects the compiled kernel or the NumPy implementation; by
+    default the kernel is used when it is built. Both give the same labels.
+    """
+    if compiled is None:
+        compiled = kernel is not None
+    if compiled:
+        return kernel.route_labels(np.frombuffer(chunk.buffer, dtype=np.uint8),
+                                   np.ascontiguousarray(chunk.line_ends, dtype=np.int64),
+                                   cb_start, cb_end, barcode_index.barcodes.astype(np.uint64),
+                                   barcode_index.labels)
+    # Only the barcode bases are gathered from the reads
+    return barcode_index.lookup(encode_array(chunk.sequence_matrix(cb_end, start=cb_start)))
+
+
+def gather_records(chunk, labels, n_samples, compiled=None):
+    """
+    Return the raw bytes of the records of every sample label in a
+    FastqChunk, concatenated in input order, as a list indexed by label.
+    """
+    if compiled is None:
+        compiled = kernel is not None
+    if compiled:
+        return kernel.gather_records(np.frombuffer(chunk.buffer, dtype=np.uint8),
+                                     np.ascontiguousarray(chunk.line_ends, dtype=np.int64),
+                                     np.ascontiguousarray(labels, dtype=np.int16), n_samples)
+    return [chunk.record_bytes(np.flatnonzero(labels == label)) for label in range(n_samples)]
+
+
+def route_chunk(routing, chunk1, chunk2, barcodes=None):
+    """
+    Route a pair of FastqChunks to samples and collect the records of each
+    sample. `routing` holds the samples, the BarcodeIndex of their cell
+    barcodes, the start and end of the barcode and the read holding it. The
+    cell barcodes are read from the chunk unless their packed `barcodes`
+    are given, e.g. from a prescan (see src.gex_prescan).
+
+    Returns (local_total, chunk_sample_counts, records) where records maps
+    each sample to the (R1, R2) FASTQ bytes of its read pairs, in input order.
+    The records are copied from the input buffers as they are.
+    """
+    samples, barcode_index, cb_start, cb_end, cb_R12 = routing
+    if barcodes is None:
+        chunk = chunk1 if cb_R12 == "R1" else chunk2
+        labels = label_reads(chunk, barcode_index, cb_start, cb_end)
+    else:
+        labels = barcode_index.lookup(barcodes)
+    counts = np.bincount(labels[labels >= 0], minlength=len(samples))
+    records_R1 = gather_records(chunk1, labels, len(samples))
+    records_R2 = gather_records(chunk2, labels, len(samples))
+    chunk_sample_counts = {}
+    records = {}
+    for label in np.flatnonzero(counts):
+        chunk_sample_counts[samples[label]] = int(counts[label])
+        records[samples[label]] = (records_R1[label], records_R2[label])
+    return len(chunk1), chunk_sample_counts, records
+
+
+def split_chunks(chunk_pairs, routing, out_files_R1, out_files_R2, workers):
+    """
+    Route paired chunks on a pool of workers and write the records of every
+    sample to its output files.
+
+    The workers are threads when the compiled kernel, which releases the
+    GIL, is built, and processes started from a fork server otherwise.
+    `routing` is passed on to route_chunk with every chunk, so splits of
+    several libraries at the same time do not share state; `chunk_pairs`
+    yields (chunk1, chunk2) or, with barcodes known in advance, (chunk1,
+    chunk2, barcodes). The main thread keeps feeding chunks while at most two
+    per worker are in flight, and writes the results back in input order,
+    so each sample's output keeps the order of the input FASTQs. Returns
+    (total_read_pairs, sample_counts).
+    """
+    total_read_pairs = 0
+    sample_counts = {}
+
+    def write(result):
+        nonlocal total_read_pairs
+        local_total, local_counts, records = result
+        total_read_pairs += local_total
+        for sample, count in local_counts.items():
+            sample_counts[sample] = sample_counts.get(sample, 0) + count
+        for sample, (data_R1, data_R2) in records.items():
+            out_files_R1[sample].write(data_R1)
+            out_files_R2[sample].write(data_R2)
+
+    route = functools.partial(route_chunk, routing)
+    if workers <= 1:
+        # Not worth a pool; route in the main thread instead.
+        for item in chunk_pairs:
+            write(route(*item))
+        return total_read_pairs, sample_counts
+
+    pending = deque()
+    if kernel is not None:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    else:
+        # Forking would copy locks held by the read-ahead and compression
+        # threads already running, so workers start from a fork server.
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+    with pool as executor:
+        for item in chunk_pairs:
+            pending.append(executor.submit(route, *item))
+            if len(pending) >= 2 * workers:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    return total_read_pairs, sample_counts
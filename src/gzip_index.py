@@ -0,0 +1,351 @@
+import logging
+import os
+import zlib
+import numpy as np
+from src.scheduler import run_lanes
+
+try:
+    from src import zran
+except ImportError:
+    zran = None
+
+
+logger = logging.getLogger(__name__)
+
+# Sidecar of the index, next to the gzip file.
+INDEX_SUFFIX = ".gzidx.npz"
+# Uncompressed bytes between checkpoints; every checkpoint keeps a window.
+SPACING = 1 << 22
+# Output a deflate stream may refer back to.
+WINDOW_SIZE = 1 << 15
+# Compressed bytes read at a time.
+INPUT_SIZE = 1 << 20
+# Bytes of a gzip member trailer (CRC32 and size).
+TRAILER_SIZE = 8
+
+
+def index_path(path):
+    """
+    Path of the index sidecar of a gzip file.
+    """
+    return path + INDEX_SUFFIX
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _padding_end(data, start):
+    """
+    Offset of the first byte from `start` on that is not zero padding, which
+    gzip readers skip after a member, or the end of `data`.
+    """
+    nonzero = np.flatnonzero(np.frombuffer(data, dtype=np.uint8, offset=start))
+    return start + int(nonzero[0]) if len(nonzero) else len(data)
+
+
+class GzipIndex:
+    """
+    Checkpoints for random access into a gzipped FASTQ, as in zlib's zran.c.
+
+    Every checkpoint is a deflate block boundary at least `spacing` bytes of
+    output after the previous one. It stores its offset in the compressed
+    file, the number of bits of the byte before that belong to it, its
+    offset in the uncompressed data and the 32 KiB of output before it,
+    which the following blocks may refer to. It also stores the number of
+    the first FASTQ record starting at or after it and the uncompressed
+    offset of that record, so that R1 and R2 are split at the same record.
+    Checkpoint 0 is the start of the file.
+    """
+
+    FIELDS = ("compressed", "bits", "uncompressed", "record", "record_start")
+
+    def __init__(self, signature, points, windows, size):
+        self.signature = list(signature)
+        self.points = {field: np.asarray(points[field], dtype=np.int64) for field in self.FIELDS}
+        # zlib-compressed windows, one per checkpoint
+        self.windows = windows
+        self.size = size
+
+    def __len__(self):
+        return len(self.points["compressed"])
+
+    def window(self, point):
+        return zlib.decompress(self.windows[point])
+
+    def save(self, path):
+        """
+        Save the index as an npz file, replacing `path` at once.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, signature=np.array(self.signature, dtype=np.int64),
+                     size=np.array(self.size), windows=np.frombuffer(b"".join(self.windows),
+                                                                     dtype=np.uint8),
+                     window_ends=np.cumsum([len(window) for window in self.windows]),
+                     **self.points)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            windows = arrays["windows"].tobytes()
+            ends = arrays["window_ends"].tolist()
+            return cls(arrays["signature"].tolist(),
+                       {field: arrays[field] for field in cls.FIELDS},
+                       [windows[start:end] for start, end in zip([0] + ends, ends)],
+                       int(arrays["size"]))
+
+    @classmethod
+    def build(cls, path, spacing=SPACING):
+        """
+        Decompress a gzip file once and record its checkpoints.
+        """
+        signature = _signature(path)
+        points = {field: [0] for field in cls.FIELDS}
+        windows = [zlib.compress(b"")]
+        # Checkpoints waiting for the start of their first record: (point, newline)
+        pending = []
+        inflater = zran.Inflater(31)
+        out = np.empty(16 * WINDOW_SIZE, dtype=np.uint8)
+        pos = total_in = total_out = lines = last_point = 0
+        member_end = False
+        data, start = b"", 0
+        with open(path, "rb") as f:
+            while True:
+                if start == len(data):
+                    data, start = f.read(INPUT_SIZE), 0
+                    if not data:
+                        break
+                if member_end:
+                    if data[start] == 0:
+                        padding_end = _padding_end(data, start)
+                        total_in += padding_end - start
+                        start = padding_end
+                        continue
+                    # The next member of a multi-member file such as BGZF
+                    inflater.reset(31)
+                if pos == len(out):
+                    out[:WINDOW_SIZE] = out[pos - WINDOW_SIZE:pos]
+                    pos = WINDOW_SIZE
+                consumed, produced, member_end = inflater.inflate(
+                    memoryview(data)[start:], out[pos:], block=True)
+                if not consumed and not produced and not member_end:
+                    raise ValueError(f"{path} is not a valid gzip file")
+                start += consumed
+                total_in += consumed
+                newlines = np.flatnonzero(out[pos:pos + produced] == 10)
+                while pending and pending[0][1] <= lines + len(newlines):
+                    point, newline = pending.pop(0)
+                    points["record_start"][point] = total_out + int(newlines[newline - lines - 1]) + 1
+                lines += len(newlines)
+                pos += produced
+                total_out += produced
+                data_type = inflater.data_type
+                if member_end or not data_type & 128 or data_type & 64 \
+                        or total_out - last_point < spacing:
+                    continue
+                # End of a deflate block that is not the last of its member
+                for field, value in zip(cls.FIELDS, (total_in, data_type & 7, total_out,
+                                                     lines // 4, total_out)):
+                    points[field].append(value)
+                windows.append(zlib.compress(out[max(pos - WINDOW_SIZE, 0):pos].tobytes(), 1))
+                if lines % 4 or out[pos - 1] != 10:
+                    # Inside a record: the next one starts after its last line
+                    points["record"][-1] += 1
+                    pending.append((len(windows) - 1, 4 * points["record"][-1]))
+                last_point = total_out
+        if not member_end:
+            raise ValueError(f"{path} is truncated")
+        # Checkpoints in the last record are of no use
+        keep = len(windows) - len(pending)
+        return cls(signature, {field: values[:keep] for field, values in points.items()},
+                   windows[:keep], total_out)
+
+
+def load_index(path, spacing=SPACING):
+    """
+    Return the index of a gzip file from its sidecar, building and saving it
+    first when it is missing or the file has changed since. Returns None for
+    files that are not gzipped or when the `src.zran` extension is not built.
+    """
+    if zran is None or not path.endswith(".gz"):
+        return None
+    sidecar = index_path(path)
+    if os.path.exists(sidecar):
+        try:
+            index = GzipIndex.load(sidecar)
+            if index.signature == _signature(path):
+                return index
+        except (OSError, ValueError, KeyError):
+            logger.warning("Ignoring unreadable gzip index %s", sidecar)
+    logger.info("Indexing %s for parallel decompression", path)
+    index = GzipIndex.build(path, spacing)
+    try:
+        index.save(sidecar)
+    except OSError as error:
+        logger.warning("Cannot save the gzip index of %s (%s); it is built again next time",
+                       path, error)
+    return index
+
+
+def record_ranges(index, parts):
+    """
+    Split the records of an indexed FASTQ into up to `parts` ranges of about
+    the same uncompressed size, each starting at a checkpoint. Returns a list
+    of (first, last) record numbers; the last range ends with None.
+    """
+    uncompressed = index.points["uncompressed"]
+    starts = np.searchsorted(uncompressed, index.size * np.arange(1, parts) / parts)
+    firsts = sorted({0} | {int(index.points["record"][point]) for point in starts
+                           if point < len(index)})
+    return list(zip(firsts, firsts[1:] + [None]))
+
+
+def split_lanes(lanes, parts, thread=1):
+    """
+    Split every (R1, R2) lane of gzipped FASTQs into up to `parts` pairs of
+    FastqRanges holding the same records, loading or building the indexes of
+    all files on up to `thread` threads. Lanes that cannot be indexed stay
+    whole. Returns the (R1, R2) pairs in order.
+    """
+    paths = sorted({path for lane in lanes for path in lane})
+    indexes = dict(zip(paths, run_lanes(paths, load_index, thread)))
+    split = []
+    for fastq_R1, fastq_R2 in lanes:
+        if parts <= 1 or indexes[fastq_R1] is None or indexes[fastq_R2] is None:
+            split.append((fastq_R1, fastq_R2))
+            continue
+        for first, last in record_ranges(indexes[fastq_R1], parts):
+            split.append((FastqRange(fastq_R1, indexes[fastq_R1], first, last),
+                          FastqRange(fastq_R2, indexes[fastq_R2], first, last)))
+    return split
+
+
+class FastqRange:
+    """
+    Records `first` up to `last` (exclusive, None for all) of an indexed
+    gzipped FASTQ.
+    """
+
+    def __init__(self, path, index, first=0, last=None):
+        self.path = path
+        self.index = index
+        self.first = first
+        self.last = last
+
+    def __str__(self):
+        last = "" if self.last is None else self.last
+        return f"{self.path}[{self.first}:{last}]"
+
+    def open(self, block_size=1 << 22):
+        return RangeReader(self.path, self.index, self.first, self.last, block_size)
+
+
+class RangeReader:
+    """
+    Read the records of a FastqRange as a binary file, decompressing from
+    the last checkpoint before them.
+    """
+
+    def __init__(self, path, index, first=0, last=None, block_size=1 << 22):
+        self.path = path
+        self.block_size = block_size
+        point = int(np.searchsorted(index.points["record"], first, side="right")) - 1
+        compressed, bits = (int(index.points[field][point]) for field in ("compressed", "bits"))
+        self.file = open(path, "rb")
+        # Checkpoint 0 starts with the gzip header, the others in raw deflate data
+        self.raw = point > 0
+        self.inflater = zran.Inflater(-15 if self.raw else 31)
+        if self.raw:
+            self.file.seek(compressed - (1 if bits else 0))
+            value = self.file.read(1)[0] if bits else 0
+            self.inflater.resume(bits, value, index.window(point))
+        self.skip_bytes = int(index.points["record_start"][point] - index.points["uncompressed"][point])
+        self.skip_lines = 4 * (first - int(index.points["record"][point]))
+        self.lines_left = None if last is None else 4 * (last - first)
+        self.data, self.start = b"", 0
+        self.skip_input = 0
+        self.member_end = False
+        self.pending = b""
+        self.done = self.lines_left == 0
+
+    def _inflate(self):
+        out = bytearray(self.block_size)
+        produced = 0
+        while produced < len(out):
+            if self.start == len(self.data):
+                self.data, self.start = self.file.read(INPUT_SIZE), 0
+                if not self.data:
+                    break
+            if self.skip_input:
+                skipped = min(self.skip_input, len(self.data) - self.start)
+                self.start += skipped
+                self.skip_input -= skipped
+                continue
+            if self.member_end:
+                if self.data[self.start] == 0:
+                    self.start = _padding_end(self.data, self.start)
+                    continue
+                self.inflater.reset(31)
+            consumed, n, self.member_end = self.inflater.inflate(
+                memoryview(self.data)[self.start:], memoryview(out)[produced:])
+            if not consumed and not n and not self.member_end:
+                raise ValueError(f"{self.path} is not a valid gzip file")
+            self.start += consumed
+            produced += n
+            if self.member_end and self.raw:
+                # Raw inflate stops before the member trailer
+                self.skip_input = TRAILER_SIZE
+                self.raw = False
+        return bytes(out[:produced])
+
+    def _next_block(self):
+        while not self.done:
+            block = self._inflate()
+            if not block:
+                self.done = True
+                return b""
+            if self.skip_bytes:
+                skipped = min(self.skip_bytes, len(block))
+                block = block[skipped:]
+                self.skip_bytes -= skipped
+            if self.skip_lines and block:
+                newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+                if len(newlines) < self.skip_lines:
+                    self.skip_lines -= len(newlines)
+                    continue
+                block = block[int(newlines[self.skip_lines - 1]) + 1:]
+                self.skip_lines = 0
+            if self.lines_left is not None and block:
+                newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+                if len(newlines) >= self.lines_left:
+                    block = block[:int(newlines[self.lines_left - 1]) + 1]
+                    self.done = True
+                else:
+                    self.lines_left -= len(newlines)
+            if block:
+                return block
+        return b""
+
+    def read(self, size=-1):
+        """
+        Return up to `size` bytes (at most one block), or b"" at the end of
+        the range.
+        """
+        if not self.pending:
+            self.pending = self._next_block()
+        if size is None or size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
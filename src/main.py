@@ -1,30 +1,83 @@
 import argparse
+import concurrent.futures
 import os
 import logging
-from src.config_validator import load_config, ConfigValidationError
-from src.fastq_loader import load_fastq
-from src.demultiplexer import categorize_reads_by_hto, deduplicate_umi, filter_cellbarcodes,split_GEX_fastqs
+from src.config_validator import load_config, ConfigValidationError, fastq_lanes, entry_paths
+from src.fastq_loader import load_fastq, reads_prefix, FIELDS
+from src.column_store import column_path
+from src.demultiplexer import categorize_reads_by_hto, deduplicate_umi, filter_cellbarcodes,split_GEX_fastqs, load_cellbarcodes
+from src.scheduler import ResourcePool, LibraryLogFilter, library_log, run_libraries, in_library
+from src.stage_cache import StageCache
+from src.perf import StageTimer
+from src.engine import ENGINES, set_engine
+from src.count_matrix import HTOCountMatrix
+from src.memory_budget import (DEDUP_BYTES_PER_READ, FIXED_BYTES, record_bytes, plan_chunks,
+                               plan_deduplication, streaming_chunk_size)
+from src.prefetch import PREFETCH_BLOCKS
+from src.pipeline import hto_statistics, umi_statistics, filter_statistics, save_statistics
+from src.gex_prescan import prescan_gex, prescan_prefix, COLUMNS as PRESCAN_COLUMNS
+import numpy as np
 from collections import OrderedDict
 
 
-def main():
+def build_parser():
+    """
+    Command line options of `schto`.
+    """
     parser = argparse.ArgumentParser(
         description="Demultiplex single-cell libraries with HTOs."
     )
     parser.add_argument("--input", required=True, help="Path to the configuration YAML file.")
     parser.add_argument("--output", required=True, help="Output directory for results.")
-    parser.add_argument("--threads", type=int, default=6, help="Number of threads to use.")
+    parser.add_argument("--threads", type=int, default=6,
+                        help="Number of threads to use, shared by all libraries.")
     parser.add_argument("--chunk_size", type=int, default=1000000, help="Chunk size for processing FASTQ files.")
+    parser.add_argument("--hto_hamming_distance", type=int, choices=[0, 1], default=0,
+                        help="Maximum Hamming distance for matching HTO sequences.")
+    parser.add_argument("--dedup_memory", type=int, default=None,
+                        help="Memory budget in MB for streaming UMI deduplication, which spills "
+                             "to disk when exceeded. By default UMIs are deduplicated in memory.")
+    parser.add_argument("--compression_level", type=int, choices=range(10), default=6,
+                        metavar="{0-9}", help="Compression level of the gzipped FASTQ outputs.")
+    parser.add_argument("--parallel_libraries", type=int, default=1,
+                        help="Number of HTO libraries processed at the same time.")
+    parser.add_argument("--max_memory", type=int, default=None,
+                        help="Memory budget in MB shared by the libraries processed at the same "
+                             "time. Chunk sizes, read-ahead and threads of every step are chosen "
+                             "to fit each library's share, and a step waits until its estimated "
+                             "memory is available.")
+    parser.add_argument("--prescan_gex", action="store_true",
+                        help="Read the cell barcodes of the GEX library in the background while "
+                             "the HTO library is processed, so that splitting it does not have to "
+                             "gather them from the records. Splitting still decompresses both "
+                             "mates, so this only helps with cores idle during the HTO steps.")
+    parser.add_argument("--gzip_index", action="store_true",
+                        help="Split gzipped FASTQs into ranges that are decompressed in parallel, "
+                             "using random-access indexes saved next to them as "
+                             "<file>.gzidx.npz (built by the first run).")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Rerun every step instead of reusing the outputs of a previous run.")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="pandas",
+                        help="Dataframe engine for UMI counting and cell barcode filtering: "
+                             "in-process pandas, or modin (requires modin and Ray).")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile every step with cProfile into <library>_<step>.prof.")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output.")
-    args = parser.parse_args()
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
 
-    os.environ["MODIN_CPUS"] = str(args.threads)
+    set_engine(args.engine, cpus=args.threads)
     # Set up logging.
     logging.basicConfig(
         level=logging.DEBUG if args.verbose else logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
+        format="%(asctime)s - %(levelname)s - [%(libname)s] %(message)s",
         datefmt='%Y-%m-%d %H:%M:%S'
     )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(LibraryLogFilter())
     logger = logging.getLogger(__name__)
     logger.info("Starting cshto with configuration file: %s", args.input)
 
@@ -39,67 +92,305 @@ def main():
     os.makedirs(args.output, exist_ok=True)
 
     # --- Step 1: Process HTO libraries ---
-    # Group FASTQ paths for HTO libraries (expects paired R1 and R2 entries by htolib_name).
-    hto_files = {}
-    for entry in config["libraries_with_HTOs"]:
-        lib = entry["htolib_name"]
-        hto_files.setdefault(lib, {})[entry["R12"]] = entry["path"]
-
-    for lib, files in hto_files.items():
-        samples = [hto["sample_name"] for hto in config["HTO_sequences"]
-                   if hto["htolib_name"] == lib]
-        statistics = OrderedDict()
-        statistics["Library name"] = lib
-        if "R1" not in files or "R2" not in files:
-            logger.error("Missing R1 or R2 for library %s", lib)
-            continue
-        statistics["HTO R1 FASTQ"] = files["R1"]
-        statistics["HTO R2 FASTQ"] = files["R2"]
-        
-        # Step 1: Load the libraries with HTOs
-        logger.info("Processing HTO library for %s: R1=%s, R2=%s", lib, files["R1"], files["R2"])
-        statistics = load_fastq(libname=lib, fastq_R1=files["R1"], fastq_R2=files["R2"],
-                   config=config, thread=args.threads,
-                   chunk_size=args.chunk_size, output=args.output,
-                   statistics=statistics)
-        logger.info("Finished processing library %s", lib)
-        # Step 2: Categorize read pairs by HTO into samples
-        categorized_indices = categorize_reads_by_hto(
-            libname=lib, config=config, thread=args.threads,
-            chunk_size=args.chunk_size, output=args.output)
-        statistics["Valid HTOs"] = sum([len(ind) for ind in categorized_indices.values()])
-        for sample in samples:
-            statistics[f"{sample} HTOs"] = len(categorized_indices[sample])
-        # Step 3: Deduplicate UMIs and categorize cell barcodes
-        unique_df = deduplicate_umi(
-            categorized_indices=categorized_indices,
-            libname=lib,
-            thread=args.threads,
-            chunk_size=args.chunk_size, 
-            output=args.output)
-        statistics["Unique barcodes and UMIs"] = unique_df["umi_count"].sum()
-        for sample in samples:
-            statistics[f"Unique barcodes and UMIs of {sample}"] = unique_df["umi_count"].iloc[unique_df["sample"] == sample].sum()
-
-        # Step 4: Filter cell barcodes from HTO according to the expected cell numbers
-        filtered_df = filter_cellbarcodes(unique_df=unique_df,
-            config=config, libname=lib,output=args.output)
-        statistics["Filtered barcodes"] = filtered_df.shape[0]
-        for sample in samples:
-            statistics[f"Filtered barcodes of {sample}"] = (filtered_df["sample"] == sample).sum()
-
-        # Step 5: Load GEX library and split the read pairs into samples according to the identified barcodes
-        statistics = split_GEX_fastqs(libname=lib, config=config,
-                         filtered_df=filtered_df, output=args.output,chunk_size=args.chunk_size,
-                         statistics=statistics)
-        save_statistics(statistics, output=args.output, libname=lib)
+    # Group FASTQ paths for HTO libraries (expects paired R1 and R2 entries by
+    # htolib_name), with one path per lane.
+    hto_files = fastq_lanes(config["libraries_with_HTOs"])
+
+    pool = ResourcePool(cores=args.threads,
+                        memory=args.max_memory * 1024 ** 2 if args.max_memory else None)
+    formatter = logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
+
+    # Libraries processed at the same time share the memory budget evenly
+    library_memory = pool.memory // max(1, min(args.parallel_libraries, len(hto_files))) \
+        if pool.memory else None
+
+    def run_library(lib, files):
+        with library_log(lib, os.path.join(args.output, f"{lib}.log"), formatter):
+            return process_library(lib, files, config, args, pool, library_memory)
+
+    run_libraries(hto_files, run_library, args.parallel_libraries)
     logger.info("Processing complete. Results are saved in: %s", args.output)
 
 
-def save_statistics(statistics, output, libname):
-    with open(os.path.join(output, f"{libname}_statistics.csv"), "w") as f:
-        for k, v in statistics.items():
-            print(",".join([k,str(v)]), file=f)
-    
+def process_library(lib, files, config, args, pool, memory=None):
+    """
+    Run all steps for one HTO library. Every step holds the cores and memory
+    it needs from `pool` while it runs, so steps of different libraries
+    interleave under the global budget.
+
+    With a `memory` budget in bytes, the chunk sizes, read-ahead blocks and
+    threads of the steps are chosen to stay within it (see
+    `src.memory_budget`) and reported in the statistics.
+
+    With `args.prescan_gex`, the cell barcodes of the GEX library are
+    extracted on a background thread during the HTO steps (see
+    `src.gex_prescan`), which then share the memory budget with it.
+
+    Steps whose inputs are unchanged since a previous run into the same output
+    directory are reused from the stage manifest (see `src.stage_cache`).
+    Their outputs are only loaded when a later step has to be run again.
+    The resources used by every step are saved as a performance report (see
+    `src.perf`).
+    """
+    logger = logging.getLogger(__name__)
+    samples = [hto["sample_name"] for hto in config["HTO_sequences"]
+               if hto["htolib_name"] == lib]
+    statistics = OrderedDict()
+    statistics["Library name"] = lib
+    if "R1" not in files or "R2" not in files:
+        logger.error("Missing R1 or R2 for library %s", lib)
+        return None
+    statistics["HTO R1 FASTQ"] = ";".join(files["R1"])
+    statistics["HTO R2 FASTQ"] = ";".join(files["R2"])
+    cache = StageCache(args.output, lib, enabled=not args.no_cache)
+    timer = StageTimer(lib, args.output, profile=args.profile)
+    library_config = {section: [entry for entry in config[section] if entry["htolib_name"] == lib]
+                      for section in ("HTO_sequences", "expected_cell_number",
+                                      "libraries_to_be_demultiplexed")}
+
+    # Optionally prescan the GEX cell barcodes, which does not depend on the
+    # HTO steps, in the background
+    prescan = None
+    prescanned = False
+    prescan_statistics = OrderedDict()
+    stage_memory = memory
+    if args.prescan_gex:
+        barcode_fastqs = fastq_lanes(library_config["libraries_to_be_demultiplexed"])[lib][
+            config["positions"]["cell_barcode_R12"]]
+        prescan_outputs = [column_path(prescan_prefix(args.output, lib, lane), column)
+                           for lane in range(1, len(barcode_fastqs) + 1)
+                           for column in PRESCAN_COLUMNS]
+        prescan_key = cache.key("prescan", files=barcode_fastqs, positions=config["positions"])
+        entry = cache.load("prescan", prescan_key)
+        if entry is None:
+            prescan_memory = memory // 4 if memory else None
+            stage_memory = memory - prescan_memory if memory else None
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"prescan-{lib}")
+            prescan = executor.submit(in_library(_prescan_gex), lib, config, args, pool, timer,
+                                      barcode_fastqs, prescan_memory)
+            # The thread finishes the prescan without the executor being waited for
+            executor.shutdown(wait=False)
+        else:
+            prescanned = True
+            prescan_statistics = entry["statistics"]
+            timer.skip("prescan", prescan_statistics["GEX prescanned reads"])
+
+    # Step 1: Load the libraries with HTOs
+    reads_columns = [column_path(reads_prefix(args.output, lib), column) for column in FIELDS]
+    extract_key = cache.key("extract", files=files["R1"] + files["R2"],
+                            positions=config["positions"])
+    entry = cache.load("extract", extract_key)
+    if entry is None:
+        logger.info("Processing HTO library for %s: R1=%s, R2=%s", lib,
+                    ", ".join(files["R1"]), ", ".join(files["R2"]))
+        lanes = max(len(files["R1"]), args.threads) if args.gzip_index else len(files["R1"])
+        plan = {"chunk_size": args.chunk_size, "threads": min(lanes, args.threads),
+                "prefetch_blocks": PREFETCH_BLOCKS, "memory": 0}
+        if stage_memory:
+            pair_bytes = record_bytes(files["R1"][0]) + record_bytes(files["R2"][0])
+            plan = plan_chunks("extract", stage_memory, pair_bytes, args.chunk_size,
+                               min(lanes, args.threads), lanes=lanes)
+        # Lanes, or with gzip indexes ranges of them, are extracted in parallel
+        # on the cores that are free
+        with pool.acquire(cores=plan["threads"], memory=plan["memory"], min_cores=1) as cores, \
+                timer.stage("extract") as record:
+            stage_statistics = load_fastq(libname=lib, fastq_R1=files["R1"], fastq_R2=files["R2"],
+                       config=config, thread=cores,
+                       chunk_size=plan["chunk_size"], output=args.output,
+                       statistics=OrderedDict(), prefetch_blocks=plan["prefetch_blocks"],
+                       gzip_index=args.gzip_index)
+            record["reads"] = stage_statistics["Total read pair"]
+        if stage_memory:
+            stage_statistics.update(_plan_statistics("Extraction", plan, cores))
+            stage_statistics["Bytes per HTO read pair"] = round(pair_bytes)
+        cache.save("extract", extract_key, reads_columns, stage_statistics)
+        logger.info("Finished processing library %s", lib)
+    else:
+        stage_statistics = entry["statistics"]
+        timer.skip("extract", stage_statistics["Total read pair"])
+    statistics.update(stage_statistics)
+    hto_reads = statistics["Total read pair"]
+
+    # Step 2: Categorize read pairs by HTO into samples
+    labels_path = os.path.join(args.output, f"{lib}_hto_labels.npy")
+    categorize_key = cache.key("categorize", parent=extract_key,
+                               hto_sequences=library_config["HTO_sequences"],
+                               hamming_distance=args.hto_hamming_distance)
+    entry = cache.load("categorize", categorize_key)
+    if entry is None:
+        with pool.acquire(cores=1), timer.stage("categorize") as record:
+            samples, hto_labels = categorize_reads_by_hto(
+                libname=lib, config=config, thread=1,
+                chunk_size=args.chunk_size, output=args.output,
+                hamming_distance=args.hto_hamming_distance)
+            np.save(labels_path, hto_labels)
+            record["reads"] = hto_reads
+        stage_statistics = hto_statistics(samples, hto_labels, args.hto_hamming_distance)
+        cache.save("categorize", categorize_key, [labels_path], stage_statistics,
+                   samples=samples)
+    else:
+        samples = entry["samples"]
+        stage_statistics = entry["statistics"]
+        timer.skip("categorize", hto_reads)
+        # Mapped rather than read, as it is only needed if deduplication reruns
+        hto_labels = np.load(labels_path, mmap_mode='r')
+    statistics.update(stage_statistics)
+
+    # Step 3: Deduplicate UMIs and categorize cell barcodes
+    umi_counts_path = os.path.join(args.output, f"{lib}_umi_counts.csv")
+    matrix_path = os.path.join(args.output, f"{lib}_hto_matrix.npz")
+    dedup_key = cache.key("deduplicate", parent=categorize_key)
+    entry = cache.load("deduplicate", dedup_key)
+    if entry is None:
+        if args.dedup_memory:
+            budget = args.dedup_memory * 1024 ** 2
+            plan = {"memory_budget": budget,
+                    "chunk_size": streaming_chunk_size(budget, args.chunk_size),
+                    "memory": budget}
+        elif stage_memory:
+            plan = plan_deduplication(stage_memory, len(hto_labels), args.chunk_size)
+        else:
+            plan = {"memory_budget": None, "chunk_size": args.chunk_size,
+                    "memory": DEDUP_BYTES_PER_READ * len(hto_labels)}
+        with pool.acquire(cores=1, memory=plan["memory"]), \
+                timer.stage("deduplicate") as record:
+            record["reads"] = hto_reads
+            matrix = deduplicate_umi(
+                samples=samples,
+                hto_labels=np.asarray(hto_labels),
+                libname=lib,
+                config=config,
+                thread=1,
+                chunk_size=plan["chunk_size"],
+                output=args.output,
+                memory_budget=plan["memory_budget"])
+        stage_statistics = OrderedDict()
+        if stage_memory:
+            stage_statistics["Deduplication mode"] = "streaming" if plan["memory_budget"] \
+                else "in memory"
+            stage_statistics["Deduplication chunk size"] = plan["chunk_size"]
+            stage_statistics["Deduplication memory (MB)"] = round(plan["memory"] / 1024 ** 2)
+        stage_statistics.update(umi_statistics(samples, matrix))
+        cache.save("deduplicate", dedup_key, [umi_counts_path, matrix_path], stage_statistics)
+    else:
+        matrix = None
+        stage_statistics = entry["statistics"]
+        timer.skip("deduplicate", hto_reads)
+    statistics.update(stage_statistics)
+
+    # Step 4: Filter cell barcodes from HTO according to the expected cell numbers
+    filtered_path = os.path.join(args.output, f"{lib}_filtered_cellbarcodes.csv")
+    filter_key = cache.key("filter", parent=dedup_key,
+                           expected_cell_number=library_config["expected_cell_number"])
+    entry = cache.load("filter", filter_key)
+    if entry is None:
+        with timer.stage("filter") as record:
+            record["reads"] = hto_reads
+            if matrix is None:
+                matrix = HTOCountMatrix.load(matrix_path)
+            filtered_df = filter_cellbarcodes(matrix=matrix,
+                config=config, libname=lib,output=args.output)
+        stage_statistics = filter_statistics(samples, filtered_df)
+        cache.save("filter", filter_key, [filtered_path], stage_statistics)
+    else:
+        filtered_df = None
+        stage_statistics = entry["statistics"]
+        timer.skip("filter", hto_reads)
+    statistics.update(stage_statistics)
+
+    if prescan is not None:
+        try:
+            prescan_statistics = prescan.result()
+        except Exception:
+            logger.exception("Prescanning the GEX library of %s failed; its cell barcodes are "
+                             "read while splitting it instead", lib)
+        else:
+            prescanned = True
+            cache.save("prescan", prescan_key, prescan_outputs, prescan_statistics)
+    statistics.update(prescan_statistics)
+
+    # Step 5: Load GEX library and split the read pairs into samples according to the identified barcodes
+    gex_fastqs = [path for d in library_config["libraries_to_be_demultiplexed"]
+                  for path in entry_paths(d)]
+    split_outputs = [os.path.join(args.output, f"{lib}_{sample}_{R12}.fastq.gz")
+                     for sample in samples for R12 in ("R1", "R2")]
+    split_key = cache.key("split", parent=filter_key, files=gex_fastqs,
+                          compression_level=args.compression_level)
+    entry = cache.load("split", split_key)
+    if entry is None:
+        if filtered_df is None:
+            filtered_df = load_cellbarcodes(filtered_path, samples, config)
+        plan = {"chunk_size": args.chunk_size, "threads": args.threads,
+                "prefetch_blocks": PREFETCH_BLOCKS, "memory": 0}
+        if memory:
+            gex_files = fastq_lanes(library_config["libraries_to_be_demultiplexed"])[lib]
+            pair_bytes = record_bytes(gex_files["R1"][0]) + record_bytes(gex_files["R2"][0])
+            lanes = len(gex_files["R1"])
+            plan = plan_chunks("split", memory, pair_bytes, args.chunk_size, args.threads,
+                               lanes=max(lanes, args.threads) if args.gzip_index else lanes)
+        # This step scales with cores, so it starts with whatever is free.
+        with pool.acquire(cores=plan["threads"], memory=plan["memory"], min_cores=1) as cores, \
+                timer.stage("split") as record:
+            logger.info("Splitting GEX FASTQs of %s on %d cores", lib, cores)
+            stage_statistics = split_GEX_fastqs(libname=lib, config=config,
+                             filtered_df=filtered_df, output=args.output,
+                             chunk_size=plan["chunk_size"],
+                             statistics=OrderedDict(), thread=cores,
+                             compresslevel=args.compression_level,
+                             prefetch_blocks=plan["prefetch_blocks"],
+                             prescanned=prescanned, gzip_index=args.gzip_index)
+            record["reads"] = stage_statistics["GEX total read pairs"]
+        if memory:
+            stage_statistics.update(_plan_statistics("GEX splitting", plan, cores))
+            stage_statistics["Bytes per GEX read pair"] = round(pair_bytes)
+        cache.save("split", split_key, split_outputs, stage_statistics)
+    else:
+        stage_statistics = entry["statistics"]
+        timer.skip("split", stage_statistics["GEX total read pairs"])
+    statistics.update(stage_statistics)
+    save_statistics(statistics, output=args.output, libname=lib)
+    timer.save()
+    return statistics
+
+
+def _prescan_gex(lib, config, args, pool, timer, barcode_fastqs, memory=None):
+    """
+    Run the GEX prescan of a library as its own step and return its statistics.
+    """
+    logger = logging.getLogger(__name__)
+    plan = {"chunk_size": args.chunk_size, "threads": len(barcode_fastqs),
+            "prefetch_blocks": PREFETCH_BLOCKS, "memory": 0}
+    if memory:
+        # The interpreter and libraries are counted by the steps running alongside
+        plan = plan_chunks("extract", memory + FIXED_BYTES, record_bytes(barcode_fastqs[0]),
+                           args.chunk_size, min(len(barcode_fastqs), args.threads),
+                           lanes=len(barcode_fastqs))
+        plan["memory"] -= FIXED_BYTES
+    with pool.acquire(cores=plan["threads"], memory=plan["memory"], min_cores=1) as cores, \
+            timer.stage("prescan") as record:
+        logger.info("Prescanning GEX cell barcodes of %s on %d cores", lib, cores)
+        reads = prescan_gex(lib, config, args.output, plan["chunk_size"], thread=cores,
+                            prefetch_blocks=plan["prefetch_blocks"])
+        record["reads"] = reads
+    statistics = OrderedDict()
+    statistics["GEX prescanned reads"] = reads
+    if memory:
+        statistics.update(_plan_statistics("GEX prescan", plan, cores))
+    return statistics
+
+
+def _plan_statistics(step, plan, cores):
+    """
+    Report the sizes chosen for a step within the memory budget. Fewer
+    cores than planned may have been free, which only lowers its memory.
+    """
+    return OrderedDict([(f"{step} chunk size", plan["chunk_size"]),
+                        (f"{step} threads", cores),
+                        (f"{step} read-ahead blocks", plan["prefetch_blocks"]),
+                        (f"{step} memory estimate (MB)", round(plan["memory"] / 1024 ** 2))])
+
+
 if __name__ == "__main__":
     main()
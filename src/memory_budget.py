@@ -0,0 +1,106 @@
+import gzip
+import logging
+from src.prefetch import PREFETCH_BLOCKS
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks read from FASTQ files (see read_fastq_chunks).
+BLOCK_SIZE = 1 << 22
+# Memory of a stage that does not scale with its chunks: interpreter,
+# libraries, output buffers.
+FIXED_BYTES = 200 * 1024 ** 2
+# Peak memory per byte of the FASTQ records in a chunk, measured on
+# synthetic libraries: the raw chunk, its line offsets and the arrays
+# derived from it while it is processed, plus, for the GEX split, the
+# chunks in flight on every worker with their routed records.
+CHUNK_FACTORS = {"extract": 4.5, "split": 5.0}
+IN_FLIGHT_FACTOR = 4.0
+# Output buffers and compression tasks in flight per thread of the GEX split.
+COMPRESSION_BYTES = 8 * 1024 ** 2
+# Rough peak memory per read pair of in-memory UMI deduplication: the packed
+# columns, the sample labels and the sorted keys.
+DEDUP_BYTES_PER_READ = 64
+# Chunks are not made smaller than this, whatever the budget.
+MIN_CHUNK_SIZE = 20000
+
+
+def record_bytes(path, sample_size=1 << 20):
+    """
+    Average size in bytes of the FASTQ records in the first `sample_size`
+    bytes of a (gzipped) file.
+    """
+    open_func = gzip.open if path.endswith(".gz") else open
+    with open_func(path, "rb") as f:
+        sample = f.read(sample_size)
+    records = sample.count(b"\n") // 4
+    return len(sample) / records if records else len(sample) or 1
+
+
+def estimate_chunk_memory(stage, chunk_size, pair_bytes, threads, prefetch_blocks, lanes=1):
+    """
+    Estimate the peak memory in bytes of the extract or split stage when it
+    runs on `threads` with chunks of `chunk_size` read pairs of `pair_bytes`.
+    Lanes are processed in parallel up to the number of threads.
+    """
+    parallel_lanes = min(lanes, threads)
+    per_lane = 2 * prefetch_blocks * BLOCK_SIZE + chunk_size * pair_bytes * CHUNK_FACTORS[stage]
+    if stage == "split":
+        # The threads of a lane beyond the first route chunks in parallel
+        workers = threads // parallel_lanes - 1
+        if workers > 1:
+            per_lane += workers * chunk_size * pair_bytes * IN_FLIGHT_FACTOR
+    fixed = FIXED_BYTES + (threads * COMPRESSION_BYTES if stage == "split" else 0)
+    return fixed + parallel_lanes * per_lane
+
+
+def plan_chunks(stage, budget, pair_bytes, chunk_size, threads, lanes=1):
+    """
+    Choose the chunk size, threads and read-ahead blocks of the extract or
+    split stage so that its estimated memory stays within `budget` bytes.
+
+    The largest chunk up to `chunk_size` is taken with as many threads and
+    blocks as possible; read-ahead and then threads are given up before
+    chunks shrink below MIN_CHUNK_SIZE. Returns a dictionary with the
+    chosen `chunk_size`, `threads`, `prefetch_blocks` and estimated `memory`.
+    """
+    for n_threads in range(threads, 0, -1):
+        for blocks in sorted({PREFETCH_BLOCKS, 2, 1}, reverse=True):
+            fixed = estimate_chunk_memory(stage, 0, pair_bytes, n_threads, blocks, lanes)
+            per_read = estimate_chunk_memory(stage, 1, pair_bytes, n_threads, blocks, lanes) - fixed
+            size = min(chunk_size, int((budget - fixed) // per_read)) if budget > fixed else 0
+            if size >= min(MIN_CHUNK_SIZE, chunk_size):
+                return {"chunk_size": size, "threads": n_threads, "prefetch_blocks": blocks,
+                        "memory": estimate_chunk_memory(stage, size, pair_bytes, n_threads,
+                                                        blocks, lanes)}
+    size = min(MIN_CHUNK_SIZE, chunk_size)
+    memory = estimate_chunk_memory(stage, size, pair_bytes, 1, 1, lanes)
+    logger.warning("The %s stage needs about %d MB, more than its memory budget of %d MB",
+                   stage, memory // 1024 ** 2, budget // 1024 ** 2)
+    return {"chunk_size": size, "threads": 1, "prefetch_blocks": 1, "memory": memory}
+
+
+def streaming_chunk_size(budget, chunk_size):
+    """
+    Chunk size, up to `chunk_size`, of streaming UMI deduplication within
+    `budget` bytes: the reads of a chunk take a quarter of it, but chunks do
+    not shrink below MIN_CHUNK_SIZE.
+    """
+    return max(min(chunk_size, budget // 4 // DEDUP_BYTES_PER_READ),
+               min(MIN_CHUNK_SIZE, chunk_size))
+
+
+def plan_deduplication(budget, reads, chunk_size):
+    """
+    Deduplicate in memory when the library fits into `budget` bytes, and
+    otherwise stream it with half of the budget for unique keys and chunks
+    sized to a quarter of it. Returns a dictionary with the streaming
+    `memory_budget` (None in memory), the `chunk_size` and the estimated
+    `memory`.
+    """
+    if DEDUP_BYTES_PER_READ * reads <= budget:
+        return {"memory_budget": None, "chunk_size": chunk_size,
+                "memory": DEDUP_BYTES_PER_READ * reads}
+    return {"memory_budget": budget // 2,
+            "chunk_size": streaming_chunk_size(budget, chunk_size),
+            "memory": budget}
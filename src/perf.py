@@ -0,0 +1,163 @@
+import contextlib
+import cProfile
+import csv
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two samples of the resident set size
+RSS_INTERVAL = 0.05
+FIELDS = ["stage", "cached", "reads", "wall_seconds", "cpu_seconds", "reads_per_sec",
+          "peak_rss_mb", "read_bytes", "write_bytes"]
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, or None where /proc is not
+    available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def max_rss():
+    """
+    Peak resident set size of this process so far, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def io_counters():
+    """
+    Bytes this process passed through read() and write() calls, including
+    reads served by the page cache (`rchar` and `wchar` of /proc/self/io).
+    Empty where /proc is not available.
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        return {}
+    return {"read_bytes": counters.get("rchar", 0), "write_bytes": counters.get("wchar", 0)}
+
+
+def cpu_time():
+    """
+    CPU time of this process and its finished child processes, in seconds.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class _RSSMonitor(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss() or 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, current_rss() or 0)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss() or 0)
+        return self.peak
+
+
+class StageTimer:
+    """
+    Record wall time, CPU time, peak RSS, bytes read and written and reads/sec
+    of the stages of one library, and save them as
+    `{libname}_performance.json` and `.csv`.
+
+    CPU time and I/O are counted for the whole process (worker processes are
+    included once they have exited), so they overlap between libraries
+    processed at the same time. With `profile`, every stage is also profiled
+    with cProfile into `{libname}_{stage}.prof`, which covers the thread
+    running the stage.
+    """
+
+    def __init__(self, libname, output, profile=False):
+        self.libname = libname
+        self.output = output
+        self.profile = profile
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure the `with` block as stage `name`. The block receives the
+        stage's record, where it can set the number of `reads` processed.
+        """
+        record = {"stage": name, "cached": False, "reads": None}
+        monitor = _RSSMonitor() if current_rss() is not None else None
+        if monitor is not None:
+            monitor.start()
+        profiler = cProfile.Profile() if self.profile else None
+        io_start, cpu_start, wall_start = io_counters(), cpu_time(), time.perf_counter()
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Only one profiler can be active at a time on Python 3.12+
+                logger.warning("Cannot profile stage %s of %s while another stage is "
+                               "profiled", name, self.libname)
+                profiler = None
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = time.perf_counter() - wall_start
+            record["wall_seconds"] = round(wall, 3)
+            record["cpu_seconds"] = round(cpu_time() - cpu_start, 3)
+            record["reads_per_sec"] = round(record["reads"] / wall) \
+                if record["reads"] and wall > 0 else None
+            peak = monitor.stop() if monitor is not None else max_rss()
+            record["peak_rss_mb"] = round(peak / 1024 ** 2, 1)
+            io_end = io_counters()
+            for key in ("read_bytes", "write_bytes"):
+                record[key] = io_end[key] - io_start[key] if io_end else None
+            self.stages.append(record)
+            logger.debug("Stage %s of %s: %s", name, self.libname, record)
+            if profiler is not None:
+                path = os.path.join(self.output, f"{self.libname}_{name}.prof")
+                profiler.dump_stats(path)
+                logger.info("Saved profile of stage %s to %s", name, path)
+
+    def skip(self, name, reads=None):
+        """
+        Record stage `name` as reused from a previous run.
+        """
+        record = dict.fromkeys(FIELDS)
+        record.update(stage=name, cached=True, reads=reads)
+        self.stages.append(record)
+
+    def save(self):
+        """
+        Write the recorded stages as JSON and CSV next to the statistics.
+        """
+        path = os.path.join(self.output, f"{self.libname}_performance")
+        with open(path + ".json", "w") as f:
+            json.dump({"library": self.libname, "stages": self.stages}, f, indent=2)
+        with open(path + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(self.stages)
@@ -0,0 +1,166 @@
+import logging
+import os
+from collections import OrderedDict
+import numpy as np
+from src.config_validator import validate_config, fastq_lanes
+from src.fastq_loader import extract_reads, load_fastq
+from src.memory_budget import streaming_chunk_size
+from src.demultiplexer import (categorize_reads_by_hto, deduplicate_umi, filter_cellbarcodes,
+                               split_GEX_fastqs, decode_cellbarcodes, AMBIGUOUS)
+
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryResult:
+    """
+    Results of one HTO library: its `statistics` (as written to
+    `<library>_statistics.csv`), the HTOCountMatrix of unique UMIs and the
+    `filtered_barcodes` dataframe of sample, cell barcode and UMI count.
+    """
+
+    def __init__(self, statistics, matrix, filtered_barcodes):
+        self.statistics = statistics
+        self.matrix = matrix
+        self.filtered_barcodes = filtered_barcodes
+
+
+class Pipeline:
+    """
+    Run scHTO in-process on a loaded configuration, e.g. from a long-lived
+    worker that demultiplexes library after library.
+
+    The steps of the `schto` command run one after another and pass the
+    extracted reads, HTO labels, count matrix and filtered barcodes on as
+    arrays and dataframes. Only the demultiplexed GEX FASTQs are written, to
+    `output`; without an output directory the GEX libraries are not split.
+    With `persist`, the intermediate files and statistics of the command
+    line are saved to `output` as well. Steps are not cached between runs.
+    Options are named like those of the command line.
+    """
+
+    def __init__(self, config, output=None, threads=1, chunk_size=1000000,
+                 hto_hamming_distance=0, dedup_memory=None, compression_level=6, persist=False,
+                 gzip_index=False):
+        validate_config(config)
+        if persist and output is None:
+            raise ValueError("Persisting intermediates needs an output directory")
+        self.config = config
+        self.output = output
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.hto_hamming_distance = hto_hamming_distance
+        self.dedup_memory = dedup_memory
+        self.compression_level = compression_level
+        self.persist = persist
+        self.gzip_index = gzip_index
+
+    @property
+    def libraries(self):
+        return list(fastq_lanes(self.config["libraries_with_HTOs"]))
+
+    def run(self, libraries=None):
+        """
+        Process the given HTO libraries (all by default) one after another.
+        Returns {libname: LibraryResult}.
+        """
+        return {lib: self.run_library(lib) for lib in (libraries or self.libraries)}
+
+    def run_library(self, libname):
+        """
+        Process one HTO library and split its GEX library. Returns a
+        LibraryResult.
+        """
+        config = self.config
+        files = fastq_lanes(config["libraries_with_HTOs"])[libname]
+        if "R1" not in files or "R2" not in files:
+            raise ValueError(f"Missing R1 or R2 for library {libname}")
+        saved = self.output if self.persist else None
+        if self.output is not None:
+            os.makedirs(self.output, exist_ok=True)
+        statistics = OrderedDict()
+        statistics["Library name"] = libname
+        statistics["HTO R1 FASTQ"] = ";".join(files["R1"])
+        statistics["HTO R2 FASTQ"] = ";".join(files["R2"])
+
+        if self.persist:
+            # The steps below map the reads from the column store
+            reads = None
+            load_fastq(libname, files["R1"], files["R2"], config, thread=self.threads,
+                       chunk_size=self.chunk_size, output=self.output, statistics=statistics,
+                       gzip_index=self.gzip_index)
+        else:
+            reads = extract_reads(libname, files["R1"], files["R2"], config,
+                                  thread=self.threads, chunk_size=self.chunk_size,
+                                  gzip_index=self.gzip_index)
+            statistics["Total read pair"] = len(reads["hto"])
+
+        samples, hto_labels = categorize_reads_by_hto(
+            libname, config, thread=1, chunk_size=self.chunk_size, output=saved,
+            hamming_distance=self.hto_hamming_distance, reads=reads)
+        statistics.update(hto_statistics(samples, hto_labels, self.hto_hamming_distance))
+
+        budget = self.dedup_memory * 1024 ** 2 if self.dedup_memory else None
+        matrix = deduplicate_umi(
+            samples, hto_labels, libname, config, thread=1,
+            chunk_size=streaming_chunk_size(budget, self.chunk_size) if budget
+            else self.chunk_size,
+            output=saved, memory_budget=budget, reads=reads)
+        statistics.update(umi_statistics(samples, matrix))
+
+        filtered_df = filter_cellbarcodes(matrix, config, libname, saved)
+        statistics.update(filter_statistics(samples, filtered_df))
+
+        if self.output is not None:
+            statistics.update(split_GEX_fastqs(
+                libname, config, filtered_df, self.output, chunk_size=self.chunk_size,
+                statistics=OrderedDict(), thread=self.threads,
+                compresslevel=self.compression_level, gzip_index=self.gzip_index))
+        if self.persist:
+            save_statistics(statistics, self.output, libname)
+        logger.info("Finished processing library %s", libname)
+        return LibraryResult(statistics, matrix, decode_cellbarcodes(filtered_df, config))
+
+
+def hto_statistics(samples, hto_labels, hamming_distance=0):
+    """
+    Statistics of the HTO labels of the reads.
+    """
+    statistics = OrderedDict()
+    hto_counts = np.bincount(hto_labels[hto_labels >= 0], minlength=len(samples))
+    statistics["Valid HTOs"] = int(hto_counts.sum())
+    for sample, count in zip(samples, hto_counts):
+        statistics[f"{sample} HTOs"] = int(count)
+    if hamming_distance:
+        statistics["Ambiguous HTOs"] = int(np.count_nonzero(hto_labels == AMBIGUOUS))
+    return statistics
+
+
+def umi_statistics(samples, matrix):
+    """
+    Statistics of the unique cell barcodes and UMIs in the count matrix.
+    """
+    statistics = OrderedDict()
+    sample_totals = matrix.sample_totals()
+    statistics["Unique barcodes and UMIs"] = int(sample_totals.sum())
+    for sample, total in zip(samples, sample_totals):
+        statistics[f"Unique barcodes and UMIs of {sample}"] = int(total)
+    return statistics
+
+
+def filter_statistics(samples, filtered_df):
+    """
+    Statistics of the filtered cell barcodes.
+    """
+    statistics = OrderedDict()
+    statistics["Filtered barcodes"] = int(filtered_df.shape[0])
+    for sample in samples:
+        statistics[f"Filtered barcodes of {sample}"] = \
+            int((filtered_df["sample"] == sample).sum())
+    return statistics
+
+
+def save_statistics(statistics, output, libname):
+    with open(os.path.join(output, f"{libname}_statistics.csv"), "w") as f:
+        for k, v in statistics.items():
+            print(",".join([k, str(v)]), file=f)
@@ -0,0 +1,96 @@
+import gzip
+import queue
+import threading
+
+
+# Blocks read ahead of the consumer per file; together with the block size
+# of read_fastq_chunks this bounds the memory of the read-ahead.
+PREFETCH_BLOCKS = 4
+# Seconds between checks for a shutdown while the queue is full or empty.
+_POLL_INTERVAL = 0.1
+
+
+class PrefetchReader:
+    """
+    Read a (gzipped) file in blocks on a background thread, ahead of the
+    consumer.
+
+    The thread decompresses up to `depth` blocks of `block_size` bytes into a
+    bounded queue and waits while it is full, so decompression (which
+    releases the GIL) overlaps with parsing the previous blocks. `read()`
+    hands out the blocks in order; an error of the thread is raised there.
+    Closing the reader, also when the consumer stops early, stops the thread.
+
+    `path` is a file name or an object whose `open()` returns a binary file,
+    such as a `src.gzip_index.FastqRange`.
+    """
+
+    def __init__(self, path, block_size=1 << 22, depth=PREFETCH_BLOCKS):
+        self.path = path
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.pending = b""
+        self.eof = False
+        self.thread = threading.Thread(target=self._run, name=f"prefetch-{path}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            if hasattr(self.path, "open"):
+                f = self.path.open()
+            else:
+                f = (gzip.open if self.path.endswith(".gz") else open)(self.path, "rb")
+            with f:
+                while not self.stopped.is_set():
+                    block = f.read(self.block_size)
+                    self._put(block)
+                    if not block:
+                        break
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _next_block(self):
+        while True:
+            try:
+                item = self.blocks.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                if not self.thread.is_alive() and self.blocks.empty():
+                    raise ValueError(f"Prefetching {self.path} stopped unexpectedly")
+                continue
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+    def read(self, size=-1):
+        """
+        Return up to `size` bytes (at most one block), or b"" at the end of
+        the file.
+        """
+        if self.stopped.is_set():
+            raise ValueError(f"Read from closed PrefetchReader of {self.path}")
+        if not self.pending and not self.eof:
+            self.pending = self._next_block()
+            self.eof = not self.pending
+        if size is None or size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
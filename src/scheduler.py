@@ -0,0 +1,142 @@
+import concurrent.futures
+import contextlib
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Name of the library whose pipeline runs in the current thread.
+_current_library = threading.local()
+
+
+class ResourcePool:
+    """
+    Global budget of cores and memory (in bytes) shared by the pipelines of
+    all libraries. Every stage acquires the slots it needs for as long as it
+    runs, so a library waiting for a large stage does not hold cores it is
+    not using.
+    """
+
+    def __init__(self, cores, memory=None):
+        self.cores = max(1, cores)
+        self.memory = memory
+        self.free_cores = self.cores
+        self.free_memory = memory
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def acquire(self, cores=1, memory=0, min_cores=None):
+        """
+        Wait until the requested slots are free and hold them within the
+        `with` block, which receives the number of cores granted.
+
+        With `min_cores`, the stage starts as soon as that many cores are free
+        and gets up to `cores` of them. Requests larger than the whole budget
+        are capped, so such a stage runs alone instead of waiting forever.
+        """
+        cores = min(cores, self.cores)
+        min_cores = min(min_cores or cores, cores)
+        memory = min(memory, self.memory) if self.memory is not None else 0
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.free_cores >= min_cores and
+                (self.memory is None or self.free_memory >= memory))
+            granted = min(cores, self.free_cores)
+            self.free_cores -= granted
+            if self.memory is not None:
+                self.free_memory -= memory
+        logger.debug("Acquired %d cores and %d bytes", granted, memory)
+        try:
+            yield granted
+        finally:
+            with self.condition:
+                self.free_cores += granted
+                if self.memory is not None:
+                    self.free_memory += memory
+                self.condition.notify_all()
+
+
+class LibraryLogFilter(logging.Filter):
+    """
+    Tag log records with the library processed by the emitting thread
+    (`%(libname)s`). With a `libname`, only that library's records pass.
+    """
+
+    def __init__(self, libname=None):
+        super().__init__()
+        self.libname = libname
+
+    def filter(self, record):
+        record.libname = getattr(_current_library, "name", "-")
+        return self.libname is None or record.libname == self.libname
+
+
+@contextlib.contextmanager
+def library_log(libname, path, formatter=None):
+    """
+    Mark the current thread as processing `libname` and copy its log records
+    into a log file of its own.
+    """
+    handler = logging.FileHandler(path, mode="w")
+    handler.addFilter(LibraryLogFilter(libname))
+    if formatter is not None:
+        handler.setFormatter(formatter)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    _current_library.name = libname
+    try:
+        yield
+    finally:
+        _current_library.name = "-"
+        root.removeHandler(handler)
+        handler.close()
+
+
+def run_libraries(libraries, process_library, parallel_libraries):
+    """
+    Run `process_library(libname, item)` for every item of the `libraries`
+    dictionary, up to `parallel_libraries` at a time. A library that fails
+    is logged and does not stop the others. Returns {libname: result}.
+    """
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(parallel_libraries, len(libraries)))) as executor:
+        futures = {executor.submit(process_library, lib, item): lib
+                   for lib, item in libraries.items()}
+        for future in concurrent.futures.as_completed(futures):
+            lib = futures[future]
+            try:
+                results[lib] = future.result()
+            except Exception:
+                logger.exception("Processing library %s failed", lib)
+    return results
+
+
+def run_lanes(lanes, process_lane, workers):
+    """
+    Run `process_lane(lane)` for every item of `lanes` on up to `workers`
+    threads, which log as the library of the calling thread. Returns the
+    results in lane order; an exception of any lane is raised.
+    """
+    if workers <= 1 or len(lanes) <= 1:
+        return [process_lane(lane) for lane in lanes]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(lanes))) as executor:
+        return list(executor.map(in_library(process_lane), lanes))
+
+
+def in_library(function):
+    """
+    Wrap `function` so that, when it is called on another thread, it logs as
+    the library of the thread that wrapped it.
+    """
+    libname = getattr(_current_library, "name", "-")
+
+    def run(*args, **kwargs):
+        _current_library.name = libname
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current_library.name = "-"
+
+    return run
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Part of every stage key; bump it when the outputs of a stage change so that
+# manifests of older versions are not reused.
+CACHE_VERSION = 3
+
+
+def file_signature(path):
+    """
+    Identify a file by its absolute path, inode, size and modification time.
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def _to_json(value):
+    # NumPy scalars in statistics
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Cannot store {type(value).__name__} in a stage manifest")
+
+
+class StageCache:
+    """
+    Manifest of the completed stages of one library, stored next to the
+    outputs as `{libname}_manifest.json`.
+
+    Every stage is recorded under a key hashed from its inputs: the signature
+    of the input files, the config sections the stage depends on and the key
+    of the stage it builds on, so a change invalidates all later stages. A
+    stage is reused while its key is unchanged and its outputs still have the
+    signature they had when the stage completed. The manifest is rewritten
+    after every stage, so an interrupted run resumes after the last completed
+    stage.
+    """
+
+    def __init__(self, output, libname, enabled=True):
+        self.path = os.path.join(output, f"{libname}_manifest.json")
+        self.libname = libname
+        self.enabled = enabled
+        self.stages = {}
+        if enabled and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.stages = json.load(f)
+            except ValueError:
+                logger.warning("Ignoring unreadable stage manifest %s", self.path)
+
+    @staticmethod
+    def key(stage, parent=None, files=(), **params):
+        """
+        Hash the inputs of a stage into its key.
+        """
+        inputs = {"version": CACHE_VERSION, "stage": stage, "parent": parent,
+                  "files": [file_signature(path) for path in files], "params": params}
+        encoded = json.dumps(inputs, sort_keys=True, default=_to_json).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def load(self, stage, key):
+        """
+        Return the manifest entry of a completed stage with the given key, or
+        None if the stage has to be run.
+        """
+        entry = self.stages.get(stage)
+        if not self.enabled or entry is None or entry["key"] != key:
+            return None
+        for path, signature in entry["outputs"].items():
+            if not os.path.exists(path) or file_signature(path) != signature:
+                return None
+        logger.info("Reusing the %s stage of %s from a previous run", stage, self.libname)
+        return entry
+
+    def save(self, stage, key, outputs, statistics=None, **extra):
+        """
+        Record a completed stage with its output files, the statistics it
+        produced and any extra values needed to reuse it.
+        """
+        if not self.enabled:
+            return
+        self.stages[stage] = dict(extra, key=key,
+                                  outputs={path: file_signature(path) for path in outputs},
+                                  statistics=dict(statistics or {}))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.stages, f, indent=2, default=_to_json)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,112 @@
+import logging
+import os
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class UMIDeduplicator:
+    """
+    Collect unique (sample, cell barcode, UMI) triples within a memory budget.
+
+    Each cell barcode and UMI pair is fused into one uint64 key, kept in
+    sorted, duplicate-free runs per sample. When the buffered keys exceed the
+    budget, the runs are merged in memory and, if they are still too large,
+    spilled as sorted `.npy` runs to `tmpdir`. `counts()` then merges all runs
+    per sample, one key range at a time, into unique UMI counts per barcode.
+    """
+
+    def __init__(self, n_samples, cb_length, umi_length, memory_budget, tmpdir):
+        if 2 * (cb_length + umi_length) > 64:
+            raise ValueError("Cell barcode and UMI do not fit into a 64-bit key")
+        self.umi_bits = 2 * umi_length
+        self.memory_budget = memory_budget
+        self.tmpdir = tmpdir
+        self.buffers = [[] for _ in range(n_samples)]
+        self.runs = [[] for _ in range(n_samples)]
+        self.buffered_bytes = 0
+        self.n_spills = 0
+
+    def add(self, labels, cell_barcodes, umis):
+        """
+        Add a chunk of reads given as sample labels and packed barcodes and
+        UMIs; reads with a negative label are ignored.
+        """
+        assigned = labels >= 0
+        labels = labels[assigned]
+        keys = ((cell_barcodes[assigned].astype(np.uint64) << np.uint64(self.umi_bits))
+                | umis[assigned].astype(np.uint64))
+        # Group the keys by sample with one sort instead of a scan per sample
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(len(self.buffers) + 1))
+        for sample, buffer in enumerate(self.buffers):
+            sample_keys = np.unique(keys[order[bounds[sample]:bounds[sample + 1]]])
+            if len(sample_keys):
+                buffer.append(sample_keys)
+                self.buffered_bytes += sample_keys.nbytes
+        if self.buffered_bytes > self.memory_budget:
+            self._consolidate()
+
+    def _consolidate(self):
+        self.buffers = [[np.unique(np.concatenate(buffer))] if buffer else []
+                        for buffer in self.buffers]
+        self.buffered_bytes = sum(buffer[0].nbytes for buffer in self.buffers if buffer)
+        if self.buffered_bytes > self.memory_budget // 2:
+            self._spill()
+
+    def _spill(self):
+        for sample, buffer in enumerate(self.buffers):
+            if buffer:
+                path = os.path.join(self.tmpdir, f"run_{sample}_{len(self.runs[sample])}.npy")
+                np.save(path, buffer[0])
+                self.runs[sample].append(path)
+        logger.debug("Spilled %d bytes of unique barcodes and UMIs to %s",
+                     self.buffered_bytes, self.tmpdir)
+        self.buffers = [[] for _ in self.buffers]
+        self.buffered_bytes = 0
+        self.n_spills += 1
+
+    def counts(self):
+        """
+        Yield (sample, cell_barcodes, umi_counts) with the barcodes of each
+        sample in ascending order, possibly split over several yields.
+        """
+        if self.buffered_bytes:
+            self._consolidate()
+        for sample in range(len(self.buffers)):
+            runs = [np.load(path, mmap_mode='r') for path in self.runs[sample]]
+            runs += self.buffers[sample]
+            for lo, hi in self._key_ranges(runs):
+                keys = np.unique(np.concatenate([_key_slice(run, lo, hi) for run in runs]))
+                if len(keys):
+                    barcodes, umi_counts = np.unique(keys >> np.uint64(self.umi_bits),
+                                                     return_counts=True)
+                    yield sample, barcodes, umi_counts
+
+    def _key_ranges(self, runs):
+        """
+        Split the key space of the runs into ranges of roughly half the memory
+        budget. Range bounds fall on cell barcode boundaries, so all UMIs of a
+        barcode are merged together.
+        """
+        total_bytes = sum(run.nbytes for run in runs)
+        n_ranges = max(1, -(-2 * total_bytes // max(self.memory_budget, 1)))
+        bounds = [np.uint64(0)]
+        if n_ranges > 1:
+            step = max(1, sum(len(run) for run in runs) // (n_ranges * 64))
+            sampled = np.sort(np.concatenate([np.asarray(run[::step]) for run in runs]))
+            quantiles = sampled[np.linspace(0, len(sampled), n_ranges + 1, dtype=int)[1:-1]]
+            barcode_mask = ~np.uint64((1 << self.umi_bits) - 1)
+            bounds += list(np.unique(quantiles & barcode_mask))
+        bounds = sorted(set(bounds))
+        # The last range is open-ended so that it also covers the maximum key
+        yield from zip(bounds, bounds[1:] + [None])
+
+
+def _key_slice(run, lo, hi):
+    """
+    Return the keys of a sorted run within [lo, hi); hi=None means no upper bound.
+    """
+    end = len(run) if hi is None else np.searchsorted(run, hi)
+    return run[np.searchsorted(run, lo):end]
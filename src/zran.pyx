@@ -0,0 +1,93 @@
+# zran.pyx
+# cython: boundscheck=False, wraparound=False, nonecheck=False, language_level=3
+"""
+Thin wrapper of zlib's inflate for random access into gzip files, after the
+zran.c example of zlib.
+
+Python's zlib module cannot stop at deflate block boundaries or resume a
+stream at a bit offset, which checkpoints of a gzip index need. Inflating
+releases the GIL, so ranges of one file are decompressed in parallel.
+"""
+from libc.string cimport memset
+
+cdef extern from "zlib.h":
+    ctypedef struct z_stream:
+        const unsigned char *next_in
+        unsigned int avail_in
+        unsigned char *next_out
+        unsigned int avail_out
+        int data_type
+    int inflateInit2(z_stream *strm, int windowBits)
+    int inflateReset2(z_stream *strm, int windowBits)
+    int inflate(z_stream *strm, int flush) nogil
+    int inflateEnd(z_stream *strm)
+    int inflatePrime(z_stream *strm, int bits, int value)
+    int inflateSetDictionary(z_stream *strm, const unsigned char *dictionary,
+                             unsigned int dictLength)
+    int Z_OK, Z_STREAM_END, Z_BUF_ERROR, Z_NEED_DICT, Z_NO_FLUSH, Z_BLOCK
+
+
+cdef class Inflater:
+    """
+    An inflate stream: `wbits` 31 reads a gzip member, -15 raw deflate data.
+    """
+    cdef z_stream strm
+    cdef bint ready
+
+    def __cinit__(self, int wbits=31):
+        memset(&self.strm, 0, sizeof(z_stream))
+        if inflateInit2(&self.strm, wbits) != Z_OK:
+            raise MemoryError("Cannot initialize zlib inflate")
+        self.ready = True
+
+    def __dealloc__(self):
+        if self.ready:
+            inflateEnd(&self.strm)
+
+    def reset(self, int wbits=31):
+        """
+        Start a new stream, e.g. the next member of a gzip file.
+        """
+        if inflateReset2(&self.strm, wbits) != Z_OK:
+            raise ValueError("Cannot reset zlib inflate")
+
+    def resume(self, int bits, int value, const unsigned char[::1] window):
+        """
+        Continue a raw stream from a checkpoint: insert the `bits` unused
+        high bits of the byte before it (`value`) and the preceding output.
+        """
+        if bits and inflatePrime(&self.strm, bits, value >> (8 - bits)) != Z_OK:
+            raise ValueError("Cannot resume zlib inflate")
+        if window.shape[0] and inflateSetDictionary(
+                &self.strm, &window[0], <unsigned int>window.shape[0]) != Z_OK:
+            raise ValueError("Cannot resume zlib inflate")
+
+    @property
+    def data_type(self):
+        """
+        zlib's data_type after the last call: the number of unused bits in
+        the last input byte, +128 at the end of a deflate block, +64 if it
+        was the last block of the stream.
+        """
+        return self.strm.data_type
+
+    def inflate(self, const unsigned char[::1] data, unsigned char[::1] out, bint block=False):
+        """
+        Inflate `data` into `out` until either is exhausted, the stream ends
+        or, with `block`, a deflate block ends. Returns (consumed, produced,
+        stream_end).
+        """
+        cdef int ret
+        cdef unsigned int avail_in = data.shape[0], avail_out = out.shape[0]
+        if avail_in == 0 or avail_out == 0:
+            return 0, 0, False
+        self.strm.next_in = &data[0]
+        self.strm.avail_in = avail_in
+        self.strm.next_out = &out[0]
+        self.strm.avail_out = avail_out
+        with nogil:
+            ret = inflate(&self.strm, Z_BLOCK if block else Z_NO_FLUSH)
+        if ret == Z_NEED_DICT or (ret != Z_OK and ret != Z_STREAM_END and ret != Z_BUF_ERROR):
+            raise ValueError("Invalid gzip data")
+        return (avail_in - self.strm.avail_in, avail_out - self.strm.avail_out,
+                ret == Z_STREAM_END)
@@ -0,0 +1,66 @@
+import pytest
+
+
+def _write_fastq(path, reads):
+    with open(path, "w") as f:
+        for i, seq in enumerate(reads):
+            f.write(f"@read{i}\n{seq}\n+\n{'F' * len(seq)}\n")
+
+
+@pytest.fixture
+def write_fastq():
+    """
+    Writer of the sequences `reads` as an uncompressed FASTQ file:
+    write_fastq(path, reads).
+    """
+    return _write_fastq
+
+
+@pytest.fixture
+def library_config(tmp_path, write_fastq):
+    """
+    Factory of a configuration with small HTO and GEX libraries in `tmp_path`:
+    library_config(libraries=("pool1",), samples=None).
+
+    Every library has the samples given for it in `samples` (by default s1
+    and s2, with HTOs GGAA and TTCC) and cell barcodes of its own: those of
+    the n-th library have their bases shifted n steps along ACGT.
+    """
+    def make(libraries=("pool1",), samples=None):
+        # Cell barcode and UMI on R1, HTO on R2
+        hto_reads = [("AAAA", "ACGT", "GGAA"), ("AAAA", "ACGG", "GGAA"),
+                     ("AAAA", "ACGG", "GGAA"), ("AAAA", "TTTT", "GGAA"),
+                     ("CCCC", "ACGT", "TTCC"), ("CCCC", "CCGT", "TTCC"),
+                     ("GGGG", "ACGT", "GGAA"), ("TTTT", "ACGT", "CAGT"),
+                     ("GGGG", "CCGT", "GGAA")]
+        # AAAT is one mismatch away from AAAA
+        gex_barcodes = ["AAAA", "CCCC", "GGGG", "AAAT", "TTTT"] * 3
+        config = {"libraries_with_HTOs": [], "libraries_to_be_demultiplexed": [],
+                  "HTO_sequences": [], "expected_cell_number": [],
+                  "positions": {
+                      "cell_barcode_R12": "R1", "cell_barcode_start": 1, "cell_barcode_end": 4,
+                      "umi_R12": "R1", "umi_start": 5, "umi_end": 8,
+                      "hto_R12": "R2", "hto_start": 1, "hto_end": 4}}
+        for n, lib in enumerate(libraries):
+            shift = str.maketrans("ACGT", "ACGT"[n % 4:] + "ACGT"[:n % 4])
+            write_fastq(tmp_path / f"{lib}_H_R1.fastq",
+                        [cb.translate(shift) + umi for cb, umi, _ in hto_reads])
+            write_fastq(tmp_path / f"{lib}_H_R2.fastq", [hto for _, _, hto in hto_reads])
+            write_fastq(tmp_path / f"{lib}_G_R1.fastq",
+                        [cb.translate(shift) + "ACGTAC" for cb in gex_barcodes])
+            write_fastq(tmp_path / f"{lib}_G_R2.fastq", ["GATTACA"] * len(gex_barcodes))
+            for R12 in ("R1", "R2"):
+                config["libraries_with_HTOs"].append(
+                    {"htolib_name": lib, "R12": R12,
+                     "path": str(tmp_path / f"{lib}_H_{R12}.fastq")})
+                config["libraries_to_be_demultiplexed"].append(
+                    {"htolib_name": lib, "R12": R12,
+                     "path": str(tmp_path / f"{lib}_G_{R12}.fastq")})
+            for sample, hto in zip((samples or {}).get(lib, ("s1", "s2")), ("GGAA", "TTCC")):
+                config["HTO_sequences"].append(
+                    {"htolib_name": lib, "sample_name": sample, "hto_sequence": hto})
+                config["expected_cell_number"].append(
+                    {"htolib_name": lib, "sample_name": sample, "estimate_number": 1})
+        return config
+
+    return make
@@ -0,0 +1,45 @@
+import random
+import numpy as np
+from src.barcode_index import BarcodeIndex, UNASSIGNED, AMBIGUOUS
+from src.encoding import encode_array
+
+
+def _reference_lookup(barcode_to_sample, barcode):
+    # Exact match first, then the samples of all whitelisted barcodes one
+    # mismatch away, as the former dictionary of neighbours did.
+    if barcode in barcode_to_sample:
+        return barcode_to_sample[barcode]
+    samples = {sample for whitelisted, sample in barcode_to_sample.items()
+               if sum(a != b for a, b in zip(whitelisted, barcode)) == 1}
+    if len(samples) == 1:
+        return samples.pop()
+    return AMBIGUOUS if samples else UNASSIGNED
+
+
+def test_lookup_matches_reference():
+    rng = random.Random(1)
+    for length in (7, 16):
+        whitelist = ["".join(rng.choices("ACGT", k=length)) for _ in range(200)]
+        labels = [rng.randrange(3) for _ in whitelist]
+        barcode_to_sample = dict(zip(whitelist, labels))
+        index = BarcodeIndex(encode_array(whitelist, length), labels, length)
+        queries = ["".join(rng.choices("ACGT", k=length)) for _ in range(1000)]
+        queries += [w[:i] + rng.choice("ACGT") + w[i + 1:]
+                    for w in whitelist for i in (0, length - 1)]
+        expected = [_reference_lookup(barcode_to_sample, q) for q in queries]
+        assert list(index.lookup(encode_array(queries, length))) == expected
+
+
+def test_ambiguity_and_precedence():
+    whitelist = ["AAAA", "AAAT", "CCCC", "CCCG", "AAAA"]
+    index = BarcodeIndex(encode_array(whitelist, 4), [0, 1, 2, 2, 3], 4)
+    queries = ["AAAA", "AAAT", "AAAC", "CCCT", "GGGG", "AANA"]
+    # The repeated AAAA keeps its last label; AAAC is one mismatch away from
+    # two samples, CCCT from two barcodes of the same sample.
+    assert list(index.lookup(encode_array(queries, 4))) == [3, 1, AMBIGUOUS, 2, UNASSIGNED, UNASSIGNED]
+    assert list(index.lookup(encode_array(queries, 4), max_mismatch=0)) == [3, 1] + [UNASSIGNED] * 4
+
+
+def test_empty_whitelist():
+    index = BarcodeIndex(np.empty(0, dtype=np.uint32), [], 4)
+    assert list(index.lookup(encode_array(["AAAA"], 4))) == [UNASSIGNED]
@@ -0,0 +1,21 @@
+import gzip
+import yaml
+from benchmarks.synthetic import generate_dataset
+
+
+def test_generate_dataset(tmp_path):
+    config_path = generate_dataset(str(tmp_path / "a"), 500, n_cells=20, n_samples=2,
+                                   error_rate=0.05, gex_reads=300)
+    generate_dataset(str(tmp_path / "b"), 500, n_cells=20, n_samples=2,
+                     error_rate=0.05, gex_reads=300)
+    config = yaml.safe_load(open(config_path))
+    assert [d["estimate_number"] for d in config["expected_cell_number"]] == [10, 10]
+    for section, n_reads in (("libraries_with_HTOs", 500), ("libraries_to_be_demultiplexed", 300)):
+        for entry in config[section]:
+            data = gzip.open(entry["path"]).read()
+            assert data.count(b"\n") == 4 * n_reads
+            # The generator is deterministic
+            assert data == gzip.open(entry["path"].replace(str(tmp_path / "a"),
+                                                           str(tmp_path / "b"))).read()
+    hto_reads = gzip.open(config["libraries_with_HTOs"][1]["path"]).read().split(b"\n")[1::4]
+    assert sum(read.startswith(b"TTGGCCTTTGTATCG") for read in hto_reads) > 100
@@ -0,0 +1,52 @@
+import concurrent.futures
+import gzip
+import struct
+from src.bgzf import BGZFWriter, BLOCK_SIZE, EOF_BLOCK, open_output, concatenate
+
+
+def _blocks(data):
+    offset = 0
+    while offset < len(data):
+        assert data[offset:offset + 4] == b"\x1f\x8b\x08\x04"
+        bsize = struct.unpack("<H", data[offset + 16:offset + 18])[0]
+        yield data[offset:offset + bsize + 1]
+        offset += bsize + 1
+
+
+def test_bgzf_roundtrip(tmp_path):
+    payload = b"".join(b"@read%d\nACGTACGTAC\n+\nFFFFFFFFFF\n" % i for i in range(100000))
+    path = str(tmp_path / "out.fastq.gz")
+    with BGZFWriter(path, compresslevel=1, threads=3) as writer:
+        writer.write(payload[:12345])
+        writer.write(payload[12345:].decode())
+    data = open(path, "rb").read()
+    assert gzip.decompress(data) == payload
+    blocks = list(_blocks(data))
+    assert blocks[-1] == EOF_BLOCK
+    assert len(blocks) - 1 == -(-len(payload) // BLOCK_SIZE)
+
+
+def test_shared_executor(tmp_path):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        writers = [open_output(str(tmp_path / f"{i}.gz"), threads=2, executor=executor)
+                   for i in range(3)]
+        for i, writer in enumerate(writers):
+            writer.write(b"%d\n" % i * 50000)
+        for writer in writers:
+            writer.close()
+    for i in range(3):
+        assert gzip.open(tmp_path / f"{i}.gz").read() == b"%d\n" % i * 50000
+
+
+def test_concatenate(tmp_path):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f"lane{i}.gz"))
+        with BGZFWriter(paths[-1]) as writer:
+            writer.write(b"%d\n" % i * (BLOCK_SIZE // 2 * i))
+    concatenate(paths, str(tmp_path / "all.gz"))
+    data = open(tmp_path / "all.gz", "rb").read()
+    assert gzip.decompress(data) == b"".join(b"%d\n" % i * (BLOCK_SIZE // 2 * i) for i in range(3))
+    # Only the EOF block of the last lane is kept
+    assert [block == EOF_BLOCK for block in _blocks(data)].count(True) == 1
+    assert data.endswith(EOF_BLOCK)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from src.column_store import (ColumnWriter, column_path, concatenate, open_column, open_columns,
+                              read_header)
+
+
+def test_write_and_map_columns(tmp_path):
+    prefix = str(tmp_path / "pool1_reads")
+    with ColumnWriter(prefix, {"cell_barcode": np.uint64, "hto": np.uint32}) as writer:
+        writer.append({"cell_barcode": np.arange(3), "hto": np.array([7, 8, 9])})
+        writer.append({"cell_barcode": np.arange(3, 5), "hto": np.array([10, 11])})
+    columns = open_columns(prefix, ["cell_barcode", "hto"])
+    assert isinstance(columns["hto"], np.memmap)
+    assert columns["cell_barcode"].dtype == np.uint64
+    assert columns["cell_barcode"].tolist() == [0, 1, 2, 3, 4]
+    assert columns["hto"][1:3].tolist() == [8, 9]
+    assert read_header(column_path(prefix, "hto")) == (np.dtype(np.uint32), 5)
+
+
+def test_empty_and_interrupted_columns(tmp_path):
+    prefix = str(tmp_path / "empty")
+    with ColumnWriter(prefix, {"umi": np.uint32}):
+        pass
+    assert len(open_column(prefix, "umi")) == 0
+    prefix = str(tmp_path / "interrupted")
+    with pytest.raises(RuntimeError):
+        with ColumnWriter(prefix, {"umi": np.uint32}) as writer:
+            writer.append({"umi": np.arange(10)})
+            raise RuntimeError
+    # Rows are only recorded once the store is complete
+    assert len(open_column(prefix, "umi")) == 0
+
+
+def test_rejects_mismatched_and_foreign_files(tmp_path):
+    prefix = str(tmp_path / "reads")
+    with ColumnWriter(prefix, {"a": np.uint32, "b": np.uint32}) as writer:
+        with pytest.raises(ValueError):
+            writer.append({"a": np.arange(2), "b": np.arange(3)})
+    (tmp_path / "other.a.col").write_bytes(b"PAR1" + bytes(100))
+    with pytest.raises(ValueError):
+        open_column(str(tmp_path / "other"), "a")
+
+
+def test_concatenate_stores(tmp_path):
+    prefixes = [str(tmp_path / f"lane{i}") for i in range(3)]
+    for i, prefix in enumerate(prefixes):
+        with ColumnWriter(prefix, {"umi": np.uint32}) as writer:
+            writer.append({"umi": np.arange(i * 10, i * 10 + i)})
+    assert concatenate(prefixes, str(tmp_path / "all"), ["umi"], chunk_size=1) == 3
+    assert open_column(str(tmp_path / "all"), "umi").tolist() == [10, 20, 21]
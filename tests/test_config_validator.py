@@ -2,7 +2,7 @@ import os
 import tempfile
 import yaml
 import pytest
-from config_validator import load_config, ConfigValidationError
+from src.config_validator import load_config, ConfigValidationError, fastq_lanes
 
 
 def test_missing_section():
@@ -21,14 +21,11 @@ def test_valid_config(tmp_path):
             {"htolib_name": "pool1", "R12": "R1", "path": __file__},
             {"htolib_name": "pool1", "R12": "R2", "path": __file__}
         ],
-        "positions": [
-            {"name": "cell_barcode_start", "position": 1, "R12": "R1"},
-            {"name": "cell_barcode_end", "position": 16, "R12": "R1"},
-            {"name": "umi_start", "position": 17, "R12": "R1"},
-            {"name": "umi_end", "position": 26, "R12": "R1"},
-            {"name": "hto_start", "position": 1, "R12": "R2"},
-            {"name": "hto_end", "position": 11, "R12": "R2"}
-        ],
+        "positions": {
+            "cell_barcode_R12": "R1", "cell_barcode_start": 1, "cell_barcode_end": 16,
+            "umi_R12": "R1", "umi_start": 17, "umi_end": 26,
+            "hto_R12": "R2", "hto_start": 1, "hto_end": 11
+        },
         "libraries_to_be_demultiplexed": [
             {"htolib_name": "pool1", "R12": "R1", "path": __file__},
             {"htolib_name": "pool1", "R12": "R2", "path": __file__}
@@ -44,4 +41,12 @@ def test_valid_config(tmp_path):
     config_file = tmp_path / "config.yaml"
     config_file.write_text(yaml.dump(config_data))
     config = load_config(str(config_file))
-    assert "libraries_with_HTOs" in config
\ No newline at end of file
+    assert "libraries_with_HTOs" in config
+
+def test_fastq_lanes():
+    entries = [{"htolib_name": "pool1", "R12": "R1", "path": ["L1_R1", "L2_R1"]},
+               {"htolib_name": "pool1", "R12": "R2", "path": "L1_R2"},
+               {"htolib_name": "pool1", "R12": "R2", "path": "L2_R2"},
+               {"htolib_name": "pool2", "R12": "R1", "path": "R1"}]
+    assert fastq_lanes(entries) == {"pool1": {"R1": ["L1_R1", "L2_R1"], "R2": ["L1_R2", "L2_R2"]},
+                                    "pool2": {"R1": ["R1"]}}
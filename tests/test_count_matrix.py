@@ -0,0 +1,57 @@
+import numpy as np
+from src.count_matrix import HTOCountMatrix, count_umis
+from src.encoding import invalid_code
+
+
+def _reads(rng, n, cb_length, umi_length):
+    labels = rng.integers(-2, 3, n).astype(np.int16)
+    cell_barcodes = rng.integers(0, 40, n).astype(np.uint64)
+    umis = rng.integers(0, 8, n).astype(np.uint64)
+    cell_barcodes[:5] = invalid_code(cb_length)
+    umis[5:10] = invalid_code(umi_length)
+    return labels, cell_barcodes, umis
+
+
+def _expected(labels, cell_barcodes, umis, cb_length, umi_length):
+    unique = {(label, cb, umi) for label, cb, umi in zip(labels, cell_barcodes, umis)
+              if label >= 0 and cb != invalid_code(cb_length) and umi != invalid_code(umi_length)}
+    counts = {}
+    for label, cb, _ in unique:
+        counts[(label, cb)] = counts.get((label, cb), 0) + 1
+    return sorted((int(label), int(cb), count) for (label, cb), count in counts.items())
+
+
+def test_count_umis():
+    rng = np.random.default_rng(0)
+    # 16 + 12 nt use the fused key; 20 + 12 nt the lexsort fallback
+    for cb_length, umi_length in ((16, 12), (20, 12)):
+        labels, cell_barcodes, umis = _reads(rng, 3000, cb_length, umi_length)
+        sample_codes, barcodes, counts = count_umis(labels, cell_barcodes, umis,
+                                                    cb_length, umi_length)
+        assert list(zip(sample_codes.tolist(), barcodes.tolist(), counts.tolist())) == \
+            _expected(labels, cell_barcodes, umis, cb_length, umi_length)
+    empty = count_umis(np.empty(0, np.int16), [], [], 16, 12)
+    assert all(len(array) == 0 for array in empty)
+
+
+def test_count_matrix(tmp_path):
+    samples = ["s1", "s2", "s3"]
+    matrix = HTOCountMatrix.from_counts(samples, [0, 0, 0, 1, 1, 0], [7, 3, 5, 3, 9, 1],
+                                        [2, 4, 4, 6, 1, 4], 4)
+    assert matrix.shape == (5, 3) and matrix.nnz == 6
+    assert list(matrix.barcodes) == [1, 3, 5, 7, 9]
+    assert list(matrix.indptr) == [0, 1, 3, 4, 5, 6]
+    assert list(matrix.indices) == [0, 0, 1, 0, 0, 1]
+    assert list(matrix.sample_totals()) == [14, 7, 0]
+    codes, barcodes, counts = matrix.ranked()
+    assert list(zip(codes, barcodes, counts)) == [(1, 3, 6), (0, 1, 4), (0, 3, 4), (0, 5, 4),
+                                                  (0, 7, 2), (1, 9, 1)]
+    # Ties at the cutoff go to the lowest barcode
+    codes, barcodes, counts = matrix.top_barcodes([2, 5, 1])
+    assert list(zip(codes, barcodes, counts)) == [(0, 1, 4), (0, 3, 4), (1, 3, 6), (1, 9, 1)]
+
+    matrix.save(str(tmp_path / "matrix.npz"))
+    loaded = HTOCountMatrix.load(str(tmp_path / "matrix.npz"))
+    assert loaded.samples == samples and loaded.length == 4
+    for name in ("barcodes", "indptr", "indices", "data"):
+        assert np.array_equal(getattr(loaded, name), getattr(matrix, name))
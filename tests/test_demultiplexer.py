@@ -1,48 +1,97 @@
-from src.demultiplexer import extract_fields, deduplicate_umis, categorize_reads_by_hto
+import numpy as np
+from src.encoding import encode_array, decode_array
+from src.column_store import ColumnWriter
+import io
+from src.fastq_loader import extract_information, get_field_positions, read_fastq_chunks
+from src.demultiplexer import (categorize_reads_by_hto, deduplicate_umi, build_hto_table,
+                               assign_hto_labels, UNASSIGNED, AMBIGUOUS)
+
+POSITIONS = {
+    "cell_barcode_R12": "R1", "cell_barcode_start": 1, "cell_barcode_end": 4,
+    "umi_R12": "R1", "umi_start": 5, "umi_end": 8,
+    "hto_R12": "R2", "hto_start": 1, "hto_end": 4,
+}
+
+
+def _write_reads(tmp_path, cell_barcodes, umis, htos):
+    columns = {"cell_barcode": encode_array(cell_barcodes, 4),
+               "umi": encode_array(umis, 4),
+               "hto": encode_array(htos, 4)}
+    with ColumnWriter(str(tmp_path / "pool1_reads"),
+                      {column: array.dtype for column, array in columns.items()}) as writer:
+        writer.append(columns)
 
 
 def test_extract_fields():
     # Create a fake paired read.
-    read_r1 = ("@read1", "ACGTACGTACGTACGTACGTACGT", "+", "FFFFFFFFFFFFFFFFFFFFFFFF")
-    read_r2 = ("@read1", "TTTTCCCCAAAAGGGGTTTT", "+", "FFFFFFFFFFFFFFFFFFFF")
-    # Fake positions: cell barcode from 1-4, UMI from 5-8 in R1, HTO from 1-5 in R2.
-    positions = [
-        {"name": "cell_barcode_start", "position": 1, "R12": "R1"},
-        {"name": "cell_barcode_end", "position": 4, "R12": "R1"},
-        {"name": "umi_start", "position": 5, "R12": "R1"},
-        {"name": "umi_end", "position": 8, "R12": "R1"},
-        {"name": "hto_start", "position": 1, "R12": "R2"},
-        {"name": "hto_end", "position": 5, "R12": "R2"}
-    ]
-    fields = extract_fields((read_r1, read_r2), positions)
-    assert fields["cell_barcode"] == "ACGT"
-    assert fields["UMI"] == "ACGT"
-    # Depending on slicing, the expected HTO might be "TTTTC"
-    assert fields["HTO"].startswith("TTTTC")
-
-
-def test_deduplicate_umis():
-    reads = [
-        {"cell_barcode": "AAAA", "UMI": "UMI1", "HTO": "HTO1"},
-        {"cell_barcode": "AAAA", "UMI": "UMI1", "HTO": "HTO1"},
-        {"cell_barcode": "AAAA", "UMI": "UMI2", "HTO": "HTO1"},
-        {"cell_barcode": "CCCC", "UMI": "UMI3", "HTO": "HTO2"}
-    ]
-    deduped = deduplicate_umis(reads, min_umi=2)
-    assert "AAAA" in deduped
-    assert "CCCC" not in deduped  # Only one unique UMI for CCCC.
-
-
-def test_categorize_reads_by_hto():
-    reads = [
-        {"cell_barcode": "AAAA", "UMI": "UMI1", "HTO": "HTO1"},
-        {"cell_barcode": "CCCC", "UMI": "UMI2", "HTO": "HTO2"},
-        {"cell_barcode": "GGGG", "UMI": "UMI3", "HTO": "HTO1"}
-    ]
-    hto_sequences = [
-        {"htolib_name": "pool1", "sample_name": "sample1", "hto_sequence": "HTO1"},
-        {"htolib_name": "pool1", "sample_name": "sample2", "hto_sequence": "HTO2"}
-    ]
-    categorized = categorize_reads_by_hto(reads, hto_sequences)
-    assert len(categorized["sample1"]) == 2
-    assert len(categorized["sample2"]) == 1
\ No newline at end of file
+    read_r1 = b"@read1\nACGTACGTACGTACGTACGTACGT\n+\nFFFFFFFFFFFFFFFFFFFFFFFF\n"
+    read_r2 = b"@read1\nTTTTCCCCAAAAGGGGTTTT\n+\nFFFFFFFFFFFFFFFFFFFF\n"
+    chunk1 = next(read_fastq_chunks(io.BytesIO(read_r1)))
+    chunk2 = next(read_fastq_chunks(io.BytesIO(read_r2)))
+    # Cell barcode from 1-4, UMI from 5-8 in R1, HTO from 1-5 in R2.
+    positions = dict(POSITIONS, hto_end=5)
+    fields = extract_information(chunk1, chunk2, get_field_positions(positions))
+    assert decode_array(fields["cell_barcode"], 4)[0] == "ACGT"
+    assert decode_array(fields["umi"], 4)[0] == "ACGT"
+    assert decode_array(fields["hto"], 5)[0] == "TTTTC"
+
+
+def test_deduplicate_umis(tmp_path):
+    _write_reads(tmp_path,
+                 cell_barcodes=["AAAA", "AAAA", "AAAA", "CCCC", "GGGG"],
+                 umis=["ACGT", "ACGT", "TTTT", "ACGT", "ACGN"],
+                 htos=["ACAC", "ACAC", "ACAC", "GTGT", "ACAC"])
+    hto_labels = np.array([0, 0, 0, 1, 0], dtype=np.int8)
+    config = {"positions": POSITIONS}
+    matrix = deduplicate_umi(["sample1", "sample2"], hto_labels, "pool1", config,
+                             thread=1, chunk_size=10, output=str(tmp_path))
+    sample_codes, barcodes, umi_counts = matrix.ranked()
+    counts = {(matrix.samples[code], seq): count for code, seq, count in
+              zip(sample_codes, decode_array(barcodes, 4), umi_counts)}
+    # The duplicated UMI is counted once and the UMI with N is dropped.
+    assert counts == {("sample1", "AAAA"): 2, ("sample2", "CCCC"): 1}
+    assert (tmp_path / "pool1_umi_counts.csv").read_text().splitlines() == [
+        "sample,cell_barcode,umi_count", "sample1,AAAA,2", "sample2,CCCC,1"]
+    assert (tmp_path / "pool1_hto_matrix.npz").exists()
+
+
+def test_deduplicate_umis_streaming(tmp_path):
+    rng = np.random.default_rng(1)
+    bases = np.array(list("ACGT"))
+    cell_barcodes = ["".join(rng.choice(bases, 4)) for _ in range(2000)]
+    umis = ["".join(rng.choice(bases, 4)) for _ in range(2000)]
+    _write_reads(tmp_path, cell_barcodes, umis, ["ACAC"] * 2000)
+    hto_labels = rng.integers(-1, 2, 2000).astype(np.int8)
+    config = {"positions": POSITIONS}
+    deduplicate_umi(["sample1", "sample2"], hto_labels, "pool1", config,
+                    thread=1, chunk_size=300, output=str(tmp_path))
+    in_memory = (tmp_path / "pool1_umi_counts.csv").read_text()
+    deduplicate_umi(["sample1", "sample2"], hto_labels, "pool1", config,
+                    thread=1, chunk_size=300, output=str(tmp_path), memory_budget=2000)
+    assert (tmp_path / "pool1_umi_counts.csv").read_text() == in_memory
+
+
+def test_categorize_reads_by_hto(tmp_path):
+    _write_reads(tmp_path,
+                 cell_barcodes=["AAAA", "CCCC", "GGGG", "TTTT"],
+                 umis=["ACGT"] * 4,
+                 htos=["ACAC", "GTGT", "ACAC", "TTTT"])
+    config = {"positions": POSITIONS, "HTO_sequences": [
+        {"htolib_name": "pool1", "sample_name": "sample1", "hto_sequence": "ACAC"},
+        {"htolib_name": "pool1", "sample_name": "sample2", "hto_sequence": "GTGT"}
+    ]}
+    samples, labels = categorize_reads_by_hto("pool1", config, thread=1,
+                                              chunk_size=3, output=str(tmp_path))
+    assert samples == ["sample1", "sample2"]
+    assert list(labels) == [0, 1, 0, UNASSIGNED]
+    assert list(np.bincount(labels[labels >= 0])) == [2, 1]
+
+
+def test_hto_table_hamming_distance():
+    codes, labels = build_hto_table(["AAAA", "AAAT"], 4, hamming_distance=1)
+    reads = encode_array(["AAAA", "AAAT", "CAAA", "AAAC", "CCAT", "GGGG", "AANA"], 4)
+    assigned = assign_hto_labels(reads, codes, labels)
+    # Exact matches win over neighbours; AAAC is one mismatch from both HTOs.
+    assert list(assigned) == [0, 1, 0, AMBIGUOUS, UNASSIGNED, UNASSIGNED, UNASSIGNED]
+    codes, labels = build_hto_table(["AAAA", "AAAT"], 4)
+    assert list(assign_hto_labels(reads, codes, labels)) == [0, 1] + [UNASSIGNED] * 5
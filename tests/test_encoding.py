@@ -0,0 +1,36 @@
+import numpy as np
+from src.encoding import (encode_seq, decode_seq, encode_array, decode_array,
+                          invalid_code, packed_dtype, sequence_matrix)
+
+
+def test_packed_dtype():
+    assert packed_dtype(12) == np.uint32
+    assert packed_dtype(15) == np.uint32
+    assert packed_dtype(16) == np.uint64
+
+
+def test_encode_decode_roundtrip():
+    seqs = ["ACGTACGTACGTACGT", "TTTTTTTTTTTTTTTT", "AAAAAAAAAAAAAAAA"]
+    packed = encode_array(seqs, 16)
+    assert packed.dtype == np.uint64
+    assert list(decode_array(packed, 16)) == seqs
+    assert decode_seq(encode_seq("TTGGCCTTTGTATCG"), 15) == "TTGGCCTTTGTATCG"
+
+
+def test_order_is_lexicographic():
+    seqs = ["GATTACA", "ACGTTTT", "ACGTAAA", "TTTTTTT"]
+    packed = encode_array(seqs, 7)
+    assert list(decode_array(np.sort(packed), 7)) == sorted(seqs)
+
+
+def test_invalid_bases():
+    packed = encode_array(["ACGN", "ACG", "ACGT"], 4)
+    assert packed[0] == invalid_code(4)
+    assert packed[1] == invalid_code(4)
+    assert packed[2] != invalid_code(4)
+    assert decode_array(packed, 4)[0] == "NNNN"
+
+
+def test_encode_matrix_slice():
+    matrix = sequence_matrix(["AAAACCCCGG", "TTTTGGGG"], 10)
+    assert list(decode_array(encode_array(matrix[:, 4:8]), 4)) == ["CCCC", "GGGG"]
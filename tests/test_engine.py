@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+import pytest
+from src import engine
+
+
+def test_set_engine():
+    assert engine.get_engine() == "pandas"
+    assert engine.dataframe_module().__name__ == "pandas"
+    with pytest.raises(ValueError):
+        engine.set_engine("spark")
+    assert engine.get_engine() == "pandas"
+
+
+def test_cli_import_is_lazy():
+    # Dataframe libraries are only imported once a stage needs them
+    code = "import sys, src.main; print('pandas' in sys.modules, 'modin' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert result.stdout.split() == ["False", "False"]
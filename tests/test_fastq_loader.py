@@ -1,8 +1,9 @@
-import os
-from src.fastq_loader import read_fastq_in_chunks
+import io
+import pytest
+from src.fastq_loader import read_fastq_chunks, read_paired_chunks
 
 
-def test_read_fastq_in_chunks(tmp_path):
+def test_read_fastq_chunks(tmp_path):
     # Create a small FASTQ file.
     fastq_content = "\n".join([
         "@read1",
@@ -16,8 +17,108 @@ def test_read_fastq_in_chunks(tmp_path):
     ])
     file_path = tmp_path / "test.fastq"
     file_path.write_text(fastq_content)
-    chunks = list(read_fastq_in_chunks(str(file_path), chunk_size=1))
-    print(chunks)
-    # Should yield one chunk with 2 records.
+    with open(file_path, "rb") as f:
+        chunks = list(read_fastq_chunks(f, chunk_size=1))
+    # Should yield two chunks with 1 record each.
     assert len(chunks) == 2
     assert len(chunks[0]) == 1
+    # The last record is terminated even though the file is not.
+    assert chunks[1].record_bytes([0]) == b"@read2\nTGCACTGCACTG\n+\nFFFFFFFFFFFF\n"
+
+
+def test_read_fastq_chunks_carry_over():
+    records = [b"@r%d\n%s\n+\n%s\n" % (i, b"ACGT" * (i % 5 + 1), b"F" * (4 * (i % 5 + 1)))
+               for i in range(100)]
+    # Blocks smaller than a record force partial records to be carried over
+    chunks = list(read_fastq_chunks(io.BytesIO(b"".join(records)), chunk_size=7, block_size=5))
+    assert [len(chunk) for chunk in chunks] == [7] * 14 + [2]
+    assert b"".join(chunk.record_bytes(range(len(chunk))) for chunk in chunks) == b"".join(records)
+    matrix = chunks[0].sequence_matrix(6)
+    assert bytes(matrix[0]) == b"ACGT\0\0"
+    assert bytes(matrix[1]) == b"ACGTAC"
+    # Slices covered by every read are gathered without padding
+    assert bytes(chunks[0].sequence_matrix(4, start=1)[0]) == b"CGT"
+    # Consecutive and scattered records are copied in the order given
+    assert chunks[0].record_bytes([0, 1, 2, 5]) == b"".join(records[i] for i in (0, 1, 2, 5))
+    assert chunks[0].record_bytes([]) == b""
+
+
+def test_read_fastq_chunks_truncated():
+    try:
+        list(read_fastq_chunks(io.BytesIO(b"@r1\nACGT\n+\n"), chunk_size=10))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Truncated record was not detected")
+
+
+def _fastq(names):
+    return io.BytesIO(b"".join(b"@%s\nACGT\n+\nFFFF\n" % name for name in names))
+
+
+def test_read_paired_chunks_checks_names():
+    r1 = _fastq([b"r%d/1 1:N:0" % i for i in range(5)])
+    r2 = _fastq([b"r%d/2 2:N:0" % i for i in range(5)])
+    pairs = list(read_paired_chunks(r1, r2, chunk_size=2, libname="pool1"))
+    assert [len(chunk1) for chunk1, _ in pairs] == [2, 2, 1]
+    assert pairs[2][0].read_name(0) == b"r4"
+    with pytest.raises(ValueError, match="out of sync"):
+        list(read_paired_chunks(_fastq([b"a", b"b", b"c"]), _fastq([b"a", b"c", b"d"]),
+                                chunk_size=2, libname="pool1"))
+    with pytest.raises(ValueError, match="different numbers"):
+        list(read_paired_chunks(_fastq([b"a", b"b"]), _fastq([b"a"]),
+                                chunk_size=2, libname="pool1"))
+
+
+def test_load_fastq_single_pass(tmp_path, write_fastq):
+    from src.column_store import open_columns
+    from collections import OrderedDict
+    from src.fastq_loader import load_fastq
+    from src.encoding import decode_array
+
+    r1 = ["AAAACCCCGGGGTTTT" + "ACGTACGTACGT", "CCCCAAAAGGGGTTTT" + "TTTTGGGGCCCC"]
+    r2 = ["TTGGCCTTTGTATCGAAA", "AACGCCAGTATGAACAAA"]
+    write_fastq(tmp_path / "R1.fastq", r1)
+    write_fastq(tmp_path / "R2.fastq", r2)
+    config = {"positions": {
+        "cell_barcode_R12": "R1", "cell_barcode_start": 1, "cell_barcode_end": 16,
+        "umi_R12": "R1", "umi_start": 17, "umi_end": 28,
+        "hto_R12": "R2", "hto_start": 1, "hto_end": 15}}
+    statistics = load_fastq("pool1", str(tmp_path / "R1.fastq"), str(tmp_path / "R2.fastq"),
+                            config, thread=1, chunk_size=1, output=str(tmp_path),
+                            statistics=OrderedDict())
+    assert statistics["Total read pair"] == 2
+    table = open_columns(str(tmp_path / "pool1_reads"), ["cell_barcode", "umi", "hto"])
+    # Fields are stored as packed integers
+    assert list(decode_array(table["cell_barcode"], 16)) == ["AAAACCCCGGGGTTTT", "CCCCAAAAGGGGTTTT"]
+    assert list(decode_array(table["umi"], 12)) == ["ACGTACGTACGT", "TTTTGGGGCCCC"]
+    assert list(decode_array(table["hto"], 15)) == ["TTGGCCTTTGTATCG", "AACGCCAGTATGAAC"]
+
+
+def test_load_fastq_lanes(tmp_path, write_fastq):
+    from collections import OrderedDict
+    from src.fastq_loader import load_fastq
+    from src.column_store import open_columns
+    from src.encoding import decode_array
+
+    config = {"positions": {
+        "cell_barcode_R12": "R1", "cell_barcode_start": 1, "cell_barcode_end": 4,
+        "umi_R12": "R1", "umi_start": 5, "umi_end": 8,
+        "hto_R12": "R2", "hto_start": 1, "hto_end": 4}}
+    bases = "ACGT"
+    lanes = []
+    for lane in range(3):
+        r1 = [bases[lane] * 4 + bases[i % 4] * 4 for i in range(5 + lane)]
+        write_fastq(tmp_path / f"L{lane}_R1.fastq", r1)
+        write_fastq(tmp_path / f"L{lane}_R2.fastq", ["GGGG"] * len(r1))
+        lanes.append(r1)
+    statistics = load_fastq("pool1", [str(tmp_path / f"L{lane}_R1.fastq") for lane in range(3)],
+                            [str(tmp_path / f"L{lane}_R2.fastq") for lane in range(3)],
+                            config, thread=3, chunk_size=2, output=str(tmp_path),
+                            statistics=OrderedDict())
+    assert statistics["Total read pair"] == 18
+    table = open_columns(str(tmp_path / "pool1_reads"), ["cell_barcode", "umi"])
+    # Lanes are concatenated in order and their shards removed
+    assert list(decode_array(table["cell_barcode"], 4)) == [seq[:4] for r1 in lanes for seq in r1]
+    assert sorted(path.name for path in tmp_path.glob("*.col")) == [
+        "pool1_reads.cell_barcode.col", "pool1_reads.hto.col", "pool1_reads.umi.col"]
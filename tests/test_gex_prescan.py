@@ -0,0 +1,55 @@
+import gzip
+from collections import OrderedDict
+import pandas as pd
+import pytest
+from src.demultiplexer import split_GEX_fastqs
+from src.encoding import encode_array
+from src.gex_prescan import prescan_gex
+
+
+def _library(tmp_path, write_fastq):
+    barcodes = ["AAAA", "CCCC", "AAAT", "GGGG", "AC"]
+    config = {"positions": {"cell_barcode_R12": "R1", "cell_barcode_start": 1,
+                            "cell_barcode_end": 4},
+              "HTO_sequences": [{"htolib_name": "pool1", "sample_name": "s1"},
+                                {"htolib_name": "pool1", "sample_name": "s2"}],
+              "libraries_to_be_demultiplexed": []}
+    for lane in range(2):
+        r1 = [barcodes[(lane + i) % len(barcodes)] + "ACGT" for i in range(7 + lane)]
+        write_fastq(tmp_path / f"L{lane}_R1.fastq", r1)
+        write_fastq(tmp_path / f"L{lane}_R2.fastq", ["GATTACA"] * len(r1))
+    for R12 in ("R1", "R2"):
+        config["libraries_to_be_demultiplexed"].append(
+            {"htolib_name": "pool1", "R12": R12,
+             "path": [str(tmp_path / f"L{lane}_{R12}.fastq") for lane in range(2)]})
+    filtered_df = pd.DataFrame({"cell_barcode": encode_array(["AAAA", "CCCC"], 4),
+                                "sample": ["s1", "s2"]})
+    return config, filtered_df
+
+
+def _split(tmp_path, config, filtered_df, prescanned):
+    output = tmp_path / ("prescanned" if prescanned else "direct")
+    output.mkdir()
+    if prescanned:
+        assert prescan_gex("pool1", config, str(output), chunk_size=3) == 15
+    statistics = split_GEX_fastqs("pool1", config, filtered_df, str(output), chunk_size=3,
+                                  statistics=OrderedDict(), thread=2, prescanned=prescanned)
+    outputs = {path.name: gzip.open(path).read() for path in output.glob("*.fastq.gz")}
+    return statistics, outputs
+
+
+def test_prescanned_split_matches_direct_split(tmp_path, write_fastq):
+    config, filtered_df = _library(tmp_path, write_fastq)
+    statistics, outputs = _split(tmp_path, config, filtered_df, prescanned=False)
+    assert statistics["GEX filtered read pairs of s1"] == 6
+    assert _split(tmp_path, config, filtered_df, prescanned=True) == (statistics, outputs)
+
+
+def test_prescan_detects_changed_fastq(tmp_path, write_fastq):
+    config, filtered_df = _library(tmp_path, write_fastq)
+    prescan_gex("pool1", config, str(tmp_path), chunk_size=3)
+    write_fastq(tmp_path / "L1_R1.fastq", ["AAAAACGTT"] * 8)
+    write_fastq(tmp_path / "L1_R2.fastq", ["GATTACA"] * 8)
+    with pytest.raises(ValueError, match="do not match their prescan"):
+        split_GEX_fastqs("pool1", config, filtered_df, str(tmp_path), chunk_size=3,
+                         statistics=OrderedDict(), prescanned=True)
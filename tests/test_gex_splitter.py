@@ -0,0 +1,97 @@
+import io
+import threading
+import numpy as np
+import pytest
+from src.fastq_loader import read_fastq_chunks
+from src.gex_splitter import split_chunks, label_reads, gather_records, kernel
+from src.barcode_index import BarcodeIndex
+from src.encoding import encode_array
+
+
+def _chunks(n_chunks, chunk_size):
+    barcodes = ["AAAA", "CCCC", "GGGG", "AAAT", "TTTT"]
+    r1, r2 = [], []
+    for c in range(n_chunks):
+        for i in range(chunk_size):
+            seq = barcodes[(c + i) % len(barcodes)] + "ACGTAC"
+            r1.append(f"@r{c}_{i}\n{seq}\n+\n{'F' * len(seq)}\n")
+            r2.append(f"@r{c}_{i}\nGATTACA\n+\nFFFFFFF\n")
+    return zip(read_fastq_chunks(io.BytesIO("".join(r1).encode()), chunk_size),
+               read_fastq_chunks(io.BytesIO("".join(r2).encode()), chunk_size))
+
+
+def _split(workers, samples=("s1", "s2"), whitelist=("AAAA", "CCCC"), chunk_pairs=None):
+    # AAAT is one mismatch away from AAAA
+    index = BarcodeIndex(encode_array(list(whitelist), 4), [0, 1], 4)
+    routing = (list(samples), index, 0, 4, "R1")
+    out_R1 = {sample: io.BytesIO() for sample in samples}
+    out_R2 = {sample: io.BytesIO() for sample in samples}
+    total, counts = split_chunks(chunk_pairs or _chunks(6, 7), routing, out_R1, out_R2,
+                                 workers=workers)
+    return total, counts, {s: (out_R1[s].getvalue(), out_R2[s].getvalue()) for s in samples}
+
+
+def test_parallel_split_matches_serial():
+    total, counts, records = _split(workers=0)
+    assert total == 42
+    assert counts == {"s1": 17, "s2": 9}
+    assert records["s1"][0].startswith(b"@r0_0\nAAAAACGTAC\n+\nFFFFFFFFFF\n@r0_3\nAAATACGTAC\n")
+    assert _split(workers=2) == (total, counts, records)
+
+
+def test_process_pool_split_matches_serial(monkeypatch):
+    # Without the compiled kernel chunks are routed on worker processes
+    monkeypatch.setattr("src.gex_splitter.kernel", None)
+    serial = _split(workers=0)
+    assert _split(workers=2) == serial
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_concurrent_splits_keep_their_routing(workers):
+    # Libraries split at the same time, e.g. with --parallel_libraries
+    libraries = {"pool1": (("s1", "s2"), ("AAAA", "CCCC")),
+                 "pool2": (("t1", "t2"), ("GGGG", "TTTT"))}
+    barrier = threading.Barrier(len(libraries), timeout=60)
+
+    def chunks_together():
+        chunk_pairs = _chunks(6, 7)
+        barrier.wait()
+        yield from chunk_pairs
+
+    results = {}
+
+    def split(lib):
+        results[lib] = _split(workers, *libraries[lib], chunk_pairs=chunks_together())
+
+    threads = [threading.Thread(target=split, args=(lib,)) for lib in libraries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for lib, (samples, whitelist) in libraries.items():
+        assert results[lib] == _split(0, samples, whitelist)
+
+
+@pytest.mark.skipif(kernel is None, reason="compiled kernel is not built")
+def test_compiled_kernel_matches_numpy():
+    rng = np.random.default_rng(3)
+    bases = np.array(list("ACGTN"))
+    whitelist = ["".join(rng.choice(bases[:4], 6)) for _ in range(300)]
+    reads = []
+    for i in range(3000):
+        barcode = list(whitelist[rng.integers(len(whitelist))])
+        # Exact matches, mismatches (also with N) and reads shorter than the barcode
+        for position in rng.choice(8, rng.integers(3), replace=False):
+            if position < 6:
+                barcode[position] = rng.choice(bases)
+        seq = "GG" + "".join(barcode) + "ACGT"
+        seq = seq[:rng.integers(5, 12)] if i % 50 == 0 else seq
+        reads.append(f"@r{i}\n{seq}\n+\n{'F' * len(seq)}\n")
+    chunk = next(read_fastq_chunks(io.BytesIO("".join(reads).encode()), 5000))
+    # Barcodes shared by samples and their neighbours are ambiguous
+    index = BarcodeIndex(encode_array(whitelist, 6), rng.integers(0, 3, len(whitelist)), 6)
+    labels = label_reads(chunk, index, 2, 8, compiled=False)
+    assert set(np.unique(labels)) == {-2, -1, 0, 1, 2}
+    assert np.array_equal(label_reads(chunk, index, 2, 8, compiled=True), labels)
+    assert gather_records(chunk, labels, 3, compiled=True) == \
+        gather_records(chunk, labels, 3, compiled=False)
@@ -0,0 +1,106 @@
+import gzip
+import os
+from collections import OrderedDict
+import numpy as np
+import pytest
+from src.gzip_index import (GzipIndex, FastqRange, load_index, index_path, record_ranges,
+                            split_lanes, zran)
+
+pytestmark = pytest.mark.skipif(zran is None, reason="zran extension is not built")
+
+
+def _fastq(n, seed, header="@read"):
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in range(n):
+        seq = "".join(rng.choice(list("ACGT"), rng.integers(20, 40)))
+        lines.append(f"{header}{i}\n{seq}\n+\n{'F' * len(seq)}\n")
+    return "".join(lines).encode()
+
+
+def test_ranges_cover_the_file(tmp_path):
+    data = _fastq(5000, 0)
+    path = str(tmp_path / "R1.fastq.gz")
+    # A multi-member file: checkpoints are resumed across member boundaries
+    with open(path, "wb") as f:
+        f.write(gzip.compress(data[:len(data) // 3]) + gzip.compress(data[len(data) // 3:]))
+    index = GzipIndex.build(path, spacing=1 << 14)
+    assert len(index) > 2 and index.size == len(data)
+    records = data.splitlines(keepends=True)
+    ranges = record_ranges(index, 4)
+    assert len(ranges) == 3 and ranges[0][0] == 0 and ranges[-1][1] is None
+
+    def read(first, last):
+        with FastqRange(path, index, first, last).open(block_size=1 << 12) as f:
+            return b"".join(iter(f.read, b""))
+
+    assert b"".join(read(first, last) for first, last in ranges) == data
+    # Ranges may also start between checkpoints
+    assert read(1234, 2345) == b"".join(records[4 * 1234:4 * 2345])
+    assert read(4999, None) == b"".join(records[4 * 4999:])
+
+
+def test_zero_padding_ends_members(tmp_path):
+    data = _fastq(6000, 5)
+    path = str(tmp_path / "R1.fastq.gz")
+    # Zero padding after members, which the gzip module skips
+    half = len(data) // 2
+    with open(path, "wb") as f:
+        f.write(gzip.compress(data[:half]) + bytes(100) + gzip.compress(data[half:]) + bytes(5000))
+    assert gzip.open(path).read() == data
+    index = GzipIndex.build(path, spacing=1 << 13)
+    assert index.size == len(data)
+    ranges = record_ranges(index, 4)
+    assert len(ranges) > 2
+
+    def read(first, last):
+        with FastqRange(path, index, first, last).open(block_size=1 << 12) as f:
+            return b"".join(iter(f.read, b""))
+
+    assert b"".join(read(first, last) for first, last in ranges) == data
+
+
+def test_load_index_reuses_sidecar(tmp_path):
+    path = str(tmp_path / "R1.fastq.gz")
+    with open(path, "wb") as f:
+        f.write(gzip.compress(_fastq(100, 1)))
+    index = load_index(path)
+    assert os.path.exists(index_path(path))
+    assert load_index(path).windows == index.windows
+    # A changed file is indexed again
+    with open(path, "wb") as f:
+        f.write(gzip.compress(_fastq(200, 2)))
+    assert load_index(path).size == len(_fastq(200, 2))
+    assert load_index(str(tmp_path / "plain.fastq")) is None
+
+
+def test_split_lanes_aligns_mates(tmp_path):
+    from src.fastq_loader import load_fastq
+    from src.column_store import open_columns
+
+    paths = {}
+    for R12, seed in (("R1", 3), ("R2", 4)):
+        paths[R12] = str(tmp_path / f"{R12}.fastq.gz")
+        # Mates of other lengths get checkpoints at other records
+        with open(paths[R12], "wb") as f:
+            f.write(gzip.compress(_fastq(4000, seed)))
+        load_index(paths[R12], spacing=1 << 14)
+    parts = split_lanes([(paths["R1"], paths["R2"])], 3, thread=2)
+    assert len(parts) > 1
+    for part_R1, part_R2 in parts:
+        assert (part_R1.first, part_R1.last) == (part_R2.first, part_R2.last)
+
+    config = {"positions": {
+        "cell_barcode_R12": "R1", "cell_barcode_start": 1, "cell_barcode_end": 8,
+        "umi_R12": "R1", "umi_start": 9, "umi_end": 16,
+        "hto_R12": "R2", "hto_start": 1, "hto_end": 15}}
+    tables = []
+    for gzip_index, output in ((False, tmp_path / "serial"), (True, tmp_path / "ranges")):
+        output.mkdir()
+        statistics = load_fastq("pool1", paths["R1"], paths["R2"], config, thread=3,
+                                chunk_size=500, output=str(output), statistics=OrderedDict(),
+                                gzip_index=gzip_index)
+        assert statistics["Total read pair"] == 4000
+        tables.append(open_columns(str(output / "pool1_reads"), ["cell_barcode", "umi", "hto"]))
+    for column in ("cell_barcode", "umi", "hto"):
+        assert np.array_equal(tables[0][column], tables[1][column])
@@ -0,0 +1,116 @@
+import gzip
+import json
+import yaml
+from src import main as schto
+from src.main import build_parser, main, process_library
+from src.memory_budget import MIN_CHUNK_SIZE
+from src.scheduler import ResourcePool
+
+
+def _run(tmp_path, config, *options):
+    output = tmp_path / "out"
+    args = build_parser().parse_args(["--input", "config.yaml", "--output", str(output),
+                                      "--threads", "2", "--chunk_size", "3", *options])
+    output.mkdir(exist_ok=True)
+    files = {R12: [str(tmp_path / f"pool1_H_{R12}.fastq")] for R12 in ("R1", "R2")}
+    statistics = process_library("pool1", files, config, args, ResourcePool(cores=args.threads))
+    with open(output / "pool1_performance.json") as f:
+        stages = json.load(f)["stages"]
+    return statistics, [stage["stage"] for stage in stages if not stage["cached"]]
+
+
+def test_process_library_reuses_stages(tmp_path, library_config):
+    config = library_config()
+    statistics, run = _run(tmp_path, config)
+    assert run == ["extract", "categorize", "deduplicate", "filter", "split"]
+    assert statistics["Filtered barcodes of s1"] == 1
+    # Nothing changed: every stage is reused with its statistics
+    assert _run(tmp_path, config) == (statistics, [])
+
+    # Only the stages after a changed parameter run again
+    config["expected_cell_number"][0]["estimate_number"] = 2
+    changed, run = _run(tmp_path, config)
+    assert run == ["filter", "split"]
+    assert changed["Filtered barcodes of s1"] == 2
+    assert changed["Total read pair"] == statistics["Total read pair"]
+    assert _run(tmp_path, config)[1] == []
+
+    _, run = _run(tmp_path, config, "--no_cache")
+    assert run == ["extract", "categorize", "deduplicate", "filter", "split"]
+
+
+def _main(tmp_path, monkeypatch, config, output, *options):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.safe_dump(config))
+    monkeypatch.setattr("sys.argv", ["schto", "--input", str(config_path), "--output",
+                                     str(tmp_path / output), "--threads", "2",
+                                     "--chunk_size", "3", *options])
+    main()
+    paths = sorted((tmp_path / output).iterdir())
+    # Timings, logs and manifests differ between runs
+    outputs = {"files": [path.name for path in paths]}
+    for path in paths:
+        if path.name.endswith(".fastq.gz"):
+            outputs[path.name] = gzip.open(path).read()
+        elif path.suffix == ".csv" and not path.name.endswith("_performance.csv"):
+            outputs[path.name] = path.read_bytes()
+    return outputs
+
+
+def test_parallel_libraries_match_serial_run(tmp_path, monkeypatch, library_config):
+    # Libraries with other cell barcodes and sample names are split at the same time
+    config = library_config(libraries=("pool1", "pool2"), samples={"pool2": ("t1", "t2")})
+    serial = _main(tmp_path, monkeypatch, config, "serial")
+    assert {"pool1_statistics.csv", "pool2_statistics.csv", "pool1_s1_R1.fastq.gz",
+            "pool2_t2_R2.fastq.gz"} <= set(serial)
+    # AAAA and AAAT of pool1 are CCCC and CCCA in pool2
+    assert serial["pool1_s1_R1.fastq.gz"].count(b"\nAAAAACGTAC\n") == 3
+    assert serial["pool2_t1_R1.fastq.gz"].count(b"\nCCCCACGTAC\n") == 3
+    assert serial["pool2_t1_R1.fastq.gz"].count(b"\nCCCAACGTAC\n") == 3
+    assert _main(tmp_path, monkeypatch, config, "parallel", "--parallel_libraries", "2") == serial
+
+
+def test_max_memory_plan_reaches_steps(tmp_path, monkeypatch, library_config):
+    calls = {}
+
+    def spy(name):
+        function = getattr(schto, name)
+
+        def run(**kwargs):
+            calls[name] = kwargs
+            return function(**kwargs)
+        monkeypatch.setattr(schto, name, run)
+
+    for name in ("load_fastq", "deduplicate_umi", "split_GEX_fastqs"):
+        spy(name)
+    outputs = _main(tmp_path, monkeypatch, library_config(), "out", "--threads", "4",
+                    "--chunk_size", "1000000", "--max_memory", "230")
+    statistics = dict(line.split(",", 1) for line in
+                      outputs["pool1_statistics.csv"].decode().splitlines())
+    # The chunks had to shrink to fit the budget
+    for step, name in (("Extraction", "load_fastq"), ("GEX splitting", "split_GEX_fastqs")):
+        assert int(statistics[f"{step} chunk size"]) < 1000000
+        assert calls[name]["chunk_size"] == int(statistics[f"{step} chunk size"])
+        assert calls[name]["thread"] == int(statistics[f"{step} threads"])
+        assert calls[name]["prefetch_blocks"] == int(statistics[f"{step} read-ahead blocks"])
+        assert 0 < int(statistics[f"{step} memory estimate (MB)"]) <= 230
+    assert statistics["Deduplication mode"] == "in memory"
+    assert calls["deduplicate_umi"]["memory_budget"] is None
+    assert calls["deduplicate_umi"]["chunk_size"] == \
+        int(statistics["Deduplication chunk size"])
+
+
+def test_dedup_memory_caps_chunk_size(tmp_path, monkeypatch, library_config):
+    calls = []
+    deduplicate_umi = schto.deduplicate_umi
+
+    def spy(**kwargs):
+        calls.append(kwargs)
+        return deduplicate_umi(**kwargs)
+    monkeypatch.setattr(schto, "deduplicate_umi", spy)
+    outputs = _main(tmp_path, monkeypatch, library_config(), "out", "--chunk_size", "1000000",
+                    "--dedup_memory", "1")
+    # The default chunk alone would take far more than 1 MB
+    assert calls[0]["memory_budget"] == 1024 ** 2
+    assert calls[0]["chunk_size"] == MIN_CHUNK_SIZE
+    assert b"Unique barcodes and UMIs of s1,5" in outputs["pool1_statistics.csv"]
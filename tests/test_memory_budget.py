@@ -0,0 +1,50 @@
+import gzip
+from src.memory_budget import (MIN_CHUNK_SIZE, DEDUP_BYTES_PER_READ, estimate_chunk_memory,
+                               plan_chunks, plan_deduplication, record_bytes,
+                               streaming_chunk_size)
+
+MB = 1024 ** 2
+
+
+def test_record_bytes(tmp_path):
+    record = b"@read\nACGTACGTAC\n+\nFFFFFFFFFF\n"
+    path = tmp_path / "R1.fastq.gz"
+    path.write_bytes(gzip.compress(record * 1000))
+    assert record_bytes(str(path)) == len(record)
+
+
+def test_plan_chunks_fits_budget():
+    # A large budget keeps the requested chunk size and all threads
+    plan = plan_chunks("split", 8192 * MB, 300, 1000000, threads=4)
+    assert (plan["chunk_size"], plan["threads"]) == (1000000, 4)
+    # A smaller one shrinks chunks to fit
+    plan = plan_chunks("split", 600 * MB, 300, 1000000, threads=4)
+    assert MIN_CHUNK_SIZE <= plan["chunk_size"] < 1000000
+    assert plan["memory"] <= 600 * MB
+    assert plan["memory"] == estimate_chunk_memory("split", plan["chunk_size"], 300,
+                                                   plan["threads"], plan["prefetch_blocks"])
+    # Threads and read-ahead are given up before chunks get too small
+    tight = plan_chunks("split", 250 * MB, 300, 1000000, threads=8, lanes=2)
+    assert tight["threads"] < 8 and tight["memory"] <= 250 * MB
+    assert tight["chunk_size"] >= MIN_CHUNK_SIZE
+
+
+def test_plan_chunks_over_budget(caplog):
+    plan = plan_chunks("extract", 10 * MB, 300, 1000000, threads=4)
+    assert (plan["chunk_size"], plan["threads"], plan["prefetch_blocks"]) == (MIN_CHUNK_SIZE, 1, 1)
+    assert "more than its memory budget" in caplog.text
+
+
+def test_plan_deduplication():
+    assert plan_deduplication(100 * MB, 1000, 5000)["memory_budget"] is None
+    plan = plan_deduplication(100 * MB, 10 ** 8, 10 ** 7)
+    assert plan["memory_budget"] == 50 * MB
+    assert plan["chunk_size"] < 10 ** 7
+
+
+def test_streaming_chunk_size():
+    # A quarter of the budget holds the reads of a chunk
+    assert streaming_chunk_size(64 * MB, 10 ** 6) == 16 * MB // DEDUP_BYTES_PER_READ
+    assert streaming_chunk_size(1024 * MB, 10 ** 6) == 10 ** 6
+    assert streaming_chunk_size(1 * MB, 10 ** 6) == MIN_CHUNK_SIZE
+    assert streaming_chunk_size(1 * MB, 1000) == 1000
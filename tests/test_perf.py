@@ -0,0 +1,27 @@
+import csv
+import json
+import numpy as np
+from src.perf import StageTimer
+
+
+def test_stage_timer(tmp_path):
+    timer = StageTimer("lib", str(tmp_path), profile=True)
+    with timer.stage("extract") as record:
+        data = np.ones(20 * 1024 ** 2 // 8)
+        (tmp_path / "out.bin").write_bytes(data.tobytes())
+        record["reads"] = 1000
+    timer.skip("filter", 1000)
+    timer.save()
+
+    report = json.loads((tmp_path / "lib_performance.json").read_text())
+    extract, filter_ = report["stages"]
+    assert extract["stage"] == "extract" and not extract["cached"]
+    assert extract["reads"] == 1000 and extract["reads_per_sec"] > 0
+    assert extract["wall_seconds"] >= 0 and extract["cpu_seconds"] >= 0
+    assert extract["peak_rss_mb"] > 20
+    assert extract["write_bytes"] >= 20 * 1024 ** 2
+    assert filter_["cached"] and filter_["wall_seconds"] is None
+    rows = list(csv.DictReader(open(tmp_path / "lib_performance.csv")))
+    assert [row["stage"] for row in rows] == ["extract", "filter"]
+    assert (tmp_path / "lib_extract.prof").exists()
+    assert not (tmp_path / "lib_filter.prof").exists()
@@ -0,0 +1,42 @@
+import gzip
+import json
+from src import Pipeline
+
+
+def test_pipeline_in_memory(tmp_path, library_config):
+    config = library_config()
+    result = Pipeline(config, chunk_size=3).run()["pool1"]
+    assert result.statistics["Total read pair"] == 9
+    assert result.statistics["Valid HTOs"] == 8
+    assert result.statistics["Unique barcodes and UMIs of s1"] == 5
+    # Plain Python values, as in the statistics CSV
+    assert all(type(value) in (int, str) for value in result.statistics.values())
+    assert json.loads(json.dumps(result.statistics)) == result.statistics
+    tolerant = Pipeline(config, chunk_size=3, hto_hamming_distance=1).run()["pool1"]
+    assert type(tolerant.statistics["Ambiguous HTOs"]) is int
+    assert result.filtered_barcodes.astype({"sample": str}).values.tolist() == [
+        ["s1", "AAAA", 3], ["s2", "CCCC", 2]]
+    # Without an output directory nothing is written and GEX is not split
+    assert "GEX total read pairs" not in result.statistics
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "pool1_G_R1.fastq", "pool1_G_R2.fastq", "pool1_H_R1.fastq", "pool1_H_R2.fastq"]
+
+
+def test_pipeline_writes_only_final_outputs(tmp_path, library_config):
+    config = library_config()
+    result = Pipeline(config, output=str(tmp_path / "out"), chunk_size=3).run_library("pool1")
+    # AAAT is one mismatch away from AAAA
+    assert result.statistics["GEX filtered read pairs of s1"] == 6
+    assert sorted(path.name for path in (tmp_path / "out").iterdir()) == [
+        f"pool1_{sample}_{R12}.fastq.gz" for sample in ("s1", "s2") for R12 in ("R1", "R2")]
+
+    persisted = Pipeline(config, output=str(tmp_path / "persisted"), chunk_size=3,
+                         persist=True).run_library("pool1")
+    assert all(type(value) in (int, str) for value in persisted.statistics.values())
+    assert persisted.statistics == result.statistics
+    assert (tmp_path / "persisted" / "pool1_statistics.csv").exists()
+    assert (tmp_path / "persisted" / "pool1_reads.hto.col").exists()
+    for sample in ("s1", "s2"):
+        name = f"pool1_{sample}_R1.fastq.gz"
+        assert gzip.open(tmp_path / "out" / name).read() == \
+            gzip.open(tmp_path / "persisted" / name).read()
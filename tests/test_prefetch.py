@@ -0,0 +1,33 @@
+import gzip
+import threading
+import pytest
+from src.prefetch import PrefetchReader
+
+
+def test_prefetch_reader_blocks(tmp_path):
+    payload = bytes(range(256)) * 1000
+    path = tmp_path / "data.gz"
+    path.write_bytes(gzip.compress(payload))
+    with PrefetchReader(str(path), block_size=1000, depth=2) as reader:
+        # Reads never return more than asked for, nor more than one block
+        assert reader.read(10) == payload[:10]
+        assert reader.read() == payload[10:1000]
+        data = reader.read(1000) + b"".join(iter(lambda: reader.read(300), b""))
+    assert data == payload[1000:]
+
+
+def test_prefetch_reader_stops_early_and_on_errors(tmp_path):
+    path = tmp_path / "data.txt"
+    path.write_bytes(b"x" * 100000)
+    with PrefetchReader(str(path), block_size=10, depth=2) as reader:
+        assert reader.read(10) == b"x" * 10
+    # The reader stops its thread although the queue was full
+    assert not reader.thread.is_alive()
+    (tmp_path / "broken.gz").write_bytes(b"not gzip data")
+    with PrefetchReader(str(tmp_path / "broken.gz")) as reader:
+        with pytest.raises(OSError):
+            reader.read(10)
+    with pytest.raises(FileNotFoundError):
+        with PrefetchReader(str(tmp_path / "missing.fastq")) as reader:
+            reader.read(10)
+    assert not any(thread.name.startswith("prefetch-") for thread in threading.enumerate())
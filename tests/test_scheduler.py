@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+from src.scheduler import ResourcePool, library_log, run_libraries, run_lanes
+
+
+def test_resource_pool_budget():
+    pool = ResourcePool(cores=4, memory=100)
+    lock = threading.Lock()
+    usage = {"cores": 0, "memory": 0, "peak_cores": 0, "peak_memory": 0}
+
+    def stage(cores, memory):
+        with pool.acquire(cores=cores, memory=memory) as granted:
+            with lock:
+                usage["cores"] += granted
+                usage["memory"] += memory
+                usage["peak_cores"] = max(usage["peak_cores"], usage["cores"])
+                usage["peak_memory"] = max(usage["peak_memory"], usage["memory"])
+            time.sleep(0.01)
+            with lock:
+                usage["cores"] -= granted
+                usage["memory"] -= memory
+
+    threads = [threading.Thread(target=stage, args=(1 + i % 3, 40)) for i in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert usage["peak_cores"] <= 4
+    assert usage["peak_memory"] <= 100
+    assert pool.free_cores == 4 and pool.free_memory == 100
+
+
+def test_resource_pool_elastic():
+    pool = ResourcePool(cores=4)
+    with pool.acquire(cores=3):
+        with pool.acquire(cores=4, min_cores=1) as granted:
+            assert granted == 1
+    # Requests beyond the budget are capped instead of waiting forever.
+    with pool.acquire(cores=8) as granted:
+        assert granted == 4
+
+
+def test_run_libraries_isolates_logs(tmp_path):
+    logger = logging.getLogger("test_scheduler")
+    logger.setLevel(logging.INFO)
+
+    def process(lib, value):
+        with library_log(lib, str(tmp_path / f"{lib}.log")):
+            logger.info("processing %s", lib)
+            if value is None:
+                raise ValueError("missing input")
+            return {"Library name": lib, "value": value}
+
+    results = run_libraries({"a": 1, "b": 2, "c": None}, process, parallel_libraries=3)
+    assert results == {"a": {"Library name": "a", "value": 1},
+                       "b": {"Library name": "b", "value": 2}}
+    for lib in "abc":
+        assert (tmp_path / f"{lib}.log").read_text() == f"processing {lib}\n"
+
+
+def test_run_lanes_logs_as_library(tmp_path):
+    logger = logging.getLogger("test_scheduler")
+    logger.setLevel(logging.INFO)
+
+    def process_lane(lane):
+        time.sleep(0.01 * (3 - lane))
+        logger.info("lane %d", lane)
+        return lane * 10
+
+    with library_log("a", str(tmp_path / "a.log")):
+        assert run_lanes([1, 2, 3], process_lane, workers=3) == [10, 20, 30]
+    assert sorted((tmp_path / "a.log").read_text().splitlines()) == ["lane 1", "lane 2", "lane 3"]
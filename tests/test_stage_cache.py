@@ -0,0 +1,43 @@
+import os
+import numpy as np
+from src.stage_cache import StageCache
+
+
+def test_stage_cache_reuse(tmp_path):
+    fastq = tmp_path / "reads.fastq"
+    fastq.write_text("@r1\nACGT\n+\nFFFF\n")
+    result = tmp_path / "result.csv"
+    result.write_text("sample,count\n")
+
+    cache = StageCache(str(tmp_path), "lib")
+    key = cache.key("extract", files=[str(fastq)], positions={"hto_start": 1})
+    assert cache.load("extract", key) is None
+    cache.save("extract", key, [str(result)], {"Total read pair": np.int64(1)},
+               samples=["s1"])
+
+    # A new run reads the manifest back
+    cache = StageCache(str(tmp_path), "lib")
+    entry = cache.load("extract", key)
+    assert entry["statistics"] == {"Total read pair": 1}
+    assert entry["samples"] == ["s1"]
+    assert StageCache(str(tmp_path), "lib", enabled=False).load("extract", key) is None
+
+    # Changed parameters, parents and inputs give other keys
+    assert cache.key("extract", files=[str(fastq)], positions={"hto_start": 2}) != key
+    assert cache.key("extract", parent="x", files=[str(fastq)],
+                     positions={"hto_start": 1}) != key
+    fastq.write_text("@r1\nACGTA\n+\nFFFFF\n")
+    assert cache.key("extract", files=[str(fastq)], positions={"hto_start": 1}) != key
+
+
+def test_stage_cache_modified_output(tmp_path):
+    result = tmp_path / "result.csv"
+    result.write_text("sample,count\n")
+    cache = StageCache(str(tmp_path), "lib")
+    key = cache.key("filter", expected_cell_number=[])
+    cache.save("filter", key, [str(result)])
+    assert cache.load("filter", key) is not None
+    result.write_text("sample,count\ns1,3\n")
+    assert cache.load("filter", key) is None
+    os.remove(result)
+    assert cache.load("filter", key) is None
@@ -0,0 +1,28 @@
+import numpy as np
+from src.umi_dedup import UMIDeduplicator
+
+
+def test_spilled_counts_match_in_memory(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 50000
+    labels = rng.integers(-2, 3, n).astype(np.int8)
+    cell_barcodes = rng.integers(0, 4 ** 16, 300, dtype=np.uint64)[rng.integers(0, 300, n)]
+    umis = rng.integers(0, 40, n).astype(np.uint32)
+    # A tiny budget forces several spills and key ranges in the final merge.
+    deduplicator = UMIDeduplicator(3, 16, 12, memory_budget=8000, tmpdir=str(tmp_path))
+    for start in range(0, n, 5000):
+        end = start + 5000
+        deduplicator.add(labels[start:end], cell_barcodes[start:end], umis[start:end])
+    counts = {}
+    for sample, barcodes, umi_counts in deduplicator.counts():
+        assert np.all(barcodes[1:] > barcodes[:-1])
+        for barcode, count in zip(barcodes.tolist(), umi_counts.tolist()):
+            assert (sample, barcode) not in counts
+            counts[(sample, barcode)] = count
+    assert deduplicator.n_spills > 1
+
+    expected = {}
+    for sample, barcode, _ in set(zip(labels.tolist(), cell_barcodes.tolist(), umis.tolist())):
+        if sample >= 0:
+            expected[(sample, barcode)] = expected.get((sample, barcode), 0) + 1
+    assert counts == expected